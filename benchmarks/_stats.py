@@ -0,0 +1,7 @@
+from typing import List
+
+
+def percentile(values: List[float], p: float) -> float:
+    """nearest-rank percentile, the same as the per-stage ones tracing.summarize reports"""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
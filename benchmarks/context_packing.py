@@ -0,0 +1,72 @@
+"""Compares the LLM latency of packed contexts against sending the top 3 documents whole.
+
+Every query is retrieved and reranked once through main_logic.retrieve_documents, then the
+QA chain runs on both contexts, alternating which goes first, against the deployed
+Vertex AI LLM (same environment as the main_logic function). Reports the LLM latency
+distribution, estimated prompt tokens and answer lengths of each.
+
+Queries are JSON lines: {"query": ..., "user_id": ...}
+
+    project_id=... CONTEXT_TOKEN_BUDGET=2000 python benchmarks/context_packing.py queries.jsonl --repeat 3
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+from time import perf_counter
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(os.path.join(os.path.dirname(__file__), "../cloud_functions/main_logic"))
+import context_packer  # noqa: E402
+import main  # noqa: E402
+from _stats import percentile  # noqa: E402
+
+
+def run_chain(context, query: str):
+    start = perf_counter()
+    response = main.components.get('QAchain')({"input_documents": context, "question": query}, return_only_outputs=True)
+    return perf_counter() - start, response.get('output_text', '')
+
+
+def main_benchmark(path: str, repeat: int):
+    with open(path) as f:
+        queries = [json.loads(line) for line in f if line.strip()]
+    packer = main.components.get('context_packer')
+
+    report = {mode: {'latency': [], 'tokens': [], 'answer_chars': [], 'empty': 0} for mode in ('top3', 'packed')}
+    for i, item in enumerate(queries):
+        docs, _ = main.retrieve_documents(item['query'], item['user_id'], main.retrieval_mode == 'adaptive')
+        top3 = docs[:3]
+        packed, stats = packer.pack(docs, item['query'])
+        contexts = {
+            'top3': (top3, context_packer.estimate_tokens(item['query'] + "".join(doc.page_content for doc in top3))
+                     + context_packer.PROMPT_OVERHEAD_TOKENS),
+            'packed': (packed, stats['prompt_tokens']),
+        }
+        for r in range(repeat):
+            # alternate the order so warm-up and drift do not favour one side
+            for mode in (('top3', 'packed') if (i + r) % 2 == 0 else ('packed', 'top3')):
+                context, tokens = contexts[mode]
+                elapsed, answer = run_chain(context, item['query'])
+                report[mode]['latency'].append(elapsed)
+                report[mode]['tokens'].append(tokens)
+                report[mode]['answer_chars'].append(len(answer))
+                report[mode]['empty'] += not answer.strip()
+
+    print(f"{len(queries)} queries x {repeat}, token budget {packer.token_budget}, max documents {packer.max_documents}, "
+          f"dedup threshold {packer.dedup_threshold}")
+    for mode, values in report.items():
+        latency = values['latency']
+        print(f"{mode:>7}: LLM latency p50 {percentile(latency, 50):.2f}s p95 {percentile(latency, 95):.2f}s "
+              f"p99 {percentile(latency, 99):.2f}s | prompt tokens/query {statistics.mean(values['tokens']):.0f} | "
+              f"answer chars {statistics.mean(values['answer_chars']):.0f} | empty answers {values['empty']}")
+    print(f"packing: {context_packer.context_stats}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("queries")
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+    main_benchmark(args.queries, args.repeat)
@@ -0,0 +1,49 @@
+"""Compares per-event dispatch overhead of the workflow and direct http modes.
+
+Times pubsub_workflow.dispatch_workflow and dispatch_http with a feedback click, the
+cheapest event handle_message serves, so the numbers are dominated by the hop itself.
+Runs in the pubsub_workflow environment (same env vars and credentials):
+
+    HANDLE_MESSAGE_URL=https://... python benchmarks/dispatch_overhead.py --events 50
+
+The workflow mode only measures execution creation; the scheduling delay until the
+workflow calls handle_message shows up in the workflow_dispatch and handle_message spans
+of the tracing report.
+"""
+import argparse
+import os
+import sys
+from time import perf_counter
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(os.path.join(os.path.dirname(__file__), "../cloud_functions/pubsub_workflow"))
+import pubsub_workflow  # noqa: E402
+from events import FeedbackEvent  # noqa: E402
+from _stats import percentile  # noqa: E402
+
+
+def feedback_event(i: int) -> FeedbackEvent:
+    return FeedbackEvent(question_ts=f'{i}.0001', feedback=1, action_ts=f'{i}.0002', app_id='A0BENCH', user_id='U0BENCH')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=50)
+    parser.add_argument("--modes", nargs="+", default=["workflow", "http"])
+    args = parser.parse_args()
+
+    for mode in args.modes:
+        dispatch = pubsub_workflow.dispatchers[mode]
+        latencies = []
+        for i in range(args.events):
+            start = perf_counter()
+            dispatch(feedback_event(i))
+            latencies.append((perf_counter() - start) * 1000)
+        # the first call pays connection setup and token fetch, report it separately
+        warm = latencies[1:] or latencies
+        print(f"{mode:>9}: first {latencies[0]:.0f}ms | warm p50 {percentile(warm, 50):.0f}ms "
+              f"p95 {percentile(warm, 95):.0f}ms p99 {percentile(warm, 99):.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Micro-benchmark of per-event serialization CPU across pubsub -> pubsub_workflow -> handle_message.
+
+legacy: json.dumps of the already-JSON payload string at ingress, the while-loop json.loads
+        and protobuf Value round trip in pubsub_workflow, json.loads again in handle_message
+typed:  one orjson encode of the typed event at ingress and one decode per hop
+
+    python benchmarks/event_codec.py --events 100000
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from events import decode_event, decode_request, from_slack  # noqa: E402
+
+try:
+    from google.protobuf import json_format
+    from google.protobuf.struct_pb2 import Value
+except ImportError:
+    json_format = None
+
+MESSAGE = {"client_msg_id": "5b3e3c6e-0d1f-4b7a-9a43-5bd1d1a5f0c2", "type": "message",
+           "text": "How do I request access to the staging cluster?", "user": "U04ABCDEF12",
+           "ts": "1696861234.123456", "team": "T01ABCDEF", "channel": "D05ABCDEF", "event_ts": "1696861234.123456",
+           "channel_type": "im", "blocks": [{"type": "rich_text", "block_id": "x1Y2", "elements": [
+               {"type": "rich_text_section", "elements": [{"type": "text", "text": "How do I request access to the staging cluster?"}]}]}]}
+SHOWMORE = {"type": "interactive_message", "actions": [{"name": "show_more", "type": "button", "value": "showmore"}],
+            "callback_id": "U04ABCDEF12_1696861234.123456", "team": {"id": "T01ABCDEF", "domain": "example"},
+            "channel": {"id": "D05ABCDEF", "name": "directmessage"}, "user": {"id": "U04ABCDEF12", "name": "someone"},
+            "action_ts": "1696861240.000100", "message_ts": "1696861236.000200", "attachment_id": "4",
+            "original_message": {"app_id": "A05ABCDEF", "text": "", "attachments": [{"id": 4, "callback_id": "U04ABCDEF12_1696861234.123456"}]}}
+
+
+def legacy(payload_str: str, app_id: str):
+    # pubsub
+    published = json.dumps(payload_str).encode("utf-8")
+    # pubsub_workflow
+    decoded_data = published.decode().strip()
+    while type(decoded_data) == str:
+        decoded_data = json.loads(decoded_data)
+    body = {'data': decoded_data, 'app_id': app_id}
+    argument = json_format.MessageToJson(json_format.ParseDict(body, Value())) if json_format else json.dumps(body)
+    # handle_message
+    return json.loads(argument.encode('utf-8').decode('utf-8'))
+
+
+def typed(payload_str: str, app_id: str):
+    # pubsub
+    published = from_slack(json.loads(payload_str), app_id=app_id).encode()
+    # pubsub_workflow
+    event = decode_event(published)
+    # handle_message
+    return decode_request(event.encode())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=100000)
+    args = parser.parse_args()
+    if json_format is None:
+        print("protobuf not installed, the legacy path skips the Value round trip and is understated")
+    for name, payload in (("message", MESSAGE), ("showmore", SHOWMORE)):
+        payload_str = json.dumps(payload)
+        results = {}
+        for path in (legacy, typed):
+            seconds = min(timeit.repeat(lambda: path(payload_str, "A05ABCDEF"), number=args.events, repeat=3))
+            results[path.__name__] = seconds / args.events * 1e6
+        print(f"{name:>9}: legacy {results['legacy']:.1f}us/event, typed {results['typed']:.1f}us/event, "
+              f"saved {results['legacy'] - results['typed']:.1f}us ({results['legacy'] / results['typed']:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Measures how long the pubsub function takes to ack Slack under load.
+
+Sends open-loop form-encoded interactive payloads (the path that does not need a Slack
+signature) at fixed rates and reports the ack latency distribution per rate. Point it at
+a local functions-framework instance or a test deployment, ideally once with
+PUBLISH_MODE=sync and once with PUBLISH_MODE=async:
+
+    python benchmarks/publish_ack_load.py http://localhost:8080 --rates 50 200 1000 --duration 20
+"""
+import argparse
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, sleep
+
+import requests
+
+from _stats import percentile
+
+_local = threading.local()
+
+
+def _session() -> requests.Session:
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def send(url: str, i: int):
+    payload = {"type": "interactive_message", "callback_id": f"loadtest_{i}", "user": {"id": "U0LOADTEST"},
+               "actions": [{"value": "showmore"}], "original_message": {"app_id": "A0LOADTEST"}}
+    start = perf_counter()
+    try:
+        status = _session().post(url, data={"payload": json.dumps(payload)}, timeout=10).status_code
+    except requests.RequestException:
+        status = None
+    return perf_counter() - start, status
+
+
+def run_rate(url: str, rate: int, duration: float, workers: int):
+    futures = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        start = perf_counter()
+        for i in range(int(rate * duration)):
+            # open loop: requests are scheduled on time whether or not earlier ones finished
+            delay = start + i / rate - perf_counter()
+            if delay > 0:
+                sleep(delay)
+            futures.append(executor.submit(send, url, i))
+    results = [f.result() for f in futures]
+    latencies = [latency * 1000 for latency, status in results if status == 200]
+    errors = len(results) - len(latencies)
+    if not latencies:
+        print(f"{rate:>6} ev/s: all {errors} requests failed")
+        return
+    over_3s = sum(latency > 3000 for latency in latencies)
+    print(f"{rate:>6} ev/s: n={len(results)} errors={errors} p50={percentile(latencies, 50):.0f}ms "
+          f"p95={percentile(latencies, 95):.0f}ms p99={percentile(latencies, 99):.0f}ms max={max(latencies):.0f}ms "
+          f"over Slack's 3s window={over_3s}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("url")
+    parser.add_argument("--rates", type=int, nargs="+", default=[50, 200, 1000])
+    parser.add_argument("--duration", type=float, default=20, help="seconds per rate")
+    parser.add_argument("--workers", type=int, default=512)
+    args = parser.parse_args()
+    for rate in args.rates:
+        run_rate(args.url, rate, args.duration, args.workers)
+
+
+if __name__ == "__main__":
+    main()
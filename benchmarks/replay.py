@@ -0,0 +1,342 @@
+"""Replays Slack events through pubsub -> pubsub_workflow -> handle_message -> main_logic in one process.
+
+Every external service is replaced by a configurable-latency fake (see replay_fakes.py), Redis by
+fakeredis, so the numbers show the cost of our own code plus the modelled service latencies.
+Reports events/sec, end-to-end and per-stage latency percentiles (from the tracing spans), service
+calls per event and memory, and compares them against a stored baseline.
+
+The corpus is JSON lines of recorded requests to the pubsub function:
+
+    {"at": 0.0, "content_type": "application/json", "headers": {...}, "body": {<Slack event envelope>}}
+    {"at": 0.4, "content_type": "application/x-www-form-urlencoded", "body": {"payload": "<interactive payload>"}}
+
+api_app_id and token are rewritten to the fake secrets, signatures are not checked. Without a
+corpus a synthetic mix of questions, Show More clicks, feedback clicks and Slack retries is used:
+
+    python benchmarks/replay.py --synthetic 300 --concurrency 8 --time-scale 0.05
+    python benchmarks/replay.py corpus.jsonl --latency vertex_llm=900 --save-baseline benchmarks/replay_baseline.json
+    python benchmarks/replay.py corpus.jsonl --baseline benchmarks/replay_baseline.json --tolerance 0.1
+
+Latencies are scaled by --time-scale, so only compare runs made with the same scale and latencies.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, sleep, time
+from typing import Dict, List, Tuple
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+FUNCTIONS = (('pubsub', 'pubsub'), ('pubsub_workflow', 'pubsub_workflow'),
+             ('handle_message', 'handle_messages'), ('main', 'main_logic'))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+for _, directory in FUNCTIONS:
+    sys.path.append(os.path.join(ROOT, "cloud_functions", directory))
+import replay_fakes  # noqa: E402
+from _stats import percentile  # noqa: E402
+
+QUESTIONS = [
+    "How do I request access to the staging cluster?", "Where is the on-call runbook?",
+    "How do I rotate my API keys?", "What is the deployment freeze policy?",
+    "How do I set up the VPN on Linux?", "Who approves production database migrations?",
+    "How do I add a new service to the monitoring dashboard?", "What is the incident severity matrix?",
+    "How do I get a Confluence space created?", "Where are the onboarding docs for new engineers?",
+    "How do I restore a deleted Redis key?", "What is the expense policy for conferences?",
+    "How do I request a new laptop?", "How are feature flags cleaned up?",
+    "What is the code review SLA?", "How do I enable SSO for a vendor tool?",
+]
+
+
+def rss_mb() -> float:
+    """current resident set size, peak RSS where /proc is not available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def synthesize(n: int, users: int, seed: int, interval: float) -> List[Dict]:
+    """builds a corpus of questions from a small pool (so caches see repeats), clicks on earlier answers and Slack retries"""
+    rng = random.Random(seed)
+    user_ids = [f"U0USER{i:03d}" for i in range(users)]
+    corpus, asked = [], []
+    for i in range(n):
+        roll = rng.random()
+        if asked and roll < 0.12:
+            user_id, ts, _ = rng.choice(asked)
+            payload = {'type': 'interactive_message', 'callback_id': f"{user_id}_{ts}", 'user': {'id': user_id},
+                       'actions': [{'name': 'show_more', 'type': 'button', 'value': 'showmore'}], 'action_ts': f"{1700000000 + i}.5"}
+            entry = {'content_type': 'application/x-www-form-urlencoded', 'body': {'payload': json.dumps(payload)}}
+        elif asked and roll < 0.22:
+            user_id, ts, _ = rng.choice(asked)
+            payload = {'type': 'interactive_message', 'callback_id': f"feedback_{user_id}_{ts}", 'user': {'id': user_id},
+                       'actions': [{'name': 'thumbs_up', 'type': 'button', 'value': rng.choice(["👍", "👎"])}],
+                       'action_ts': f"{1700000000 + i}.5"}
+            entry = {'content_type': 'application/x-www-form-urlencoded', 'body': {'payload': json.dumps(payload)}}
+        elif asked and roll < 0.27:
+            entry = {**rng.choice(asked)[2], 'headers': {'X-Slack-Retry-Num': '1', 'X-Slack-Retry-Reason': 'http_timeout'}}
+        else:
+            user_id, ts = rng.choice(user_ids), f"{1700000000 + i}.{i:06d}"
+            event = {'type': 'message', 'channel_type': 'im', 'user': user_id, 'text': rng.choice(QUESTIONS),
+                     'ts': ts, 'channel': f"D{user_id}"}
+            entry = {'content_type': 'application/json', 'headers': {},
+                     'body': {'type': 'event_callback', 'event_id': f"Ev{i:08d}", 'event': event}}
+            asked.append((user_id, ts, entry))
+        corpus.append({**entry, 'at': i * interval})
+    return corpus
+
+
+class _Request:
+    """The part of the request object the functions read"""
+
+    def __init__(self, data: bytes = b'', json_body: Dict = None):
+        self.data = data
+        self.mimetype = 'application/json'
+        self._json = json_body
+
+    def get_json(self) -> Dict:
+        return self._json
+
+
+class _Response:
+    def __init__(self, text: str, status_code: int):
+        self.text = text
+        self.status_code = status_code
+
+    def raise_for_status(self) -> None:
+        import requests
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} from main_logic")
+
+
+class _InProcessSearchClient:
+    """stands in for handle_message's SearchClient, calling main_logic in this process"""
+
+    def __init__(self, cloud: replay_fakes.FakeCloud, handler, record_span):
+        self.cloud = cloud
+        self.handler = handler
+        self.record_span = record_span
+
+    def post(self, json_body: Dict, headers: Dict, stream: bool = False) -> _Response:
+        self.cloud.wait('network')
+        start, started = time(), perf_counter()
+        result = self.handler(_Request(json.dumps(json_body).encode('utf-8')))
+        self.record_span('fn_main_logic', start, perf_counter() - started)
+        self.cloud.wait('network')
+        return _Response(json.dumps(result[0]), result[1])
+
+    def reuse_stats(self) -> Dict:
+        return {}
+
+
+class Harness:
+    """imports the four functions against the fakes and wires them together"""
+
+    def __init__(self, args: argparse.Namespace):
+        latencies = dict(item.split('=') for item in args.latency)
+        self.cloud = replay_fakes.install({k: float(v) for k, v in latencies.items()}, args.time_scale,
+                                          args.jitter, args.seed)
+        self.trace_path = tempfile.NamedTemporaryFile(prefix='replay_spans_', suffix='.jsonl', delete=False).name
+        for name, value in (('project_id', 'replay-project'), ('GCP_PROJECT', 'replay-project'),
+                            ('DISPATCH_MODE', args.dispatch_mode), ('STREAM_ANSWERS', 'false'), ('ASYNC_HANDLER', 'false')):
+            os.environ.setdefault(name, value)
+        os.environ['TRACE_EXPORT_PATH'] = self.trace_path
+
+        import flask
+        self.flask = flask
+        self.app = flask.Flask('replay')
+        self.import_mb = {}
+        self.modules = {}
+        for module_name, _ in FUNCTIONS:
+            before = rss_mb()
+            self.modules[module_name] = __import__(module_name)
+            self.import_mb[module_name] = round(rss_mb() - before, 1)
+
+        import tracing
+        self.tracing = tracing
+        handle_message = self.modules['handle_message']
+        handle_message.search_client = _InProcessSearchClient(self.cloud, self.modules['main'].main, tracing.record_span)
+        original_handle_message = handle_message.handle_message
+        self.handled: Dict[str, float] = {}
+
+        def timed_handle_message(request):
+            # a fresh trace, so an event dropped before handle_message sets its own is not attributed to a stale one
+            tracing.set_trace()
+            start, started = time(), perf_counter()
+            try:
+                return original_handle_message(request)
+            finally:
+                tracing.record_span('fn_handle_message', start, perf_counter() - started)
+                self.handled[tracing.current_trace_id()] = time()
+        handle_message.handle_message = timed_handle_message
+
+        def push(envelope: Dict):
+            tracing.set_trace()
+            start, started = time(), perf_counter()
+            try:
+                return self.modules['pubsub_workflow'].pub_sub_acknowledge_and_trigger_workflow(_Request(json_body=envelope))
+            finally:
+                tracing.record_span('fn_pubsub_workflow', start, perf_counter() - started)
+        self.cloud.push_endpoint = push
+        self.cloud.workflow_target = lambda body: handle_message.handle_message(_Request(body))
+
+    def publish(self, entry: Dict) -> Tuple[float, str, int]:
+        """sends one corpus entry to the pubsub function"""
+        body = entry['body']
+        if entry['content_type'] == 'application/json':
+            body = {**body, 'api_app_id': replay_fakes.SECRETS['SLACK_APP_ID'], 'token': replay_fakes.SECRETS['VERIFICATION_TOKEN_SLACK']}
+            data = json.dumps(body)
+        else:
+            data = body
+        with self.app.test_request_context('/', method='POST', data=data, headers=entry.get('headers') or {},
+                                           content_type=entry['content_type']):
+            start, started = time(), perf_counter()
+            response = self.modules['pubsub'].publish(self.flask.request)
+            trace_id = self.tracing.current_trace_id()
+            self.tracing.record_span('fn_pubsub', start, perf_counter() - started)
+        status = response[1] if isinstance(response, tuple) else 200
+        return start, trace_id, status
+
+    def replay(self, corpus: List[Dict], concurrency: int, pace: bool) -> Dict:
+        """replays the corpus and collects the report"""
+        published: Dict[str, float] = {}
+        statuses = Counter()
+        calls_before = dict(self.cloud.calls)
+        begin = perf_counter()
+
+        def send(entry: Dict):
+            if pace:
+                sleep(max(0.0, entry['at'] - (perf_counter() - begin)))
+            start, trace_id, status = self.publish(entry)
+            published[trace_id] = start
+            statuses[status] += 1
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(send, corpus))
+        self.cloud.wait_idle()
+        wall = perf_counter() - begin
+
+        with open(self.trace_path) as f:
+            spans = [json.loads(line) for line in f if line.strip()]
+        end_to_end = [(self.handled[t] - s) * 1000 for t, s in published.items() if t in self.handled]
+        calls = {k: v - calls_before.get(k, 0) for k, v in self.cloud.calls.items()}
+        return {
+            'events': len(corpus),
+            'wall_s': round(wall, 3),
+            'events_per_sec': round(len(corpus) / wall, 2),
+            'pubsub_responses': {str(k): v for k, v in statuses.items()},
+            'end_to_end_ms': {'count': len(end_to_end), **({f"p{p}": round(percentile(end_to_end, p), 1) for p in (50, 95, 99)}
+                                                        if end_to_end else {})},
+            'stages': {name: {k: round(v, 1) for k, v in stats.items()} for name, stats in self.tracing.summarize(spans).items()},
+            'service_calls_per_event': {k: round(v / len(corpus), 3) for k, v in sorted(calls.items())},
+            'slack_messages': self.cloud.slack_messages,
+            'nacks': self.cloud.nacks,
+            'memory_mb': {'import': self.import_mb, 'rss': round(rss_mb(), 1),
+                          'peak_rss': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)},
+        }
+
+
+def print_report(report: Dict) -> None:
+    print(f"{report['events']} events in {report['wall_s']}s: {report['events_per_sec']} events/sec, "
+          f"pubsub responses {report['pubsub_responses']}, {report['slack_messages']} Slack messages, {report['nacks']} nacks")
+    e2e = report['end_to_end_ms']
+    if e2e['count']:
+        print(f"end to end ({e2e['count']} events reaching handle_message): "
+              f"p50 {e2e['p50']:.0f}ms p95 {e2e['p95']:.0f}ms p99 {e2e['p99']:.0f}ms")
+    print(f"{'stage':<24}{'count':>8}{'p50 ms':>12}{'p95 ms':>12}{'p99 ms':>12}")
+    for name, stats in sorted(report['stages'].items(), key=lambda item: -item[1]['p50']):
+        print(f"{name:<24}{stats['count']:>8}{stats['p50']:>12.1f}{stats['p95']:>12.1f}{stats['p99']:>12.1f}")
+    print("service calls per event: " + ", ".join(f"{k} {v}" for k, v in report['service_calls_per_event'].items()))
+    memory = report['memory_mb']
+    print("memory: import " + ", ".join(f"{k} +{v}MB" for k, v in memory['import'].items())
+          + f" | rss {memory['rss']}MB, peak {memory['peak_rss']}MB (all four functions in one process)")
+
+
+def _metrics(report: Dict) -> Dict[str, Tuple[float, bool]]:
+    """metric -> (value, higher is better)"""
+    metrics = {'events_per_sec': (report['events_per_sec'], True), 'memory_mb.peak_rss': (report['memory_mb']['peak_rss'], False)}
+    for p in ('p50', 'p95'):
+        if p in report['end_to_end_ms']:
+            metrics[f"end_to_end_ms.{p}"] = (report['end_to_end_ms'][p], False)
+    for name, stats in report['stages'].items():
+        # sub-millisecond stages are all noise in relative terms
+        if stats['p95'] >= 1:
+            metrics[f"stages.{name}.p95"] = (stats['p95'], False)
+    return metrics
+
+
+def compare(report: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """prints the change of every metric present in both reports, returns the regressed ones"""
+    current, previous = _metrics(report), _metrics(baseline)
+    if baseline.get('config') != report.get('config'):
+        print(f"warning: baseline config {baseline.get('config')} differs from {report.get('config')}")
+    regressions = []
+    print(f"{'metric':<36}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name in sorted(current.keys() & previous.keys()):
+        value, higher_is_better = current[name]
+        base = previous[name][0]
+        change = (value - base) / base if base else 0.0
+        worse = -change if higher_is_better else change
+        flag = ""
+        if worse > tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<36}{base:>12.1f}{value:>12.1f}{change:>+10.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("corpus", nargs="?", help="JSON lines of recorded requests, synthetic events when omitted")
+    parser.add_argument("--synthetic", type=int, default=200, help="number of synthetic events")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight to the pubsub function")
+    parser.add_argument("--pace", action="store_true", help="send events at their recorded offsets instead of back to back")
+    parser.add_argument("--dispatch-mode", default="workflow", choices=["workflow", "inprocess"])
+    parser.add_argument("--latency", action="append", default=[], metavar="SERVICE=MS",
+                        help=f"override a service latency, services: {', '.join(replay_fakes.DEFAULT_LATENCIES)}")
+    parser.add_argument("--time-scale", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.25)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", help="baseline report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative change counted as a regression")
+    parser.add_argument("--save-baseline", help="write the report here")
+    parser.add_argument("--verbose", action="store_true", help="keep the functions' stdout")
+    args = parser.parse_args()
+
+    if args.corpus:
+        with open(args.corpus) as f:
+            corpus = [json.loads(line) for line in f if line.strip()]
+    else:
+        corpus = synthesize(args.synthetic, args.users, args.seed, interval=0.05)
+
+    with contextlib.redirect_stdout(sys.stdout if args.verbose else io.StringIO()):
+        harness = Harness(args)
+        report = harness.replay(corpus, args.concurrency, args.pace)
+    report['config'] = {'corpus': args.corpus or f"synthetic:{args.synthetic}:{args.users}:{args.seed}",
+                        'concurrency': args.concurrency, 'pace': args.pace, 'dispatch_mode': args.dispatch_mode,
+                        'time_scale': args.time_scale, 'latencies': harness.cloud.latencies}
+    print_report(report)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} metrics regressed by more than {args.tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
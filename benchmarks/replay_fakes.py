@@ -0,0 +1,497 @@
+"""Configurable-latency stand-ins for the services the four functions call, used by replay.py.
+
+install() registers fake client modules (Secret Manager, Cloud Logging, Pub/Sub, Firestore,
+Workflows, Vertex AI, Cohere, Slack, Google ID tokens) in sys.modules before the functions are
+imported, points redis at a shared fakeredis server and replaces the langchain wrappers of
+Matching Engine, Cohere rerank and the Vertex LLM and embeddings. Frameworks (flask, requests,
+aiohttp, langchain itself) are the real ones; langchain is only faked when it is not installed.
+
+Every fake call sleeps a lognormally jittered latency and is counted per service.
+"""
+import base64
+import hashlib
+import importlib
+import json
+import logging
+import random
+import sys
+import threading
+import types
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import sleep, time
+from typing import Callable, Dict, List, Optional
+
+import fakeredis
+import numpy as np
+import redis
+import redis.asyncio
+
+# milliseconds per call before scaling, rough production medians
+DEFAULT_LATENCIES = {
+    'secret_manager': 40, 'id_token': 30, 'slack': 120, 'pubsub_publish': 25, 'pubsub_delivery': 60,
+    'workflows_create': 80, 'workflows_start': 250, 'network': 15, 'firestore': 40,
+    'vertex_embedding': 60, 'vertex_llm': 1800, 'matching_engine': 80, 'cohere': 250,
+}
+EMBEDDING_DIM = 768
+SECRETS = {'SLACK_APP_ID': 'A0REPLAY', 'VERIFICATION_TOKEN_SLACK': 'replay-token', 'REDIS_HOST': 'localhost',
+           'REDIS_PORT': '6379', 'search_func_url': 'https://main-logic.replay.invalid'}
+BOT_USER_ID = 'U0REPLAYBOT'
+
+
+class FakeCloud:
+    """Latency model, call counters and the push targets wired up by the replay harness"""
+
+    def __init__(self, latencies: Dict[str, float], time_scale: float = 1.0, jitter: float = 0.25,
+                 seed: int = 0, workers: int = 64):
+        self.latencies = latencies
+        self.time_scale = time_scale
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.calls: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.redis_server = fakeredis.FakeServer()
+        self.firestore: Dict[str, Dict[str, Dict]] = {}
+        self.slack_messages = 0
+        self.nacks = 0
+        # set by the harness: pub/sub push endpoint and the workflow step calling handle_message
+        self.push_endpoint: Optional[Callable[[Dict], object]] = None
+        self.workflow_target: Optional[Callable[[bytes], object]] = None
+        self._inflight = 0
+        self._idle = threading.Condition()
+
+    def wait(self, service: str) -> None:
+        """sleeps the latency of one call to service"""
+        with self.lock:
+            self.calls[service] = self.calls.get(service, 0) + 1
+            factor = self.random.lognormvariate(0, self.jitter) if self.jitter else 1.0
+        sleep(self.latencies.get(service, 0) * self.time_scale * factor / 1000)
+
+    def submit(self, fn: Callable, *args) -> Future:
+        """runs fn in the background, tracked by wait_idle"""
+        with self._idle:
+            self._inflight += 1
+
+        def run():
+            try:
+                return fn(*args)
+            finally:
+                with self._idle:
+                    self._inflight -= 1
+                    self._idle.notify_all()
+        return self.executor.submit(run)
+
+    def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        """blocks until every delivery and workflow execution finished"""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._inflight == 0, timeout)
+
+
+cloud: Optional[FakeCloud] = None
+
+
+def _module(name: str, **attributes) -> types.ModuleType:
+    """registers an empty fake module (and missing parents) under name"""
+    parent_name, _, child = name.rpartition('.')
+    module = types.ModuleType(name)
+    module.__path__ = []
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    if parent_name:
+        setattr(_namespace(parent_name), child, module)
+    return module
+
+
+def _namespace(name: str) -> types.ModuleType:
+    """returns the parent package, the installed one when there is one"""
+    if name in sys.modules:
+        return sys.modules[name]
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return _module(name)
+
+
+def _installed(name: str) -> Optional[types.ModuleType]:
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+
+# --- Google Cloud ---------------------------------------------------------------------------
+
+class _SecretManagerServiceClient:
+    def access_secret_version(self, request: Dict):
+        cloud.wait('secret_manager')
+        secret_id = request['name'].split('/')[3]
+        value = SECRETS.get(secret_id, f"replay-{secret_id}")
+        return types.SimpleNamespace(payload=types.SimpleNamespace(data=value.encode('utf-8')))
+
+
+class _CloudLoggingHandler(logging.Handler):
+    """formats records like the real handler but ships them nowhere"""
+
+    def __init__(self, client=None, **kwargs):
+        super().__init__()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.format(record)
+
+
+class _Settings:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class _PublisherClient:
+    def __init__(self, batch_settings=None, publisher_options=None):
+        self._ids = iter(range(1, 1 << 62))
+
+    def topic_path(self, project: str, topic: str) -> str:
+        return f"projects/{project}/topics/{topic}"
+
+    def publish(self, topic: str, data: bytes, **attributes) -> Future:
+        future, message_id = Future(), str(next(self._ids))
+
+        def deliver():
+            cloud.wait('pubsub_publish')
+            future.set_result(message_id)
+            cloud.wait('pubsub_delivery')
+            envelope = {'message': {'data': base64.b64encode(data).decode(), 'attributes': attributes, 'messageId': message_id}}
+            response = cloud.push_endpoint(envelope)
+            if isinstance(response, tuple) and response[1] >= 300:
+                cloud.nacks += 1
+        cloud.submit(deliver)
+        return future
+
+
+class _Document:
+    def __init__(self, collection: Dict, doc_id: str):
+        self._collection = collection
+        self.id = doc_id
+
+    def set(self, fields: Dict, merge: bool = False) -> None:
+        cloud.wait('firestore')
+        self._write(fields, merge)
+
+    def update(self, fields: Dict) -> None:
+        cloud.wait('firestore')
+        if self.id not in self._collection:
+            raise KeyError(f"No document to update: {self.id}")
+        self._write(fields, True)
+
+    def _write(self, fields: Dict, merge: bool) -> None:
+        with cloud.lock:
+            self._collection[self.id] = {**self._collection.get(self.id, {}), **fields} if merge else dict(fields)
+
+
+class _Collection:
+    def __init__(self, name: str):
+        with cloud.lock:
+            self._documents = cloud.firestore.setdefault(name, {})
+
+    def document(self, doc_id: str) -> _Document:
+        return _Document(self._documents, doc_id)
+
+
+class _WriteBatch:
+    def __init__(self):
+        self._writes = []
+
+    def set(self, document: _Document, fields: Dict, merge: bool = False) -> None:
+        self._writes.append((document, fields, merge))
+
+    def commit(self) -> None:
+        cloud.wait('firestore')
+        for document, fields, merge in self._writes:
+            document._write(fields, merge)
+
+
+class _FirestoreClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def collection(self, name: str) -> _Collection:
+        return _Collection(name)
+
+    def batch(self) -> _WriteBatch:
+        return _WriteBatch()
+
+
+class _WorkflowsClient:
+    def workflow_path(self, project: str, location: str, workflow: str) -> str:
+        return f"projects/{project}/locations/{location}/workflows/{workflow}"
+
+
+class _ExecutionsClient:
+    def create_execution(self, request: Dict):
+        cloud.wait('workflows_create')
+        argument = request['execution']['argument']
+
+        def run():
+            cloud.wait('workflows_start')
+            cloud.workflow_target(argument.encode('utf-8'))
+        cloud.submit(run)
+        return types.SimpleNamespace(name=f"{request['parent']}/executions/{time()}")
+
+
+def _fetch_id_token(request, audience: str) -> str:
+    cloud.wait('id_token')
+    claims = base64.urlsafe_b64encode(json.dumps({'aud': audience, 'exp': time() + 3600}).encode()).decode().rstrip('=')
+    return f"replay.{claims}.signature"
+
+
+# --- Slack ----------------------------------------------------------------------------------
+
+class _WebClient:
+    def __init__(self, token: Optional[str] = None, **kwargs):
+        self.token = token
+
+    def _post(self, channel: str) -> Dict:
+        cloud.wait('slack')
+        with cloud.lock:
+            cloud.slack_messages += 1
+        return {'ok': True, 'channel': channel, 'ts': f"{time():.6f}"}
+
+    def chat_postMessage(self, channel: str, **kwargs) -> Dict:
+        return self._post(channel)
+
+    def chat_update(self, channel: str, ts: str, **kwargs) -> Dict:
+        return self._post(channel)
+
+    def api_call(self, method: str, **kwargs) -> Dict:
+        cloud.wait('slack')
+        return {'ok': True, 'user_id': BOT_USER_ID}
+
+
+class _SlackApiError(Exception):
+    def __init__(self, message: str, response):
+        super().__init__(message)
+        self.response = response
+
+
+class _AsyncWebClient(_WebClient):
+    async def chat_postMessage(self, channel: str, **kwargs) -> Dict:
+        return self._post(channel)
+
+    async def chat_update(self, channel: str, ts: str, **kwargs) -> Dict:
+        return self._post(channel)
+
+
+class _SignatureVerifier:
+    def __init__(self, signing_secret: str):
+        pass
+
+    def is_valid_request(self, body, headers) -> bool:
+        return True
+
+
+class _CohereClient:
+    # a class, langchain's pydantic CohereRerank uses cohere.Client as a field type
+    def __init__(self, api_key: str, **kwargs):
+        self.api_key = api_key
+
+
+# --- Vertex AI, Matching Engine and Cohere through langchain --------------------------------
+
+def _vector(text: str) -> List[float]:
+    seed = int.from_bytes(hashlib.sha1(text.encode('utf-8')).digest()[:4], 'little')
+    return np.random.default_rng(seed).standard_normal(EMBEDDING_DIM).astype(np.float32).tolist()
+
+
+def _seeded(text: str) -> random.Random:
+    return random.Random(hashlib.sha1(text.encode('utf-8')).digest())
+
+
+def _install_langchain(corpus_size: int) -> None:
+    real = _installed('langchain.schema') is not None
+    if real:
+        from langchain.callbacks.base import BaseCallbackHandler
+        from langchain.embeddings.base import Embeddings
+        from langchain.schema import Document
+    else:
+        class Document:
+            def __init__(self, page_content: str, metadata: Optional[Dict] = None):
+                self.page_content = page_content
+                self.metadata = metadata or {}
+
+        class Embeddings:
+            pass
+
+        class BaseCallbackHandler:
+            pass
+
+    class VertexAIEmbeddings(Embeddings):
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def embed_query(self, text: str) -> List[float]:
+            cloud.wait('vertex_embedding')
+            return _vector(text)
+
+        def embed_documents(self, texts: List[str]) -> List[List[float]]:
+            cloud.wait('vertex_embedding')
+            return [_vector(text) for text in texts]
+
+    class VertexAI:
+        def __init__(self, *args, streaming: bool = False, **kwargs):
+            self.streaming = streaming
+
+    class HypotheticalDocumentEmbedder(Embeddings):
+        def __init__(self, base_embeddings: Embeddings):
+            self.base_embeddings = base_embeddings
+
+        @classmethod
+        def from_llm(cls, llm, base_embeddings: Embeddings, prompt_key: str):
+            return cls(base_embeddings)
+
+        def embed_query(self, text: str) -> List[float]:
+            cloud.wait('vertex_llm')
+            return self.base_embeddings.embed_documents([f"hypothetical answer to {text}"])[0]
+
+        def embed_documents(self, texts: List[str]) -> List[List[float]]:
+            return self.base_embeddings.embed_documents(texts)
+
+    class MatchingEngine:
+        """returns k of corpus_size synthetic pages of the namespace, ranked per query"""
+
+        def __init__(self, embedding: Embeddings):
+            self.embedding = embedding
+
+        @classmethod
+        def from_components(cls, embedding: Embeddings, **kwargs):
+            return cls(embedding)
+
+        def similarity_search_with_score(self, query: str, k: int = 4, filter=None):
+            self.embedding.embed_query(query)
+            cloud.wait('matching_engine')
+            namespace = filter[0].allow_tokens[0] if filter else 'default'
+            ranked = _seeded(f"{namespace}:{query}").sample(range(corpus_size), min(k, corpus_size))
+            return [(Document(page_content=f"Page {i} of {namespace}. " + "Deployment and onboarding notes. " * 30,
+                              metadata={'id': f"{namespace}-{i}", 'title': f"Confluence page {i}",
+                                        'url': f"https://example.atlassian.net/wiki/pages/{namespace}/{i}"}),
+                     0.9 - rank * 0.002) for rank, i in enumerate(ranked)]
+
+        def similarity_search(self, query: str, k: int = 4, filter=None):
+            return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+    class CohereRerank:
+        def __init__(self, top_n: int = 3, **kwargs):
+            self.top_n = top_n
+
+        def compress_documents(self, documents, query: str):
+            cloud.wait('cohere')
+            ranked = sorted(documents, key=lambda doc: _seeded(f"{query}:{doc.metadata['id']}").random(), reverse=True)
+            return [Document(page_content=doc.page_content, metadata={**doc.metadata, 'relevance_score': 0.95 - i * 0.05})
+                    for i, doc in enumerate(ranked[:self.top_n])]
+
+    class QAChain:
+        def __init__(self, llm: VertexAI):
+            self.llm = llm
+
+        def __call__(self, inputs: Dict, return_only_outputs: bool = False, callbacks=None) -> Dict:
+            answer = f"Based on {len(inputs['input_documents'])} pages: " + "follow the runbook step by step. " * 8
+            if callbacks:
+                tokens = answer.split(' ')
+                for token in tokens:
+                    cloud.wait('vertex_llm_token')
+                    for callback in callbacks:
+                        callback.on_llm_new_token(token + ' ')
+            else:
+                cloud.wait('vertex_llm')
+            return {'output_text': answer}
+
+    def load_qa_chain(llm: VertexAI, chain_type: str = 'stuff', **kwargs) -> QAChain:
+        return QAChain(llm)
+
+    fakes = {
+        'langchain.schema': {'Document': Document},
+        'langchain.embeddings.base': {'Embeddings': Embeddings},
+        'langchain.callbacks.base': {'BaseCallbackHandler': BaseCallbackHandler},
+        'langchain.embeddings': {'VertexAIEmbeddings': VertexAIEmbeddings},
+        'langchain.llms': {'VertexAI': VertexAI},
+        'langchain.chains': {'HypotheticalDocumentEmbedder': HypotheticalDocumentEmbedder,
+                             'LLMChain': object, 'RetrievalQA': object},
+        'langchain.chains.question_answering': {'load_qa_chain': load_qa_chain},
+        'langchain.vectorstores.matching_engine': {'MatchingEngine': MatchingEngine},
+        'langchain.retrievers.document_compressors': {'CohereRerank': CohereRerank},
+        'langchain.prompts': {'PromptTemplate': object},
+    }
+    # with the real langchain installed only the service wrappers change, its base classes stay
+    for name, attributes in fakes.items():
+        module = _namespace(name)
+        for attribute, value in attributes.items():
+            setattr(module, attribute, value)
+
+
+# --- Redis ----------------------------------------------------------------------------------
+
+class _ReplayRedis(fakeredis.FakeRedis):
+    def __init__(self, *args, host=None, port=None, password=None, **kwargs):
+        super().__init__(server=cloud.redis_server)
+
+
+class _ReplayAsyncRedis(fakeredis.FakeAsyncRedis):
+    def __init__(self, *args, host=None, port=None, password=None, **kwargs):
+        super().__init__(server=cloud.redis_server)
+
+
+def install(latencies: Optional[Dict[str, float]] = None, time_scale: float = 1.0, jitter: float = 0.25,
+            seed: int = 0, corpus_size: int = 200) -> FakeCloud:
+    """registers the fakes, has to run before the functions are imported
+
+    Args:
+        latencies (Optional[Dict[str, float]]): per-service latency overrides in milliseconds
+        time_scale (float): multiplier applied to every latency
+        jitter (float): sigma of the lognormal latency jitter, 0 for fixed latencies
+        seed (int): seed of the jitter
+        corpus_size (int): synthetic pages per Matching Engine namespace
+
+    Returns:
+        FakeCloud: the latency model and counters
+    """
+    global cloud
+    cloud = FakeCloud({**DEFAULT_LATENCIES, 'vertex_llm_token': DEFAULT_LATENCIES['vertex_llm'] / 60, **(latencies or {})},
+                      time_scale, jitter, seed)
+
+    _module('google.cloud.secretmanager', SecretManagerServiceClient=_SecretManagerServiceClient)
+    _module('google.cloud.logging', Client=lambda *args, **kwargs: None)
+    _module('google.cloud.logging_v2')
+    _module('google.cloud.logging_v2.handlers', CloudLoggingHandler=_CloudLoggingHandler)
+    _module('google.cloud.pubsub_v1', PublisherClient=_PublisherClient, types=types.SimpleNamespace(
+        BatchSettings=_Settings, PublisherOptions=_Settings, PublishFlowControl=_Settings,
+        LimitExceededBehavior=types.SimpleNamespace(BLOCK='block')))
+    _module('google.cloud.firestore', Client=_FirestoreClient)
+    _module('google.cloud.workflows_v1', WorkflowsClient=_WorkflowsClient)
+    _module('google.cloud.workflows')
+    _module('google.cloud.workflows.executions_v1', ExecutionsClient=_ExecutionsClient, Execution=dict)
+    _module('google.cloud.workflows.executions_v1.types')
+    _module('google.cloud.workflows.executions_v1.types.executions')
+    _module('google.cloud.aiplatform', init=lambda **kwargs: None)
+    _module('google.cloud.aiplatform.matching_engine')
+    _module('google.cloud.aiplatform.matching_engine.matching_engine_index_endpoint',
+            Namespace=lambda name, allow_tokens, deny_tokens: types.SimpleNamespace(
+                name=name, allow_tokens=allow_tokens, deny_tokens=deny_tokens))
+    _module('google.auth')
+    _module('google.auth.transport')
+    _module('google.auth.transport.requests', Request=lambda *args, **kwargs: None)
+    _module('google.oauth2')
+    _module('google.oauth2.id_token', fetch_id_token=_fetch_id_token)
+    if _installed('grpc') is None:
+        _module('grpc._channel', _InactiveRpcError=type('_InactiveRpcError', (Exception,), {}))
+    _module('vertexai')
+    _module('vertexai.preview')
+    _module('vertexai.preview.language_models',
+            TextEmbeddingModel=types.SimpleNamespace(from_pretrained=lambda name: types.SimpleNamespace(name=name)))
+    _module('cohere', Client=_CohereClient)
+    _module('slack_sdk', WebClient=_WebClient)
+    _module('slack_sdk.signature', SignatureVerifier=_SignatureVerifier)
+    _module('slack_sdk.errors', SlackApiError=_SlackApiError)
+    _module('slack_sdk.web')
+    _module('slack_sdk.web.async_client', AsyncWebClient=_AsyncWebClient)
+    _install_langchain(corpus_size)
+
+    redis.Redis = _ReplayRedis
+    redis.asyncio.Redis = _ReplayAsyncRedis
+    return cloud
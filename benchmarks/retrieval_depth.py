@@ -0,0 +1,71 @@
+"""Compares adaptive retrieval depth against the fixed k=100 baseline.
+
+Runs every query through main_logic.retrieve_documents twice, once fixed and once adaptive,
+against the deployed Matching Engine and Cohere (same environment as the main_logic
+function), and reports latency, documents and estimated tokens sent to rerank, and recall@3.
+Set RERANK_CACHE_ENABLED=false to measure uncached Cohere calls, since the second pass
+over a query otherwise hits rankings cached by the first.
+
+Queries are JSON lines: {"query": ..., "user_id": ..., "relevant_urls": [...]} where
+relevant_urls is optional. Without labels, recall@3 is measured against the top 3 of the
+fixed baseline.
+
+    project_id=... RETRIEVAL_K_STEPS=20,50,100 python benchmarks/retrieval_depth.py queries.jsonl
+"""
+import json
+import os
+import statistics
+import sys
+from time import perf_counter
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(os.path.join(os.path.dirname(__file__), "../cloud_functions/main_logic"))
+import main  # noqa: E402
+import rerank_cache  # noqa: E402
+from _stats import percentile  # noqa: E402
+
+# Cohere bills one search unit per query and up to 100 documents of at most 500 tokens each
+RERANK_CHUNK_TOKENS = 500
+RERANK_DOCS_PER_UNIT = 100
+
+
+def run(query: str, user_id: str, adaptive: bool):
+    start = perf_counter()
+    docs, stats = main.retrieve_documents(query, user_id, adaptive)
+    elapsed = perf_counter() - start
+    tokens = stats['reranked_characters'] / 4
+    chunks = stats['reranked_documents'] + tokens // RERANK_CHUNK_TOKENS
+    # every Cohere call is at least one unit, cached and skipped rounds are free
+    units = max(stats['rerank_calls'], -(-chunks // RERANK_DOCS_PER_UNIT)) if stats['rerank_calls'] else 0
+    return elapsed, [doc.metadata.get('url') for doc in docs[:3]], tokens, units, stats['k']
+
+
+def main_benchmark(path: str):
+    with open(path) as f:
+        queries = [json.loads(line) for line in f if line.strip()]
+
+    report = {mode: {'latency': [], 'tokens': [], 'units': [], 'recall': [], 'k': []} for mode in ('fixed', 'adaptive')}
+    for item in queries:
+        fixed = run(item['query'], item['user_id'], adaptive=False)
+        adaptive = run(item['query'], item['user_id'], adaptive=True)
+        relevant = set(item.get('relevant_urls') or fixed[1])
+        for mode, (elapsed, top3, tokens, units, k) in (('fixed', fixed), ('adaptive', adaptive)):
+            report[mode]['latency'].append(elapsed)
+            report[mode]['tokens'].append(tokens)
+            report[mode]['units'].append(units)
+            report[mode]['recall'].append(len(relevant & set(top3)) / max(1, min(3, len(relevant))))
+            report[mode]['k'].append(k)
+
+    print(f"{len(queries)} queries, k steps {main.retrieval_k_steps}, rerank_min_score {main.rerank_min_score}")
+    for mode, values in report.items():
+        print(f"{mode:>9}: latency p50 {percentile(values['latency'], 50):.3f}s p95 {percentile(values['latency'], 95):.3f}s | "
+              f"rerank tokens/query {statistics.mean(values['tokens']):.0f} | search units/query {statistics.mean(values['units']):.2f} | "
+              f"mean k {statistics.mean(values['k']):.0f} | recall@3 {statistics.mean(values['recall']):.3f}")
+    report_stats = rerank_cache.report()
+    print(f"rerank: {report_stats['cohere_calls_per_1k']:.0f} Cohere calls per 1k rerank requests, "
+          f"mean rerank latency {report_stats['mean_rerank_ms']:.0f}ms, cache hits {report_stats['cache_hits']}, "
+          f"skipped {report_stats['skipped']}, coalesced {report_stats['coalesced']}")
+
+
+if __name__ == "__main__":
+    main_benchmark(sys.argv[1])
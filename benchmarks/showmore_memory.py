@@ -0,0 +1,55 @@
+"""Reports Redis memory used by the Show More cache per 10k stored queries.
+
+Renders synthetic search outputs into Show More pages, writes them through showmore_store
+and reads MEMORY USAGE for every key. Run against a scratch Redis instance, the keys are deleted afterwards:
+
+    REDIS_URL=redis://localhost:6379/15 python benchmarks/showmore_memory.py --results 50 --page-size 10
+"""
+import argparse
+import os
+import sys
+
+import redis
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../cloud_functions/handle_messages"))
+from message_composer import compose_showmore_pages  # noqa: E402
+from showmore_store import save_showmore_pages, showmore_key  # noqa: E402
+
+
+def synthetic_search_output(n_results: int, query_index: int):
+    return [(f"Confluence page {query_index}-{i}: onboarding and deployment guide",
+             f"https://example.atlassian.net/wiki/spaces/ENG/pages/{query_index * 1000 + i}")
+            for i in range(n_results)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queries", type=int, default=10000)
+    parser.add_argument("--results", type=int, default=50, help="deduplicated results stored per query")
+    parser.add_argument("--page-size", type=int, default=10)
+    parser.add_argument("--ttl", type=int, default=7 * 24 * 3600)
+    args = parser.parse_args()
+
+    r = redis.Redis.from_url(os.environ.get("REDIS_URL", "redis://localhost:6379/15"))
+    callback_ids = [f"U0BENCH_{i}.000100" for i in range(args.queries)]
+    try:
+        for i, callback_id in enumerate(callback_ids):
+            pages = compose_showmore_pages(synthetic_search_output(args.results, i), "U0BENCH", f"{i}.000100", args.page_size)
+            save_showmore_pages(r, callback_id, pages, args.ttl)
+
+        pipe = r.pipeline(transaction=False)
+        for callback_id in callback_ids:
+            pipe.memory_usage(showmore_key(callback_id))
+        usage = [u or 0 for u in pipe.execute()]
+        total = sum(usage)
+        print(f"keys: {len(usage)}, results per key: {args.results}, page size: {args.page_size}")
+        print(f"total: {total / 1024 ** 2:.2f} MiB, per key: {total / len(usage):.0f} B, "
+              f"per 10k queries: {total / len(usage) * 10000 / 1024 ** 2:.2f} MiB")
+        print(f"ttl on sample key: {r.ttl(showmore_key(callback_ids[0]))} s")
+    finally:
+        for start in range(0, len(callback_ids), 1000):
+            r.delete(*[showmore_key(c) for c in callback_ids[start:start + 1000]])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+from time import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from events import MessageEvent
+from message_composer import (MAX_TEXT_LENGTH, SHOWMORE_PAGE_SIZE, compose_answer, compose_messages, compose_results,
+                              compose_showmore_pages, format_chat_response)
+from tracing import current_trace_id
+
+ERROR_TEXT = "*Sorry, we encountered an error. Your query has been logged for analysis.*"
+THINKING_TEXT = "_Thinking..._"
+
+
+class ErrorReported(Exception):
+    """The search failed after ERROR_TEXT was shown in the placeholder, the caller has nothing left to post"""
+
+
+def search_body(event: MessageEvent) -> Dict:
+    """body of the search request for a question"""
+    return {'query': event.text, 'user_id': event.namespace, 'trace_id': current_trace_id()}
+
+
+def latency_ms(ts: str) -> float:
+    """latency from the question (Slack ts) to now"""
+    return (time() - float(ts)) * 1000
+
+
+class PreparedAnswer(NamedTuple):
+    messages: List[Dict]
+    pages: List[Dict]
+    urls: List[str]
+
+
+def prepare_answer(response_list: Dict, user_id: str, ts: str, page_size: int = SHOWMORE_PAGE_SIZE) -> PreparedAnswer:
+    """the answer messages, the Show More pages and the result urls of a search response
+
+    Args:
+        response_list (Dict): search response with chat_response and search_output
+        user_id (str): id of the user who asked
+        ts (str): timestamp of the question
+        page_size (int): results per Show More page
+
+    Returns:
+        PreparedAnswer: messages to post in order, pages to cache and urls to record
+    """
+    search_output = response_list['search_output']
+    return PreparedAnswer(compose_answer(response_list['chat_response']['output_text'], search_output, user_id, ts),
+                          compose_showmore_pages(search_output, user_id, ts, page_size),
+                          [url for _, url in search_output])
+
+
+class StreamedAnswer:
+    """State of an answer streamed into a placeholder message.
+
+    Each stream event is fed to the matching method, which returns what to send; the
+    caller does the Slack and Redis calls, synchronously or on an event loop.
+    """
+
+    def __init__(self, user_id: str, ts: str, update_interval: float, page_size: int = SHOWMORE_PAGE_SIZE):
+        self.user_id = user_id
+        self.ts = ts
+        self.update_interval = update_interval
+        self.page_size = page_size
+        self.placeholder: Optional[Dict] = None
+        self.search_output: List[Tuple[str, str]] = []
+        self.partial = ""
+        self.last_update = 0.0
+        self.finished = False
+
+    @property
+    def urls(self) -> List[str]:
+        return [url for _, url in self.search_output]
+
+    def results(self, search_output: List[Tuple[str, str]]) -> Tuple[List[Dict], List[Dict]]:
+        """the result messages to post below the placeholder and the Show More pages to cache"""
+        self.search_output = search_output
+        return (compose_results(search_output, self.user_id, self.ts),
+                compose_showmore_pages(search_output, self.user_id, self.ts, self.page_size))
+
+    def chunk(self, text: str) -> Optional[str]:
+        """adds a chunk of the answer, returns the placeholder text when an update is due"""
+        self.partial += text
+        if self.placeholder is None or time() - self.last_update < self.update_interval or not self.partial.strip():
+            return None
+        self.last_update = time()
+        return format_chat_response(self.partial)[:MAX_TEXT_LENGTH]
+
+    def done(self, output_text: str) -> List[Dict]:
+        """the final answer, the first message replaces the placeholder and the others are posted"""
+        self.finished = True
+        return compose_messages(format_chat_response(output_text), [])
+
+    def failed(self) -> None:
+        """the search reported an error, the caller shows ERROR_TEXT"""
+        self.finished = True
+
+    @property
+    def cut_short(self) -> bool:
+        """the stream ended without 'done' or 'error' and the placeholder still says Thinking"""
+        return not self.finished and self.placeholder is not None
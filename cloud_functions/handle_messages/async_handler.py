@@ -0,0 +1,198 @@
+import asyncio
+import contextvars
+import json
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+import redis
+import redis.asyncio as aioredis
+from slack_sdk.web.async_client import AsyncWebClient
+
+from answer_flow import ERROR_TEXT, THINKING_TEXT, ErrorReported, StreamedAnswer, latency_ms, prepare_answer, search_body
+from credentials_cache import get_id_token
+from feedback_store import FeedbackPipeline
+from events import FeedbackEvent, ShowMoreEvent, SlackEvent
+from message_composer import SHOWMORE_PAGE_SIZE
+from search_client import CircuitOpenError, SearchClient
+from showmore_store import aload_showmore_page, asave_showmore_pages
+from slack_client import AsyncRateLimitedSlackClient
+from tracing import set_trace, span
+from utils import logger
+
+
+class AsyncHandler:
+    """asyncio implementation of handle_message.
+
+    All clients live on one event loop running in a background thread, so a warm instance
+    keeps its Slack, HTTP and Redis connections across invocations and concurrent requests
+    share them instead of each blocking a worker thread on network I/O. Slack calls queue
+    behind the same Redis rate limit buckets as the synchronous client, and the search goes
+    through the shared SearchClient's timeouts, retries and circuit breaker.
+    """
+
+    def __init__(self, bot_api_token: str, search_client: SearchClient, redis_client: redis.Redis, redis_kwargs: Dict,
+                 feedback: Optional[FeedbackPipeline], stream_answers: bool = False, stream_update_interval: float = 1.2,
+                 showmore_ttl: int = 7 * 24 * 3600, showmore_page_size: int = SHOWMORE_PAGE_SIZE):
+        self.bot_api_token = bot_api_token
+        self.search_client = search_client
+        self.redis_client = redis_client
+        self.redis_kwargs = redis_kwargs
+        self.stream_answers = stream_answers
+        self.stream_update_interval = stream_update_interval
+        self.showmore_ttl = showmore_ttl
+        self.showmore_page_size = showmore_page_size
+        self.feedback = feedback
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self._clients = None
+
+    def _get_clients(self) -> Tuple[AsyncRateLimitedSlackClient, aiohttp.ClientSession, aioredis.Redis]:
+        # the clients have to be created on the loop they will run on
+        if self._clients is None:
+            self._clients = (AsyncRateLimitedSlackClient(AsyncWebClient(token=self.bot_api_token), self.redis_client),
+                             aiohttp.ClientSession(), aioredis.Redis(**self.redis_kwargs))
+        return self._clients
+
+    def handle(self, event: SlackEvent) -> Tuple[str, int]:
+        """runs handle_event on the background loop and waits for the result
+
+        Args:
+            event (SlackEvent): decoded event
+
+        Returns:
+            Tuple[str, int]: response string and code
+        """
+        return asyncio.run_coroutine_threadsafe(self.handle_event(event), self.loop).result()
+
+    async def _slack_call(self, method: str, **kwargs) -> Dict:
+        """calls a rate limited AsyncWebClient method, recorded as a slack_post span"""
+        with span("slack_post", method=method.replace('_', '.')):
+            return await getattr(self._get_clients()[0], method)(**kwargs)
+
+    async def _post_in_order(self, user_id: str, messages: List[Dict]) -> List[str]:
+        """posts messages one after another so Slack assigns increasing ts values"""
+        posted = []
+        for message in messages:
+            response = await self._slack_call('chat_postMessage', channel=user_id, **message)
+            posted.append(response['ts'])
+        return posted
+
+    async def handle_event(self, event: SlackEvent) -> Tuple[str, int]:
+        """async counterpart of handle_message.process_event
+
+        Args:
+            event (SlackEvent): decoded event
+
+        Returns:
+            Tuple[str, int]: response string and code
+        """
+        session, r = self._get_clients()[1:]
+        set_trace(event.trace_id)
+
+        # check if interactive message (either feedback or showmore button):
+        if isinstance(event, FeedbackEvent):
+            if self.feedback is not None:
+                self.feedback.record_feedback(event.user_id, event.question_ts, event.feedback)
+            return 'OK', 200
+        if isinstance(event, ShowMoreEvent):
+            # one pre-rendered page per click, it ends with the button for the next one
+            message = await aload_showmore_page(r, event.callback_id)
+            if message is not None:
+                await self._slack_call('chat_postMessage', channel=event.user_id, **message)
+            return 'OK', 200
+
+        # if not an interactive message then it's the first question
+        user_id = event.user_id
+        ts = event.ts
+        logger.info("processing request %s for user %s", event.text, user_id)
+
+        data = search_body(event)
+        with span("token_fetch"):
+            # the token cache is synchronous, the pool thread keeps the trace
+            id_token_info = await self.loop.run_in_executor(None, contextvars.copy_context().run, get_id_token,
+                                                            self.search_client.url)
+        headers = {'Content-type': 'application/json',
+                   'Authorization': f'Bearer {id_token_info}'}
+
+        try:
+            if self.stream_answers:
+                await self._stream_search(data, headers, user_id, ts)
+                return 'OK', 200
+
+            logger.info("Pulling search data.")
+            with span("search_request"):
+                async with await self.search_client.apost(session, data, headers) as response:
+                    response.raise_for_status()
+                    response_list = json.loads(await response.text())
+            logger.info("Search data pulled, client stats: %s", self.search_client.stats)
+        except ErrorReported as e:
+            # the answer placeholder already shows ERROR_TEXT
+            logger.error("Search stream failed: %s, client stats: %s", e, self.search_client.stats)
+            return "QUERY ERROR", 404
+        except (aiohttp.ClientError, asyncio.TimeoutError, CircuitOpenError) as e:
+            logger.error("Search request failed: %s, client stats: %s", e, self.search_client.stats)
+            await self._slack_call('chat_postMessage', channel=user_id, text=ERROR_TEXT)
+            return "QUERY ERROR", 404
+
+        answer = prepare_answer(response_list, user_id, ts, self.showmore_page_size)
+        # the Show More cache write does not need to wait for Slack, nor Slack for it
+        await asyncio.gather(asave_showmore_pages(r, f"{user_id}_{ts}", answer.pages, self.showmore_ttl),
+                             self._post_in_order(user_id, answer.messages))
+        if self.feedback is not None:
+            self.feedback.record_query(user_id, ts, event.text, answer.urls, latency_ms(ts))
+        return 'OK', 200
+
+    async def _stream_search(self, data: Dict, headers: Dict, user_id: str, ts: str) -> None:
+        """async counterpart of handle_message.stream_search"""
+        session, r = self._get_clients()[1:]
+        answer = StreamedAnswer(user_id, ts, self.stream_update_interval, self.showmore_page_size)
+        pending = []
+        try:
+            with span("search_request", stream=True):
+                response = await self.search_client.apost(session, {**data, 'stream': True}, headers)
+            async with response:
+                response.raise_for_status()
+                async for line in response.content:
+                    if not line.strip():
+                        continue
+                    event = json.loads(line)
+                    if event['event'] == 'search_output':
+                        answer.placeholder = await self._slack_call('chat_postMessage', channel=user_id, text=THINKING_TEXT)
+                        messages, pages = answer.results(event['search_output'])
+                        # results and the cache write go out while the answer is still generating
+                        pending.append(asyncio.ensure_future(self._post_in_order(user_id, messages)))
+                        pending.append(asyncio.ensure_future(asave_showmore_pages(r, f"{user_id}_{ts}", pages, self.showmore_ttl)))
+                    elif event['event'] == 'chunk':
+                        text = answer.chunk(event['text'])
+                        if text is not None:
+                            await self._slack_call('chat_update', channel=answer.placeholder['channel'],
+                                                   ts=answer.placeholder['ts'], text=text)
+                    elif event['event'] == 'done':
+                        messages = answer.done(event['chat_response']['output_text'])
+                        if answer.placeholder is not None:
+                            await self._slack_call('chat_update', channel=answer.placeholder['channel'],
+                                                   ts=answer.placeholder['ts'], **messages.pop(0))
+                        if messages:
+                            # overflow text goes below the results, so wait for them first
+                            await asyncio.gather(*pending)
+                            await self._post_in_order(user_id, messages)
+                        if self.feedback is not None:
+                            self.feedback.record_query(user_id, ts, data['query'], answer.urls, latency_ms(ts))
+                    elif event['event'] == 'error':
+                        answer.failed()
+                        if answer.placeholder is None:
+                            await self._slack_call('chat_postMessage', channel=user_id, text=ERROR_TEXT)
+                        else:
+                            await self._slack_call('chat_update', channel=answer.placeholder['channel'],
+                                                   ts=answer.placeholder['ts'], text=ERROR_TEXT)
+        except Exception as e:
+            if not answer.cut_short:
+                raise
+            raise ErrorReported(e) from e
+        finally:
+            await asyncio.gather(*pending)
+            # the stream broke off before 'done' or 'error', do not leave the placeholder thinking
+            if answer.cut_short:
+                await self._slack_call('chat_update', channel=answer.placeholder['channel'],
+                                       ts=answer.placeholder['ts'], text=ERROR_TEXT)
@@ -0,0 +1,112 @@
+import atexit
+import threading
+from time import time
+from typing import Dict, List
+
+from utils import logger
+
+FEEDBACK_COLLECTION = "slackbot_feedback"
+# Firestore rejects batches of more than 500 writes
+MAX_BATCH_WRITES = 500
+
+
+class FeedbackPipeline:
+    """Buffers query and feedback records and upserts them to Firestore in batches.
+
+    Records are keyed by {user_id}_{ts} of the question and written with set(merge=True),
+    so a feedback click is stored whether or not the query record got there first. flush()
+    commits the queue in WriteBatches of at most batch_size records; with background=True a
+    thread also commits once batch_size records are queued or the oldest one waited
+    flush_interval seconds. Records of a failed commit are queued again up to max_attempts times.
+    """
+
+    def __init__(self, db, collection: str = FEEDBACK_COLLECTION, batch_size: int = 100,
+                 flush_interval: float = 2.0, max_attempts: int = 3, background: bool = True):
+        self.db = db
+        self.collection = collection
+        self.batch_size = min(batch_size, MAX_BATCH_WRITES)
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self._pending: List[Dict] = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self.stats = {'queued': 0, 'written': 0, 'batches': 0, 'failed_batches': 0, 'dropped': 0}
+        if background:
+            threading.Thread(target=self._run, daemon=True).start()
+            atexit.register(self.flush)
+
+    def _enqueue(self, user_id: str, ts: str, fields: Dict) -> None:
+        with self._lock:
+            self._pending.append({'doc_id': f"{user_id}_{ts}", 'fields': fields, 'queued_at': time(), 'attempts': 0})
+            self.stats['queued'] += 1
+            if len(self._pending) >= self.batch_size:
+                self._wake.set()
+
+    def record_query(self, user_id: str, ts: str, query: str, urls: List[str], latency_ms: float) -> None:
+        """queues the record of an answered question
+
+        Args:
+            user_id (str): id of the user who asked
+            ts (str): timestamp of the question
+            query (str): the question
+            urls (List[str]): urls of the returned results, in order
+            latency_ms (float): time from the question to the answer being posted
+        """
+        self._enqueue(user_id, ts, {'user_id': user_id, 'ts': ts, 'query': query, 'urls': urls,
+                                    'latency_ms': round(latency_ms, 1), 'answered_at': time()})
+
+    def record_feedback(self, user_id: str, ts: str, feedback: int) -> None:
+        """queues a thumbs up (1) or down (-1) for the question asked at ts"""
+        self._enqueue(user_id, ts, {'user_id': user_id, 'ts': ts, 'feedback': feedback, 'feedback_at': time()})
+
+    def _due(self) -> bool:
+        with self._lock:
+            return bool(self._pending) and (len(self._pending) >= self.batch_size
+                                            or time() - self._pending[0]['queued_at'] >= self.flush_interval)
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if self._due():
+                self.flush()
+
+    def flush(self) -> int:
+        """commits everything queued, batch_size documents per WriteBatch
+
+        Returns:
+            int: number of records written
+        """
+        with self._lock:
+            records, self._pending = self._pending, []
+        written = 0
+        for start in range(0, len(records), self.batch_size):
+            chunk = records[start:start + self.batch_size]
+            # records of the same question are merged into one write
+            merged: Dict[str, Dict] = {}
+            for record in chunk:
+                merged.setdefault(record['doc_id'], {}).update(record['fields'])
+            batch = self.db.batch()
+            for doc_id, fields in merged.items():
+                batch.set(self.db.collection(self.collection).document(doc_id), fields, merge=True)
+            try:
+                batch.commit()
+            except Exception as e:
+                self.stats['failed_batches'] += 1
+                self._requeue(chunk, e)
+                continue
+            written += len(chunk)
+            self.stats['written'] += len(chunk)
+            self.stats['batches'] += 1
+        if records:
+            logger.info("Feedback pipeline flushed %d records, stats: %s", written, self.stats)
+        return written
+
+    def _requeue(self, records: List[Dict], error: Exception) -> None:
+        retry = [record for record in records if record['attempts'] + 1 < self.max_attempts]
+        for record in retry:
+            record['attempts'] += 1
+        self.stats['dropped'] += len(records) - len(retry)
+        logger.error(f"Feedback batch of {len(records)} records failed, retrying {len(retry)}: {error}")
+        with self._lock:
+            self._pending[:0] = retry
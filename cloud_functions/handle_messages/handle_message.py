@@ -4,24 +4,36 @@ import os
 import requests
 import urllib
 import google.auth
-import google.oauth2.id_token
-from google.auth.transport.requests import Request
-from google.oauth2 import id_token
 from slack_sdk import WebClient
 from google.cloud import pubsub_v1
-from time import time
-from typing import Tuple
+from typing import Dict, Tuple
 from google.cloud import firestore
 import redis
-from grpc import _InactiveRpcError
+from grpc._channel import _InactiveRpcError
 from utils import read_secret, logger
+from credentials_cache import get_id_token
+from tracing import set_trace, span
+from idempotency import IdempotencyStore
+from events import FeedbackEvent, ShowMoreEvent, SlackEvent, decode_request
+from scheduler import SearchScheduler
+from async_handler import AsyncHandler
+from search_client import SearchClient
+from slack_client import RateLimitedSlackClient
+from answer_flow import ERROR_TEXT, THINKING_TEXT, ErrorReported, StreamedAnswer, latency_ms, prepare_answer, search_body
+from feedback_store import FeedbackPipeline
+from showmore_store import load_showmore_page, save_showmore_pages
+from message_composer import SHOWMORE_PAGE_SIZE
 # Load environment variables
 project_id = os.environ['project_id']
 
-# Firestore initialization
+# Firestore initialization, query and feedback records are not stored without it
+feedback = None
 try:
     db = firestore.Client()
     logger.info("Firestore DB initialized.")
+    # records queued by a request are upserted in one batch before it returns,
+    # an instance is not reliably given CPU once the response has been sent
+    feedback = FeedbackPipeline(db, batch_size=int(os.environ.get('FEEDBACK_BATCH_SIZE', 100)), background=False)
 except ValueError:
     pass
 
@@ -31,13 +43,103 @@ pswrd = read_secret("REDIS_PASS", project_id)
 port = read_secret("REDIS_PORT", project_id)
 host = read_secret("REDIS_HOST", project_id)
 r = redis.Redis(host=host, port=port, password=pswrd)
+showmore_ttl = int(os.environ.get('SHOWMORE_TTL', 7 * 24 * 3600))
+showmore_page_size = int(os.environ.get('SHOWMORE_PAGE_SIZE', SHOWMORE_PAGE_SIZE))
+dedup = IdempotencyStore("handle_message", r)
+# caps searches per user and across instances, Show More and feedback clicks skip the queue;
+# off unless SCHEDULER_ENABLED=true, without Redis every search runs unscheduled
+scheduler = SearchScheduler(r if os.environ.get('SCHEDULER_ENABLED', 'false') == 'true' else None)
 
 # read search logic url:
 search_func_url = read_secret('search_func_url', project_id)
+# pooled keep-alive client shared by the invocations of a warm instance
+search_client = SearchClient(search_func_url)
 
-# Initialize WebClient
+# Initialize WebClient, queued behind the Slack rate limits shared through Redis
 bot_api_token = read_secret('BOT_TOKEN', project_id)
-client = WebClient(token=bot_api_token)
+client = RateLimitedSlackClient(WebClient(token=bot_api_token), r)
+
+# Streaming answer delivery; chat.update is a tier 3 method (~50 calls per minute)
+stream_answers = os.environ.get('STREAM_ANSWERS', 'false') == 'true'
+stream_update_interval = float(os.environ.get('STREAM_UPDATE_INTERVAL', 1.2))
+
+# asyncio pipeline (AsyncWebClient, aiohttp, redis.asyncio) sharing one event loop per instance
+async_handler = None
+if os.environ.get('ASYNC_HANDLER', 'false') == 'true':
+    # the async clients share the Slack rate limits in Redis and the search client's timeouts, retries and breaker
+    async_handler = AsyncHandler(bot_api_token, search_client, r,
+                                 {'host': host, 'port': port, 'password': pswrd}, feedback,
+                                 stream_answers=stream_answers,
+                                 stream_update_interval=stream_update_interval,
+                                 showmore_ttl=showmore_ttl,
+                                 showmore_page_size=showmore_page_size)
+
+
+def post_message(**kwargs) -> Dict:
+    """chat_postMessage recorded as a slack_post span"""
+    with span("slack_post", method="chat.postMessage"):
+        return client.chat_postMessage(**kwargs)
+
+
+def update_message(**kwargs) -> Dict:
+    """chat_update recorded as a slack_post span"""
+    with span("slack_post", method="chat.update"):
+        return client.chat_update(**kwargs)
+
+
+def stream_search(data: Dict, headers: Dict, user_id: str, ts: str) -> None:
+    """posts the search results as soon as they arrive and progressively updates an answer
+    placeholder while main_logic streams the generated answer
+
+    Args:
+        data (Dict): search request body
+        headers (Dict): search request headers
+        user_id (str): id of the user who asked
+        ts (str): timestamp of the question
+    """
+    with span("search_request", stream=True):
+        response = search_client.post({**data, 'stream': True}, headers, stream=True)
+    response.raise_for_status()
+    answer = StreamedAnswer(user_id, ts, stream_update_interval, showmore_page_size)
+    try:
+        for line in response.iter_lines():
+            if not line:
+                continue
+            event = json.loads(line)
+            if event['event'] == 'search_output':
+                answer.placeholder = post_message(channel=user_id, text=THINKING_TEXT)
+                messages, pages = answer.results(event['search_output'])
+                for message in messages:
+                    post_message(channel=user_id, **message)
+                save_showmore_pages(r, f"{user_id}_{ts}", pages, showmore_ttl)
+            elif event['event'] == 'chunk':
+                text = answer.chunk(event['text'])
+                if text is not None:
+                    update_message(channel=answer.placeholder['channel'], ts=answer.placeholder['ts'], text=text)
+            elif event['event'] == 'done':
+                messages = answer.done(event['chat_response']['output_text'])
+                if answer.placeholder is not None:
+                    update_message(channel=answer.placeholder['channel'], ts=answer.placeholder['ts'], **messages.pop(0))
+                for message in messages:
+                    post_message(channel=user_id, **message)
+                if feedback is not None:
+                    feedback.record_query(user_id, ts, data['query'], answer.urls, latency_ms(ts))
+            elif event['event'] == 'error':
+                answer.failed()
+                if answer.placeholder is None:
+                    post_message(channel=user_id, text=ERROR_TEXT)
+                else:
+                    update_message(channel=answer.placeholder['channel'], ts=answer.placeholder['ts'], text=ERROR_TEXT)
+    except Exception as e:
+        if not answer.cut_short:
+            raise
+        raise ErrorReported(e) from e
+    finally:
+        # the stream broke off before 'done' or 'error', do not leave the placeholder thinking
+        if answer.cut_short:
+            update_message(channel=answer.placeholder['channel'], ts=answer.placeholder['ts'], text=ERROR_TEXT)
+
+
 def handle_message(request: requests.Request) -> Tuple[str, int]:
     """
     Receive request from pubsub and either calls the search logic for response
@@ -50,152 +152,105 @@ def handle_message(request: requests.Request) -> Tuple[str, int]:
         Tuple[str, int]: response string and code
     """
     logger.info("Here is the event: %s", request.data)
-    pre_event_data = request.data.decode('utf-8')
-    event_data = json.loads(pre_event_data)
+    event = decode_request(request.data)
+    logger.info("Event: %s", event)
+    if event is None:
+        # nothing to answer (message edits, deletions, ...), a 200 keeps the workflow from retrying it
+        return 'OK', 200
+
+    # drop workflow retries before any search or Slack call
+    dedup_key = event.dedup_key()
+    if not dedup.first_seen(dedup_key):
+        return 'OK', 200
+
+    set_trace(event.trace_id)
+    try:
+        with scheduler.slot(event) as slot:
+            if slot.superseded:
+                logger.info("question %s of %s repeats one that is being answered", event.ts, event.user_id)
+                return 'OK', 200
+            if async_handler is not None:
+                response = async_handler.handle(event)
+            else:
+                response = process_event(event)
+    except Exception:
+        # let the workflow retry handle the event again
+        dedup.release(dedup_key)
+        raise
+    finally:
+        if feedback is not None:
+            feedback.flush()
+    # a returned error was already shown to the user, a retry would only repeat it
+    return response
 
-    logger.info("Event Data: %s", event_data)
-     
-    data_dict = event_data['data']
 
-    # Initialize message colors:
-    colours = ['#DBB0CE', '#411C50', '#E99E86']
-    colour_counter = 0
+def process_event(event: SlackEvent) -> Tuple[str, int]:
+    """posts a Show More page, records feedback or answers a question
 
+    Args:
+        event (SlackEvent): the decoded event, holding its scheduler slot
+
+    Returns:
+        Tuple[str, int]: response string and code
+    """
     # check if interactive message (either feedback or showmore button):
-    if data_dict['type'] == "interactive_message":
-        if data_dict['callback_id'].startswith("feedback"):
-            user_id, ts = data_dict['callback_id'].split("_")[1:]
-            feedback = data_dict['actions'][0]['value']
-            if feedback == "👍":
-                feedback = 1
-            elif feedback == "👎":
-                feedback = -1
-            db.collection("slackbot_feedback").document(f"{user_id}_{ts}").update({f"feedback": feedback})
-        else:
-            user_id = data_dict['user']['id']
-            # Retrieve rest of the search results
-            search_results = r.hgetall(f"slackbot_showmore:{data_dict['callback_id']}")
-            search_output = [(v.decode('utf-8').split('$$$')[0], v.decode('utf-8').split('$$$')[1]) for v in search_results.values()]
-            for i in range(3, len(search_output)):
-                logger.info(f"attempting to post the {i}th message")
-                client.chat_postMessage(
-                    channel=user_id,
-                    attachments=[
-                        {
-                            'fallback': "Your search results are ready!",
-                            'color': colours[colour_counter % 3],
-                            'title': search_output[i][0],
-                            'title_link': search_output[i][1]
-                        }
-                    ],
-                )
-                colour_counter += 1
+    if isinstance(event, FeedbackEvent):
+        if feedback is not None:
+            feedback.record_feedback(event.user_id, event.question_ts, event.feedback)
+    elif isinstance(event, ShowMoreEvent):
+        # one pre-rendered page per click, it ends with the button for the next one
+        message = load_showmore_page(r, event.callback_id)
+        if message is not None:
+            logger.info("posting Show More page %s", event.callback_id)
+            post_message(channel=event.user_id, **message)
     
     # if not an interactive message then it's the first question
     else:
-        text = data_dict['text']
-        user_id = data_dict['user']
-        ts = data_dict['ts']
+        text = event.text
+        user_id = event.user_id
+        ts = event.ts
         logger.info("processing request %s for user %s", text, user_id)
     
-        data = {'query': text, 'user_id': event_data['user_id']}
+        data = search_body(event)
 
-        id_token_info = id_token.fetch_id_token(Request(), search_func_url)
+        with span("token_fetch"):
+            id_token_info = get_id_token(search_func_url)
         headers = {'Content-type': 'application/json', 
                    'Authorization': f'Bearer {id_token_info}'}
         try:
+            if stream_answers:
+                stream_search(data, headers, user_id, ts)
+                return 'OK', 200
+
             logger.info("Pulling search data.")
-            response = requests.post(search_func_url, json=data, headers=headers)
-            response_list = json.loads(response.text)
-            if response_list['chat_response']['output_text'] == "":
-                client.chat_postMessage(channel=user_id, text="*I don't know.*")
-                logger.info("Search data pulled")
-        except _InactiveRpcError:
-            client.chat_postMessage(channel=user_id, text="*Sorry, we encountered an error. Your query has been logged for analysis.*")
+            with span("search_request"):
+                response = search_client.post(data, headers)
+            response.raise_for_status()
+            logger.info("Search data pulled, client stats: %s", search_client.reuse_stats())
+        except ErrorReported as e:
+            # the answer placeholder already shows ERROR_TEXT
+            logger.error("Search stream failed: %s, client stats: %s", e, search_client.reuse_stats())
+            return "QUERY ERROR", 404
+        except (_InactiveRpcError, requests.exceptions.RequestException) as e:
+            logger.error("Search request failed: %s, client stats: %s", e, search_client.reuse_stats())
+            post_message(channel=user_id, text=ERROR_TEXT)
             return "QUERY ERROR", 404
 
         response_list = json.loads(response.text)
         logger.info("Response list: %s", response_list)
 
-        unformatted_chat_response = response_list['chat_response']['output_text']
-        chat_response_lines = unformatted_chat_response.split('\n')  # split the text into lines
-        chat_response_lines_bold = [f"*{line}*" if line.strip() else line for line in chat_response_lines]  # make each non-empty line bold
-        chat_response = '\n'.join(chat_response_lines_bold)  # join the lines back together
-        if chat_response == "": # 'I don't know' has already been posted, no need to post any other text besides the links
-            pass
-        else:
-            client.chat_postMessage(channel=user_id, text=chat_response)
-            # future adding history:
-            # history = r.hget(f"slackbot_showmore:{user_id}_{ts}", "history")
-            # r.hset(f"slackbot_showmore:{user_id}_{ts}", "history", f"{chat_response + history}")
-
-        search_output = response_list['search_output']
-        # store search output in cache
-        for i, item in enumerate(search_output):
-            r.hset(f"slackbot_showmore:{user_id}_{ts}", 
-                   f"search_results.{i}", f"{item[0]}$$${item[1]}")
-        
-        # send the messages
-        for i in range(3):
-            client.chat_postMessage(
-                channel=user_id,
-                attachments=[
-                    {
-                        'fallback': "Your search results are ready!",
-                        'color': colours[colour_counter % 3],
-                        'title': search_output[i][0],
-                        'title_link': search_output[i][1]
-                    }
-                ],
-            )
-            colour_counter += 1
-
-        # Show More button
-        logger.info("Posting show more button...")
-        client.chat_postMessage(
-            channel=user_id,
-            attachments=[
-                {   
-                    "text": "Need more results?",
-                    "color": "#3AA3E3",  # Might want to remove this line depending on how we want UI to look
-                    "attachment_type": "default",
-                    "callback_id": f"{user_id}_{ts}",
-                    "actions": [
-                        {
-                            "name": "show_more",
-                            "text": "Show More",
-                            "type": "button",
-                            "value": "showmore"
-                        },
-                    ],
-                }
-            ]
-        )
-
-        # Post thumbs up and down buttons
-        client.chat_postMessage(
-            channel=user_id,
-            attachments=[
-                {
-                    "text": "How did I do?",
-                    "attachment_type": "default",
-                    "callback_id": f"feedback_{user_id}_{ts}",
-                    "actions": [
-                        {
-                            "name": "thumbs_up",
-                            "text": "👍",
-                            "type": "button",
-                            "value": "👍"
-                        },
-                        {
-                            "name": "thumbs_down",
-                            "text": "👎",
-                            "type": "button",
-                            "value": "👎"
-                        }
-                    ]
-                }
-            ]
-        )
-
-    return 'OK', 200
\ No newline at end of file
+        answer = prepare_answer(response_list, user_id, ts, showmore_page_size)
+        # store the rendered Show More pages in cache
+        save_showmore_pages(r, f"{user_id}_{ts}", answer.pages, showmore_ttl)
+        # future adding history:
+        # history = r.hget(f"slackbot_showmore:{user_id}_{ts}", "history")
+        # r.hset(f"slackbot_showmore:{user_id}_{ts}", "history", f"{chat_response + history}")
+
+        # send the answer, the top results and the show more and feedback buttons together
+        for message in answer.messages:
+            post_message(channel=user_id, **message)
+        # latency from the question (Slack ts) to the answer being posted
+        if feedback is not None:
+            feedback.record_query(user_id, ts, text, answer.urls, latency_ms(ts))
+
+    return 'OK', 200
@@ -0,0 +1,204 @@
+from typing import Dict, List, Optional, Tuple
+
+# Slack truncates message text after 40k characters and rejects more than 100 attachments;
+# it recommends staying at or below 20 attachments, so that is the split point we use.
+MAX_TEXT_LENGTH = 40000
+MAX_ATTACHMENTS = 20
+# results per Show More page, each page is a single message
+SHOWMORE_PAGE_SIZE = 10
+
+# Initialize message colors:
+colours = ['#DBB0CE', '#411C50', '#E99E86']
+
+
+def format_chat_response(output_text: str) -> str:
+    """makes each non-empty line of the answer bold
+
+    Args:
+        output_text (str): raw answer from the QA chain
+
+    Returns:
+        str: formatted answer, "I don't know." when the answer is blank
+    """
+    if output_text == "":
+        return "*I don't know.*"
+    chat_response_lines = output_text.split('\n')
+    return '\n'.join(f"*{line}*" if line.strip() else line for line in chat_response_lines)
+
+
+def result_attachment(title: str, url: str, colour_counter: int) -> Dict:
+    """builds the attachment for a single search result
+
+    Args:
+        title (str): page title
+        url (str): page link
+        colour_counter (int): position of the result, picks the colour
+
+    Returns:
+        Dict: legacy attachment
+    """
+    return {
+        'fallback': "Your search results are ready!",
+        'color': colours[colour_counter % 3],
+        'title': title,
+        'title_link': url
+    }
+
+
+def showmore_callback_id(user_id: str, ts: str, page: int = 1) -> str:
+    """callback_id of the button showing the given page, {user_id}_{ts} for the first one"""
+    return f"{user_id}_{ts}" if page == 1 else f"{user_id}_{ts}:{page}"
+
+
+def parse_showmore_callback(callback_id: str) -> Tuple[str, str, int]:
+    """splits a Show More callback_id into user_id, ts and page"""
+    base, _, page = callback_id.partition(":")
+    user_id, _, ts = base.partition("_")
+    return user_id, ts, int(page or 1)
+
+
+def show_more_attachment(user_id: str, ts: str, page: int = 1) -> Dict:
+    """builds the Show More button, its callback_id identifies the cached results and the page to show"""
+    return {
+        "text": "Need more results?",
+        "color": "#3AA3E3",  # Might want to remove this line depending on how we want UI to look
+        "attachment_type": "default",
+        "callback_id": showmore_callback_id(user_id, ts, page),
+        "actions": [
+            {
+                "name": "show_more",
+                "text": "Show More",
+                "type": "button",
+                "value": "showmore"
+            },
+        ],
+    }
+
+
+def feedback_attachment(user_id: str, ts: str) -> Dict:
+    """builds the thumbs up and down buttons"""
+    return {
+        "text": "How did I do?",
+        "attachment_type": "default",
+        "callback_id": f"feedback_{user_id}_{ts}",
+        "actions": [
+            {
+                "name": "thumbs_up",
+                "text": "👍",
+                "type": "button",
+                "value": "👍"
+            },
+            {
+                "name": "thumbs_down",
+                "text": "👎",
+                "type": "button",
+                "value": "👎"
+            }
+        ]
+    }
+
+
+def _split_text(text: str) -> List[str]:
+    """splits text on line boundaries into pieces Slack will not truncate"""
+    pieces, current = [], ""
+    for line in text.split('\n'):
+        while len(line) > MAX_TEXT_LENGTH:
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(line[:MAX_TEXT_LENGTH])
+            line = line[MAX_TEXT_LENGTH:]
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) > MAX_TEXT_LENGTH:
+            pieces.append(current)
+            current = line
+        else:
+            current = candidate
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def compose_messages(text: Optional[str], attachments: List[Dict]) -> List[Dict]:
+    """packs text and attachments into as few chat_postMessage payloads as Slack limits allow
+
+    Args:
+        text (Optional[str]): message text, goes into the first payload
+        attachments (List[Dict]): attachments in display order
+
+    Returns:
+        List[Dict]: keyword arguments for chat_postMessage (without the channel)
+    """
+    texts = _split_text(text) if text else []
+    chunks = [attachments[i:i + MAX_ATTACHMENTS] for i in range(0, len(attachments), MAX_ATTACHMENTS)]
+    messages = [{'text': t} for t in texts[:-1]]
+    last_text = texts[-1] if texts else None
+    if not chunks:
+        return messages + ([{'text': last_text}] if last_text else [])
+    for i, chunk in enumerate(chunks):
+        message = {'attachments': chunk}
+        if i == 0 and last_text:
+            message['text'] = last_text
+        messages.append(message)
+    return messages
+
+
+def _result_and_button_attachments(search_output: List[Tuple[str, str]], user_id: str, ts: str) -> List[Dict]:
+    attachments = [result_attachment(title, url, i) for i, (title, url) in enumerate(search_output[:3])]
+    attachments.append(show_more_attachment(user_id, ts))
+    attachments.append(feedback_attachment(user_id, ts))
+    return attachments
+
+
+def compose_answer(output_text: str, search_output: List[Tuple[str, str]], user_id: str, ts: str) -> List[Dict]:
+    """composes the answer, the top three results and both action buttons into one message
+
+    Args:
+        output_text (str): raw answer from the QA chain
+        search_output (List[Tuple[str, str]]): list of (title, url)
+        user_id (str): id of the user who asked
+        ts (str): timestamp of the question
+
+    Returns:
+        List[Dict]: keyword arguments for chat_postMessage (without the channel)
+    """
+    return compose_messages(format_chat_response(output_text), _result_and_button_attachments(search_output, user_id, ts))
+
+
+def compose_showmore_pages(search_output: List[Tuple[str, str]], user_id: str, ts: str,
+                           page_size: int = SHOWMORE_PAGE_SIZE) -> List[Dict]:
+    """renders the results after the top three into Show More pages, each one a single
+    message ending with the button for the next page
+
+    Args:
+        search_output (List[Tuple[str, str]]): list of (title, url)
+        user_id (str): id of the user who asked
+        ts (str): timestamp of the question
+        page_size (int): results per page
+
+    Returns:
+        List[Dict]: keyword arguments for chat_postMessage (without the channel), page 1 first
+    """
+    page_size = min(page_size, MAX_ATTACHMENTS - 1)
+    rest = search_output[3:]
+    pages = []
+    for page, start in enumerate(range(0, len(rest), page_size), 1):
+        attachments = [result_attachment(title, url, start + i) for i, (title, url) in enumerate(rest[start:start + page_size])]
+        if start + page_size < len(rest):
+            attachments.append(show_more_attachment(user_id, ts, page + 1))
+        pages.append({'attachments': attachments})
+    return pages
+
+
+def compose_results(search_output: List[Tuple[str, str]], user_id: str, ts: str) -> List[Dict]:
+    """composes the top three results and both action buttons, used while the answer is still streaming
+
+    Args:
+        search_output (List[Tuple[str, str]]): list of (title, url)
+        user_id (str): id of the user who asked
+        ts (str): timestamp of the question
+
+    Returns:
+        List[Dict]: keyword arguments for chat_postMessage (without the channel)
+    """
+    return compose_messages(None, _result_and_button_attachments(search_output, user_id, ts))
@@ -0,0 +1,176 @@
+import asyncio
+import os
+import random
+import threading
+from time import sleep, time
+from typing import Dict, Optional
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+from utils import logger
+
+SEARCH_POOL_SIZE = int(os.environ.get('SEARCH_POOL_SIZE', 10))
+SEARCH_CONNECT_TIMEOUT = float(os.environ.get('SEARCH_CONNECT_TIMEOUT', 5))
+SEARCH_READ_TIMEOUT = float(os.environ.get('SEARCH_READ_TIMEOUT', 300))
+SEARCH_RETRIES = int(os.environ.get('SEARCH_RETRIES', 3))
+SEARCH_BACKOFF = float(os.environ.get('SEARCH_BACKOFF', 0.5))
+SEARCH_BREAKER_THRESHOLD = int(os.environ.get('SEARCH_BREAKER_THRESHOLD', 5))
+SEARCH_BREAKER_RESET = float(os.environ.get('SEARCH_BREAKER_RESET', 30))
+
+# what a cold or scaling search function answers with before it can serve the request, a 500
+# comes from the search itself and is not retried
+RETRY_STATUSES = {429, 502, 503, 504}
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised without calling the search function while the circuit breaker is open"""
+
+
+class SearchClient:
+    """Keep-alive client for the main_logic search function.
+
+    One instance lives per warm handle_message instance, so its pooled connections (and
+    their TLS sessions) are reused across invocations. Connection errors, connect timeouts
+    and cold-start statuses are retried with jittered exponential backoff; after
+    breaker_threshold consecutive failed requests the breaker fails calls fast for
+    breaker_reset seconds, then lets a trial request through. apost is the aiohttp
+    counterpart of post, sharing the timeouts, retries and breaker.
+    """
+
+    def __init__(self, url: str, pool_size: int = SEARCH_POOL_SIZE,
+                 connect_timeout: float = SEARCH_CONNECT_TIMEOUT, read_timeout: float = SEARCH_READ_TIMEOUT,
+                 retries: int = SEARCH_RETRIES, backoff: float = SEARCH_BACKOFF,
+                 breaker_threshold: int = SEARCH_BREAKER_THRESHOLD, breaker_reset: float = SEARCH_BREAKER_RESET):
+        self.url = url
+        self.timeout = (connect_timeout, read_timeout)
+        self.async_timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        # requests speaks HTTP/1.1 only, keep-alive is what saves the handshakes
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self.stats = {'requests': 0, 'attempts': 0, 'retries': 0, 'failures': 0, 'short_circuited': 0}
+
+    def _check_breaker(self) -> None:
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time() - self._opened_at < self.breaker_reset:
+                self.stats['short_circuited'] += 1
+                raise CircuitOpenError(f"search circuit open after {self._failures} consecutive failures")
+            # half open: this request is the trial, the others keep failing fast until it returns
+            self._opened_at = time()
+
+    def _record(self, success: bool) -> None:
+        with self._lock:
+            if success:
+                self._failures, self._opened_at = 0, None
+                return
+            self._failures += 1
+            self.stats['failures'] += 1
+            if self._failures >= self.breaker_threshold:
+                if self._opened_at is None:
+                    logger.error("Opening search circuit after %d consecutive failures", self._failures)
+                self._opened_at = time()
+
+    def _connection_pool(self):
+        return self.session.get_adapter(self.url).poolmanager.connection_from_url(self.url)
+
+    def _backoff(self, attempt: int) -> float:
+        self.stats['retries'] += 1
+        return random.uniform(0, self.backoff * 2 ** (attempt - 1))
+
+    def reuse_stats(self) -> Dict[str, float]:
+        """request counters plus the share of attempts served on an already open connection"""
+        pool = self._connection_pool()
+        served = max(pool.num_requests, 1)
+        return {**self.stats, 'new_connections': pool.num_connections,
+                'connection_reuse_rate': round(1 - pool.num_connections / served, 3)}
+
+    def post(self, json: Dict, headers: Dict, stream: bool = False) -> requests.Response:
+        """posts a search request, retrying cold-start errors
+
+        Args:
+            json (Dict): request body
+            headers (Dict): request headers
+            stream (bool): whether to stream the response body
+
+        Raises:
+            CircuitOpenError: the breaker is open
+            requests.exceptions.RequestException: the last error once retries are exhausted
+
+        Returns:
+            requests.Response: the response, possibly with a retryable status when retries ran out
+        """
+        self._check_breaker()
+        self.stats['requests'] += 1
+        for attempt in range(self.retries + 1):
+            if attempt:
+                sleep(self._backoff(attempt))
+            self.stats['attempts'] += 1
+            try:
+                response = self.session.post(self.url, json=json, headers=headers, stream=stream, timeout=self.timeout)
+            except requests.exceptions.ConnectionError as e:
+                logger.warning("Search attempt %d failed: %s", attempt + 1, e)
+                if attempt == self.retries:
+                    self._record(False)
+                    raise
+                continue
+            except requests.exceptions.RequestException:
+                # read timeouts are not retried, the search may still be running
+                self._record(False)
+                raise
+            if response.status_code in RETRY_STATUSES and attempt < self.retries:
+                logger.warning("Search attempt %d returned %d", attempt + 1, response.status_code)
+                response.close()
+                continue
+            self._record(response.status_code < 500)
+            return response
+
+    async def apost(self, session: aiohttp.ClientSession, json: Dict, headers: Dict) -> aiohttp.ClientResponse:
+        """async counterpart of post over an aiohttp session, the body is read or streamed by the caller
+
+        Args:
+            session (aiohttp.ClientSession): session of the calling event loop
+            json (Dict): request body
+            headers (Dict): request headers
+
+        Raises:
+            CircuitOpenError: the breaker is open
+            aiohttp.ClientError: the last error once retries are exhausted
+
+        Returns:
+            aiohttp.ClientResponse: the response, possibly with a retryable status when retries ran out
+        """
+        self._check_breaker()
+        self.stats['requests'] += 1
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self._backoff(attempt))
+            self.stats['attempts'] += 1
+            try:
+                response = await session.post(self.url, json=json, headers=headers, timeout=self.async_timeout)
+            except aiohttp.ClientConnectionError as e:
+                # read timeouts are not retried, the search may still be running
+                if isinstance(e, aiohttp.SocketTimeoutError) or attempt == self.retries:
+                    self._record(False)
+                    raise
+                logger.warning("Search attempt %d failed: %s", attempt + 1, e)
+                continue
+            except aiohttp.ClientError:
+                self._record(False)
+                raise
+            if response.status in RETRY_STATUSES and attempt < self.retries:
+                logger.warning("Search attempt %d returned %d", attempt + 1, response.status)
+                response.release()
+                continue
+            self._record(response.status < 500)
+            return response
@@ -0,0 +1,101 @@
+from typing import Dict, List, Optional, Tuple
+
+import orjson
+import redis
+import redis.asyncio as aioredis
+
+from message_composer import compose_showmore_pages, parse_showmore_callback, showmore_callback_id
+
+SHOWMORE_PREFIX = "slackbot_showmore"
+PAGE_PREFIX = "page."
+# fields of the result lists cached before pages were pre-rendered
+FIELD_PREFIX = "search_results."
+SEPARATOR = "$$$"
+
+
+def showmore_key(callback_id: str) -> str:
+    """builds the Redis key for a Show More callback_id ({user_id}_{ts})"""
+    return f"{SHOWMORE_PREFIX}:{callback_id}"
+
+
+def encode_pages(pages: List[Dict]) -> Dict[str, bytes]:
+    """builds the hash mapping written in a single HSET, page.{n} -> ready-to-send payload"""
+    return {f"{PAGE_PREFIX}{n}": orjson.dumps(page) for n, page in enumerate(pages, 1)}
+
+
+def decode_search_output(raw: Dict[bytes, bytes]) -> List[Tuple[str, str]]:
+    """decodes an HGETALL reply, each value once, back into result order
+
+    Args:
+        raw (Dict[bytes, bytes]): reply from HGETALL
+
+    Returns:
+        List[Tuple[str, str]]: list of (title, url) ordered by result index
+    """
+    results = []
+    for field, value in raw.items():
+        field = field.decode('utf-8')
+        if not field.startswith(FIELD_PREFIX):
+            continue
+        title, _, url = value.decode('utf-8').partition(SEPARATOR)
+        results.append((int(field[len(FIELD_PREFIX):]), title, url))
+    return [(title, url) for _, title, url in sorted(results)]
+
+
+def load_showmore_page(r: redis.Redis, callback_id: str) -> Optional[Dict]:
+    """fetches the pre-rendered page a Show More button points at with a single HGET
+
+    Results cached before pages were pre-rendered are rendered from the stored list.
+
+    Args:
+        r (redis.Redis): redis client
+        callback_id (str): callback_id of the clicked button
+
+    Returns:
+        Optional[Dict]: keyword arguments for chat_postMessage, None when there is nothing to show
+    """
+    user_id, ts, page = parse_showmore_callback(callback_id)
+    key = showmore_key(showmore_callback_id(user_id, ts))
+    raw = r.hget(key, f"{PAGE_PREFIX}{page}")
+    if raw is not None:
+        return orjson.loads(raw)
+    pages = compose_showmore_pages(decode_search_output(r.hgetall(key)), user_id, ts)
+    return pages[page - 1] if page <= len(pages) else None
+
+
+async def aload_showmore_page(r: aioredis.Redis, callback_id: str) -> Optional[Dict]:
+    """async counterpart of load_showmore_page"""
+    user_id, ts, page = parse_showmore_callback(callback_id)
+    key = showmore_key(showmore_callback_id(user_id, ts))
+    raw = await r.hget(key, f"{PAGE_PREFIX}{page}")
+    if raw is not None:
+        return orjson.loads(raw)
+    pages = compose_showmore_pages(decode_search_output(await r.hgetall(key)), user_id, ts)
+    return pages[page - 1] if page <= len(pages) else None
+
+
+def save_showmore_pages(r: redis.Redis, callback_id: str, pages: List[Dict], ttl: int) -> None:
+    """writes the pre-rendered pages and their expiry in one pipelined round trip
+
+    Args:
+        r (redis.Redis): redis client
+        callback_id (str): {user_id}_{ts} of the question
+        pages (List[Dict]): pages from compose_showmore_pages
+        ttl (int): expiry of the key in seconds
+    """
+    if not pages:
+        return
+    pipe = r.pipeline(transaction=False)
+    pipe.hset(showmore_key(callback_id), mapping=encode_pages(pages))
+    pipe.expire(showmore_key(callback_id), ttl)
+    pipe.execute()
+
+
+async def asave_showmore_pages(r: aioredis.Redis, callback_id: str, pages: List[Dict], ttl: int) -> None:
+    """async counterpart of save_showmore_pages"""
+    if not pages:
+        return
+    async with r.pipeline(transaction=False) as pipe:
+        pipe.hset(showmore_key(callback_id), mapping=encode_pages(pages))
+        pipe.expire(showmore_key(callback_id), ttl)
+        await pipe.execute()
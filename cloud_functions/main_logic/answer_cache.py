@@ -0,0 +1,146 @@
+import hashlib
+import json
+import re
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import redis
+
+from utils import logger
+
+# process-wide hit/miss counters, reported in the logs on every lookup
+cache_stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0}
+
+
+def normalize_query(query: str) -> str:
+    """lowercases the query, collapses whitespace and drops trailing punctuation
+
+    Args:
+        query (str): raw query text
+
+    Returns:
+        str: normalized query
+    """
+    query = re.sub(r"\s+", " ", query.strip().lower())
+    return query.rstrip("?!. ")
+
+
+class AnswerCache:
+    """Redis-backed cache of search() results, namespaced per user.
+
+    Every entry is a hash holding the normalized query, its float32 embedding and the
+    serialized result. A sorted set per user scores entries by last access time and is
+    used both for the near-duplicate scan and for LRU eviction.
+    """
+
+    def __init__(self, redis_client: redis.Redis, ttl: int = 86400, threshold: float = 0.95,
+                 max_entries: int = 50, prefix: str = "slackbot_answers"):
+        self.r = redis_client
+        self.ttl = ttl
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.prefix = prefix
+
+    def _entry_key(self, user_id: str, digest: str) -> str:
+        return f"{self.prefix}:{user_id}:{digest}"
+
+    def _index_key(self, user_id: str) -> str:
+        return f"{self.prefix}_lru:{user_id}"
+
+    def _touch(self, user_id: str, digest: str) -> None:
+        pipe = self.r.pipeline()
+        pipe.zadd(self._index_key(user_id), {digest: time.time()})
+        pipe.expire(self._index_key(user_id), self.ttl)
+        pipe.expire(self._entry_key(user_id, digest), self.ttl)
+        pipe.execute()
+
+    def _log(self, outcome: str, user_id: str) -> None:
+        cache_stats[outcome] += 1
+        logger.info("Answer cache %s for user %s, stats: %s", outcome, user_id, cache_stats)
+
+    def lookup(self, user_id: str, query: str,
+               embed: Callable[[str], List[float]]) -> Tuple[Optional[Dict], Optional[List[float]]]:
+        """looks up a cached answer by exact normalized query, then by embedding similarity
+
+        Args:
+            user_id (str): id of the user sending the query
+            query (str): the question sent via chatbot
+            embed (Callable[[str], List[float]]): query embedding function, only called on an exact miss
+
+        Returns:
+            Tuple[Optional[Dict], Optional[List[float]]]: cached result (None on a miss) and the
+            query embedding if one was computed
+        """
+        digest = hashlib.sha1(normalize_query(query).encode("utf-8")).hexdigest()
+        try:
+            cached = self.r.hget(self._entry_key(user_id, digest), "result")
+            if cached is not None:
+                self._touch(user_id, digest)
+                self._log("exact_hits", user_id)
+                return json.loads(cached), None
+        except redis.exceptions.RedisError as e:
+            logger.error(f"Answer cache lookup failed: {e}")
+            return None, None
+
+        embedding = embed(query)
+        try:
+            digests = [d.decode("utf-8") for d in self.r.zrevrange(self._index_key(user_id), 0, -1)]
+            pipe = self.r.pipeline()
+            for d in digests:
+                pipe.hget(self._entry_key(user_id, d), "embedding")
+            stored = pipe.execute()
+
+            live = [(d, v) for d, v in zip(digests, stored) if v is not None]
+            expired = [d for d, v in zip(digests, stored) if v is None]
+            if expired:
+                self.r.zrem(self._index_key(user_id), *expired)
+            if live:
+                query_vec = np.asarray(embedding, dtype=np.float32)
+                matrix = np.vstack([np.frombuffer(v, dtype=np.float32) for _, v in live])
+                norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query_vec)
+                scores = matrix @ query_vec / np.where(norms == 0, 1, norms)
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    best_digest = live[best][0]
+                    cached = self.r.hget(self._entry_key(user_id, best_digest), "result")
+                    if cached is not None:
+                        self._touch(user_id, best_digest)
+                        logger.info("Near-duplicate query matched with cosine similarity %.4f", scores[best])
+                        self._log("semantic_hits", user_id)
+                        return json.loads(cached), embedding
+        except redis.exceptions.RedisError as e:
+            logger.error(f"Answer cache lookup failed: {e}")
+            return None, embedding
+
+        self._log("misses", user_id)
+        return None, embedding
+
+    def store(self, user_id: str, query: str, embedding: Optional[List[float]], result: Dict) -> None:
+        """stores a search result and evicts the least recently used entries over max_entries
+
+        Args:
+            user_id (str): id of the user sending the query
+            query (str): the question sent via chatbot
+            embedding (Optional[List[float]]): query embedding returned by lookup
+            result (Dict): the search() result to cache
+        """
+        normalized = normalize_query(query)
+        digest = hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+        mapping = {"query": normalized, "result": json.dumps(result)}
+        if embedding is not None:
+            mapping["embedding"] = np.asarray(embedding, dtype=np.float32).tobytes()
+        try:
+            pipe = self.r.pipeline()
+            pipe.hset(self._entry_key(user_id, digest), mapping=mapping)
+            pipe.expire(self._entry_key(user_id, digest), self.ttl)
+            pipe.zadd(self._index_key(user_id), {digest: time.time()})
+            pipe.expire(self._index_key(user_id), self.ttl)
+            pipe.zcard(self._index_key(user_id))
+            size = pipe.execute()[-1]
+            if size > self.max_entries:
+                evicted = self.r.zpopmin(self._index_key(user_id), size - self.max_entries)
+                self.r.delete(*[self._entry_key(user_id, d.decode("utf-8")) for d, _ in evicted])
+                logger.info("Answer cache evicted %d entries for user %s", len(evicted), user_id)
+        except redis.exceptions.RedisError as e:
+            logger.error(f"Answer cache store failed: {e}")
@@ -0,0 +1,78 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from typing import Any, Callable, Dict, List
+
+from utils import logger
+
+
+class LazyComponents:
+    """Registry of clients that are built on first use.
+
+    Factories may call get() for their own dependencies. Each component is built once under
+    its own lock, in whichever thread asks for it first, so a warmup pool and request threads
+    can race for the same component without building it twice or deadlocking the pool.
+    """
+
+    def __init__(self):
+        self._factories: Dict[str, Callable[[], Any]] = {}
+        self._eager: List[str] = []
+        self._values: Dict[str, Any] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self.timings: Dict[str, float] = {}
+
+    def register(self, name: str, eager: bool = True) -> Callable:
+        """decorator registering a factory for a component
+
+        Args:
+            name (str): component name used with get()
+            eager (bool): whether warmup() builds it, components only needed on demand pass False
+
+        Returns:
+            Callable: the decorator
+        """
+        def decorator(factory: Callable[[], Any]) -> Callable[[], Any]:
+            self._factories[name] = factory
+            self._locks[name] = threading.Lock()
+            if eager:
+                self._eager.append(name)
+            return factory
+        return decorator
+
+    def get(self, name: str) -> Any:
+        """returns the component, building it (and its dependencies) if needed
+
+        Args:
+            name (str): component name
+
+        Returns:
+            Any: the built component
+        """
+        if name in self._values:
+            return self._values[name]
+        with self._locks[name]:
+            if name not in self._values:
+                start = perf_counter()
+                value = self._factories[name]()
+                # includes time spent waiting on dependencies built by other threads
+                self.timings[name] = perf_counter() - start
+                logger.info("Initialized %s in %.3fs", name, self.timings[name])
+                self._values[name] = value
+        return self._values[name]
+
+    def warmup(self, max_workers: int = 8) -> None:
+        """starts building every eager component on a thread pool without waiting for it
+
+        Args:
+            max_workers (int): size of the pool
+        """
+        def run():
+            start = perf_counter()
+            with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="warmup") as executor:
+                futures = {name: executor.submit(self.get, name) for name in self._eager}
+            for name, future in futures.items():
+                if future.exception() is not None:
+                    logger.error(f"Failed to initialize {name}: {future.exception()}")
+            logger.info("Warmup finished in %.3fs, component timings: %s", perf_counter() - start,
+                        {name: round(t, 3) for name, t in sorted(self.timings.items(), key=lambda item: -item[1])})
+        threading.Thread(target=run, daemon=True).start()
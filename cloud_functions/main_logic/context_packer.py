@@ -0,0 +1,109 @@
+import re
+from typing import Dict, List, Sequence, Set, Tuple
+
+from langchain.schema import Document
+
+from utils import logger
+
+# process-wide counters, reported in the logs on every packed context
+context_stats = {"contexts": 0, "source_tokens": 0, "prompt_tokens": 0, "duplicate_sentences": 0, "trimmed_sentences": 0}
+
+# tokens of the 'stuff' prompt template around the documents and the question
+PROMPT_OVERHEAD_TOKENS = 60
+_SENTENCE_BREAK = re.compile(r"(?<=[.!?])\s+|\n+")
+_WORD = re.compile(r"\w+")
+
+
+def estimate_tokens(text: str, chars_per_token: float = 4.0) -> int:
+    """rough token count, PaLM averages about four characters per token on English text"""
+    return int(len(text) / chars_per_token) + 1
+
+
+def _shingles(words: List[str], n: int = 3) -> Set[Tuple[str, ...]]:
+    if len(words) < n:
+        return {tuple(words)}
+    return {tuple(words[i:i + n]) for i in range(len(words) - n + 1)}
+
+
+class ContextPacker:
+    """Packs reranked documents into the QA prompt under a token budget.
+
+    Documents are taken by relevance score and split into sentences. A sentence is dropped
+    when dedup_threshold of its word 3-grams already appear in one packed sentence, which
+    removes repeated boilerplate and the overlap between neighbouring chunks of a page. A
+    document that no longer fits is cut down to the sentences sharing the most words with
+    the question, kept in their original order.
+    """
+
+    def __init__(self, token_budget: int = 2000, max_documents: int = 10, dedup_threshold: float = 0.8,
+                 chars_per_token: float = 4.0):
+        self.token_budget = token_budget
+        self.max_documents = max_documents
+        self.dedup_threshold = dedup_threshold
+        self.chars_per_token = chars_per_token
+
+    def _tokens(self, text: str) -> int:
+        return estimate_tokens(text, self.chars_per_token)
+
+    def _is_duplicate(self, shingles: Set[Tuple[str, ...]], packed: List[Set[Tuple[str, ...]]]) -> bool:
+        return any(len(shingles & other) >= self.dedup_threshold * len(shingles) for other in packed)
+
+    def _trim(self, sentences: List[Tuple], query_words: Set[str], budget: int) -> List[Tuple]:
+        """the sentences most relevant to the question that fit the budget, in document order"""
+        by_relevance = sorted(range(len(sentences)), key=lambda i: -len(query_words.intersection(sentences[i][1])))
+        chosen, used = set(), 0
+        for i in by_relevance:
+            tokens = self._tokens(sentences[i][0])
+            if used + tokens <= budget:
+                chosen.add(i)
+                used += tokens
+        return [sentences[i] for i in sorted(chosen)]
+
+    def pack(self, documents: Sequence[Document], query: str) -> Tuple[List[Document], Dict]:
+        """selects and compresses the documents sent to the QA chain
+
+        Args:
+            documents (Sequence[Document]): reranked documents, with metadata['relevance_score'] when Cohere scored them
+            query (str): the question sent via chatbot
+
+        Returns:
+            Tuple[List[Document], Dict]: packed documents and packing stats, prompt_tokens being the estimated prompt size
+        """
+        query_words = {word for word in _WORD.findall(query.lower()) if len(word) > 2}
+        budget = self.token_budget - PROMPT_OVERHEAD_TOKENS - self._tokens(query)
+        ranked = sorted(documents, key=lambda doc: doc.metadata.get('relevance_score') or 0.0, reverse=True)
+        stats = {'documents': 0, 'source_tokens': 0, 'prompt_tokens': 0, 'duplicate_sentences': 0, 'trimmed_sentences': 0}
+        packed_docs, packed_shingles = [], []
+        for doc in ranked[:self.max_documents]:
+            stats['source_tokens'] += self._tokens(doc.page_content)
+            if budget <= 0:
+                continue
+            sentences = []
+            for sentence in _SENTENCE_BREAK.split(doc.page_content):
+                words = _WORD.findall(sentence.lower())
+                if not words:
+                    continue
+                shingles = _shingles(words)
+                # checked against the packed documents and the earlier sentences of this one
+                if self._is_duplicate(shingles, packed_shingles) or self._is_duplicate(shingles, [s[2] for s in sentences]):
+                    stats['duplicate_sentences'] += 1
+                    continue
+                sentences.append((sentence.strip(), words, shingles))
+            if sum(self._tokens(sentence) for sentence, _, _ in sentences) > budget:
+                kept = self._trim(sentences, query_words, budget)
+                stats['trimmed_sentences'] += len(sentences) - len(kept)
+                sentences = kept
+            if not sentences:
+                continue
+            packed_shingles.extend(shingles for _, _, shingles in sentences)
+            content = " ".join(sentence for sentence, _, _ in sentences)
+            budget -= self._tokens(content)
+            stats['documents'] += 1
+            packed_docs.append(Document(page_content=content, metadata=doc.metadata))
+
+        stats['prompt_tokens'] = self.token_budget - budget
+        for key in ('source_tokens', 'prompt_tokens', 'duplicate_sentences', 'trimmed_sentences'):
+            context_stats[key] += stats[key]
+        context_stats['contexts'] += 1
+        logger.info("Packed context: %s, stats: %s", stats, context_stats)
+        return packed_docs, stats
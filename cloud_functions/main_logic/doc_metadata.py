@@ -0,0 +1,117 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from langchain.schema import Document
+
+from rerank_cache import document_id
+from utils import logger
+
+# process-wide counters, reported in the logs on every prepared result list
+doc_metadata_stats = {"memory_hits": 0, "built": 0, "missing": 0, "duplicates": 0}
+
+_TRACKING_PARAMS = ("utm_", "fbclid", "gclid")
+
+
+class DocMeta(NamedTuple):
+    title: str
+    url: str
+
+
+def canonicalize_url(url: str) -> str:
+    """dedup key of a result url: lowercased scheme and host, no default port, fragment,
+    tracking parameters or trailing slash, and sorted query parameters
+
+    Args:
+        url (str): url from the document metadata
+
+    Returns:
+        str: canonical url
+    """
+    parts = urlsplit(url.strip())
+    host = parts.hostname or ''
+    if parts.port and (parts.scheme, parts.port) not in (('http', 80), ('https', 443)):
+        host = f"{host}:{parts.port}"
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if not k.startswith(_TRACKING_PARAMS))
+    return urlunsplit((parts.scheme.lower(), host, parts.path.rstrip('/'), urlencode(query), ''))
+
+
+class DocMetadataIndex:
+    """Prepared (title, url) of indexed documents, keyed by document id.
+
+    Entries are built from the Document metadata whenever it has title and url, and kept
+    in an in-memory LRU, so documents that come back without them (e.g. from the local
+    index) are still described. Results are deduplicated on canonical urls with
+    an ordered dict instead of a scan of the list built so far.
+    """
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self._memory: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, doc_id: str, meta: DocMeta) -> None:
+        with self._lock:
+            self._memory[doc_id] = meta
+            self._memory.move_to_end(doc_id)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def _from_memory(self, doc_ids: List[str]) -> Dict[str, DocMeta]:
+        found = {}
+        with self._lock:
+            for doc_id in doc_ids:
+                meta = self._memory.get(doc_id)
+                if meta is not None:
+                    self._memory.move_to_end(doc_id)
+                    found[doc_id] = meta
+        return found
+
+    def describe(self, docs: Sequence[Document]) -> List[Tuple[str, Optional[DocMeta]]]:
+        """(doc_id, metadata) of every document in order, None when it cannot be described
+
+        Args:
+            docs (Sequence[Document]): reranked documents
+
+        Returns:
+            List[Tuple[str, Optional[DocMeta]]]: prepared metadata per document
+        """
+        doc_ids = [document_id(doc) for doc in docs]
+        # the Document metadata is the freshest description, the cache only fills the gaps
+        built = {}
+        for doc_id, doc in zip(doc_ids, docs):
+            title, url = doc.metadata.get('title'), doc.metadata.get('url')
+            if title and url and doc_id not in built:
+                built[doc_id] = DocMeta(title, url)
+        missing = [doc_id for doc_id in dict.fromkeys(doc_ids) if doc_id not in built]
+        found = self._from_memory(missing)
+        doc_metadata_stats["memory_hits"] += len(found)
+        doc_metadata_stats["missing"] += len(missing) - len(found)
+        doc_metadata_stats["built"] += len(built)
+        for doc_id, meta in built.items():
+            self._remember(doc_id, meta)
+        found.update(built)
+        return [(doc_id, found.get(doc_id)) for doc_id in doc_ids]
+
+    def search_output(self, docs: Sequence[Document]) -> List[Tuple[str, str]]:
+        """(title, url) of the documents in order, one per canonical url
+
+        Args:
+            docs (Sequence[Document]): reranked documents
+
+        Returns:
+            List[Tuple[str, str]]: deduplicated results
+        """
+        results: OrderedDict = OrderedDict()
+        for doc_id, meta in self.describe(docs):
+            if meta is None:
+                logger.error(f"No title and url for document with ID {doc_id}, left out of the results")
+                continue
+            key = canonicalize_url(meta.url)
+            if key in results:
+                doc_metadata_stats["duplicates"] += 1
+                continue
+            results[key] = (meta.title, meta.url)
+        logger.info("Document metadata stats: %s", doc_metadata_stats)
+        return list(results.values())
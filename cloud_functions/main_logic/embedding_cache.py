@@ -0,0 +1,93 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+import redis
+from langchain.embeddings.base import Embeddings
+
+from answer_cache import normalize_query
+from utils import logger
+
+# process-wide hit/miss counters, reported in the logs on every miss
+embedding_cache_stats = {"memory_hits": 0, "redis_hits": 0, "misses": 0}
+
+
+class CachedEmbeddings(Embeddings):
+    """Caches query embeddings of another Embeddings object.
+
+    Queries are keyed by normalized text and model name. An in-memory LRU serves repeats on
+    a warm instance, Redis shares them across instances as raw float16 or float32 bytes
+    (1.5KB or 3KB per 768-dim gecko vector instead of ~15KB of JSON). Document embeddings
+    are passed through, they are only computed when indexing.
+    """
+
+    def __init__(self, embeddings: Embeddings, model_name: str, redis_client: Optional[redis.Redis] = None,
+                 ttl: int = 7 * 86400, max_entries: int = 1024, dtype: str = "float16",
+                 prefix: str = "slackbot_embeddings"):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.r = redis_client
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.dtype = np.dtype(dtype)
+        self.prefix = prefix
+        self._memory: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, text: str) -> str:
+        digest = hashlib.sha1(normalize_query(text).encode("utf-8")).hexdigest()
+        # the dtype is part of the key so changing it never misreads stored bytes
+        return f"{self.prefix}:{self.model_name}:{self.dtype.name}:{digest}"
+
+    def _remember(self, key: str, embedding: List[float]) -> None:
+        with self._lock:
+            self._memory[key] = embedding
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def embed_query(self, text: str) -> List[float]:
+        """returns the cached query embedding, computing and storing it on a miss
+
+        Args:
+            text (str): query text
+
+        Returns:
+            List[float]: query embedding
+        """
+        key = self._key(text)
+        with self._lock:
+            embedding = self._memory.get(key)
+            if embedding is not None:
+                self._memory.move_to_end(key)
+        if embedding is not None:
+            embedding_cache_stats["memory_hits"] += 1
+            return embedding
+
+        if self.r is not None:
+            try:
+                stored = self.r.get(key)
+            except redis.exceptions.RedisError as e:
+                logger.error(f"Embedding cache lookup failed: {e}")
+                stored = None
+            if stored is not None:
+                embedding = np.frombuffer(stored, dtype=self.dtype).astype(np.float32).tolist()
+                self._remember(key, embedding)
+                embedding_cache_stats["redis_hits"] += 1
+                return embedding
+
+        embedding = self.embeddings.embed_query(text)
+        embedding_cache_stats["misses"] += 1
+        logger.info("Embedding cache miss for model %s, stats: %s", self.model_name, embedding_cache_stats)
+        self._remember(key, embedding)
+        if self.r is not None:
+            try:
+                self.r.set(key, np.asarray(embedding, dtype=self.dtype).tobytes(), ex=self.ttl)
+            except redis.exceptions.RedisError as e:
+                logger.error(f"Embedding cache store failed: {e}")
+        return embedding
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
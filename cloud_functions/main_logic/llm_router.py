@@ -0,0 +1,138 @@
+import contextvars
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from time import perf_counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from langchain.schema import Document
+
+from tracing import span
+from utils import logger
+
+FAST = "fast"
+SLOW = "slow"
+
+# process-wide counters, reported in the logs on every routed question
+llm_stats = {"queries": 0, "fast_calls": 0, "slow_calls": 0, "fast_ms": 0.0, "slow_ms": 0.0, "routed_slow": 0,
+             "escalated_deadline": 0, "escalated_empty": 0, "hedged": 0, "hedge_slow_wins": 0, "timeouts": 0}
+# calls finish in the pool threads, concurrently with the request threads
+_stats_lock = threading.Lock()
+
+
+def _count(key: str, value: float = 1) -> None:
+    with _stats_lock:
+        llm_stats[key] += value
+
+
+def report() -> Dict[str, float]:
+    """llm_stats plus the escalation rate and mean latency per tier"""
+    with _stats_lock:
+        stats = dict(llm_stats)
+    queries = max(stats["queries"], 1)
+    escalated = stats["escalated_deadline"] + stats["escalated_empty"]
+    return {**stats, "escalation_rate": round(escalated / queries, 3),
+            "mean_fast_ms": round(stats["fast_ms"] / max(stats["fast_calls"], 1), 1),
+            "mean_slow_ms": round(stats["slow_ms"] / max(stats["slow_calls"], 1), 1)}
+
+
+class LLMRouter:
+    """Answers with a fast model under a deadline and escalates to the larger one when needed.
+
+    Hard questions (weak rerank evidence or a long question) go to the slow model directly.
+    The others go to the fast model; when it misses fast_deadline or returns an empty
+    answer the slow model is asked instead. With hedge_delay set, the slow model is
+    started alongside a fast call that has not answered after hedge_delay seconds and the
+    first non-empty answer wins. Calls past their deadline are abandoned, not cancelled:
+    they finish in the pool and their answer is dropped.
+    """
+
+    def __init__(self, fast_chain, slow_chain, fast_deadline: float = 8.0, slow_deadline: float = 30.0,
+                 hedge_delay: Optional[float] = None, hard_min_score: float = 0.3, hard_query_words: int = 40,
+                 max_workers: int = 32):
+        self.chains = {FAST: fast_chain, SLOW: slow_chain}
+        self.deadlines = {FAST: fast_deadline, SLOW: slow_deadline}
+        self.hedge_delay = hedge_delay
+        self.hard_min_score = hard_min_score
+        self.hard_query_words = hard_query_words
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def is_hard(self, query: str, docs: Sequence[Document]) -> bool:
+        """weak rerank evidence or a long question need the larger model"""
+        if len(query.split()) > self.hard_query_words:
+            return True
+        top_score = docs[0].metadata.get('relevance_score') if docs else None
+        return top_score is not None and top_score < self.hard_min_score
+
+    def _call(self, tier: str, context: List[Document], query: str) -> Dict:
+        start = perf_counter()
+        with span("llm_call", tier=tier):
+            response = self.chains[tier]({"input_documents": context, "question": query}, return_only_outputs=True)
+        _count(f"{tier}_calls")
+        _count(f"{tier}_ms", (perf_counter() - start) * 1000)
+        return response
+
+    def _submit(self, tier: str, context: List[Document], query: str) -> Future:
+        # carries the trace into the pool thread
+        return self.executor.submit(contextvars.copy_context().run, self._call, tier, context, query)
+
+    @staticmethod
+    def _answered(future: Future) -> bool:
+        return future.done() and future.exception() is None and bool(future.result().get('output_text', '').strip())
+
+    def _fast_then_slow(self, context: List[Document], query: str) -> Tuple[Dict, str]:
+        fast = self._submit(FAST, context, query)
+        wait([fast], timeout=self.hedge_delay if self.hedge_delay is not None else self.deadlines[FAST])
+        if self._answered(fast):
+            return fast.result(), FAST
+        # an empty or failed fast answer
+        if fast.done():
+            _count("escalated_empty")
+            return self._slow(context, query), SLOW
+
+        if self.hedge_delay is None:
+            _count("escalated_deadline")
+            return self._slow(context, query), SLOW
+        # hedge: race the slow model against the still running fast call
+        _count("hedged")
+        slow = self._submit(SLOW, context, query)
+        pending = {fast, slow}
+        start = perf_counter()
+        while pending:
+            done, pending = wait(pending, timeout=self.deadlines[SLOW] - (perf_counter() - start), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if self._answered(future):
+                    tier = FAST if future is fast else SLOW
+                    _count("hedge_slow_wins", tier == SLOW)
+                    return future.result(), tier
+        _count("timeouts")
+        return {"output_text": ""}, SLOW
+
+    def _slow(self, context: List[Document], query: str) -> Dict:
+        slow = self._submit(SLOW, context, query)
+        done, _ = wait([slow], timeout=self.deadlines[SLOW])
+        if not done:
+            _count("timeouts")
+            return {"output_text": ""}
+        return slow.result()
+
+    def answer(self, context: List[Document], query: str, docs: Sequence[Document]) -> Tuple[Dict, str]:
+        """answers the question from the packed context
+
+        Args:
+            context (List[Document]): input documents of the QA chain
+            query (str): the question sent via chatbot
+            docs (Sequence[Document]): reranked documents, their relevance scores judge how hard the question is
+
+        Returns:
+            Tuple[Dict, str]: chain output and the tier that answered, "fast" or "slow"
+        """
+        _count("queries")
+        if self.is_hard(query, docs):
+            _count("routed_slow")
+            response, tier = self._slow(context, query), SLOW
+        else:
+            response, tier = self._fast_then_slow(context, query)
+        logger.info("LLM answered by the %s tier, stats: %s", tier, report())
+        return response, tier
@@ -0,0 +1,191 @@
+import json
+import os
+import sys
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+from langchain.schema import Document
+
+from utils import logger
+
+# namespaces smaller than this are searched exhaustively, larger ones through the IVF lists
+IVF_MIN_ROWS = 20000
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+def _kmeans(vectors: np.ndarray, n_lists: int, iterations: int = 10, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """spherical k-means used to build the IVF lists, returns (centroids, assignments)"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        for i in range(n_lists):
+            members = vectors[assignments == i]
+            if len(members):
+                centroids[i] = members.mean(axis=0)
+        centroids = _normalize(centroids)
+    return centroids, np.argmax(vectors @ centroids.T, axis=1).astype(np.int32)
+
+
+def export_snapshot(path: str, records: Iterable[Tuple[str, str, Dict, Dict[str, List[str]]]],
+                    embeddings: Embeddings, batch_size: int = 250) -> int:
+    """writes a snapshot that LocalVectorStore can memory-map
+
+    The snapshot holds vectors.f32 (normalized float32 rows), documents.jsonl (id, text,
+    metadata and namespace tokens per row), manifest.json and, for large snapshots,
+    centroids.f32/lists.i32 for IVF search.
+
+    Args:
+        path (str): output directory
+        records (Iterable[Tuple[str, str, Dict, Dict[str, List[str]]]]): (doc_id, page_content, metadata, namespaces)
+        embeddings (Embeddings): the embedding model the Matching Engine index was built with
+        batch_size (int): texts per embedding call
+
+    Returns:
+        int: number of exported documents
+    """
+    os.makedirs(path, exist_ok=True)
+    records = list(records)
+    vectors = np.memmap(os.path.join(path, "vectors.f32"), dtype=np.float32, mode="w+",
+                        shape=(len(records), len(embeddings.embed_query("dimension probe"))))
+    with open(os.path.join(path, "documents.jsonl"), "w") as f:
+        for start in range(0, len(records), batch_size):
+            batch = records[start:start + batch_size]
+            vectors[start:start + len(batch)] = _normalize(np.asarray(embeddings.embed_documents([r[1] for r in batch]), dtype=np.float32))
+            for doc_id, page_content, metadata, namespaces in batch:
+                f.write(json.dumps({"id": doc_id, "page_content": page_content, "metadata": metadata, "namespaces": namespaces}) + "\n")
+    vectors.flush()
+
+    n_lists = 0
+    if len(records) >= IVF_MIN_ROWS:
+        n_lists = int(np.sqrt(len(records)))
+        centroids, assignments = _kmeans(np.asarray(vectors), n_lists)
+        centroids.astype(np.float32).tofile(os.path.join(path, "centroids.f32"))
+        assignments.tofile(os.path.join(path, "lists.i32"))
+    with open(os.path.join(path, "manifest.json"), "w") as f:
+        json.dump({"count": len(records), "dim": vectors.shape[1], "n_lists": n_lists}, f)
+    logger.info("Exported %d documents to %s", len(records), path)
+    return len(records)
+
+
+class LocalVectorStore:
+    """In-process replica of the Matching Engine index loaded from an exported snapshot.
+
+    Serves the similarity_search / similarity_search_with_score calls main_logic makes,
+    including the Namespace restricts, over a memory-mapped float32 matrix.
+    """
+
+    def __init__(self, path: str, embedding: Embeddings, n_probe: int = 8):
+        with open(os.path.join(path, "manifest.json")) as f:
+            manifest = json.load(f)
+        self.embedding = embedding
+        self.n_probe = n_probe
+        self.vectors = np.memmap(os.path.join(path, "vectors.f32"), dtype=np.float32, mode="r",
+                                 shape=(manifest["count"], manifest["dim"]))
+        self.documents = []
+        # namespace name -> token -> row indices
+        self.namespace_rows: Dict[str, Dict[str, np.ndarray]] = defaultdict(dict)
+        tokens = defaultdict(lambda: defaultdict(list))
+        with open(os.path.join(path, "documents.jsonl")) as f:
+            for row, line in enumerate(f):
+                record = json.loads(line)
+                self.documents.append((record["page_content"], {**record["metadata"], "id": record["id"]}))
+                for name, values in record["namespaces"].items():
+                    for token in values:
+                        tokens[name][token].append(row)
+        for name, by_token in tokens.items():
+            for token, rows in by_token.items():
+                self.namespace_rows[name][token] = np.asarray(rows, dtype=np.int64)
+
+        self.centroids, self.lists = None, None
+        if manifest.get("n_lists"):
+            self.centroids = np.fromfile(os.path.join(path, "centroids.f32"), dtype=np.float32).reshape(manifest["n_lists"], -1)
+            self.lists = np.fromfile(os.path.join(path, "lists.i32"), dtype=np.int32)
+        logger.info("Loaded local index with %d documents from %s", manifest["count"], path)
+
+    def _candidate_rows(self, filter: Optional[List]) -> Optional[np.ndarray]:
+        """applies Matching Engine Namespace restricts, None means every row"""
+        rows = None
+        for namespace in filter or []:
+            by_token = self.namespace_rows.get(namespace.name, {})
+            if namespace.allow_tokens:
+                allowed = [by_token[t] for t in namespace.allow_tokens if t in by_token]
+                allowed = np.unique(np.concatenate(allowed)) if allowed else np.empty(0, dtype=np.int64)
+                rows = allowed if rows is None else np.intersect1d(rows, allowed)
+            if namespace.deny_tokens:
+                denied = [by_token[t] for t in namespace.deny_tokens if t in by_token]
+                if denied:
+                    base = np.arange(len(self.documents)) if rows is None else rows
+                    rows = np.setdiff1d(base, np.concatenate(denied))
+        return rows
+
+    def has_namespace(self, filter: Optional[List]) -> bool:
+        """whether the snapshot holds any document for the restricts"""
+        rows = self._candidate_rows(filter)
+        return rows is None or len(rows) > 0
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter: Optional[List] = None) -> List[Tuple[Document, float]]:
+        """cosine similarity search within the namespace restricts
+
+        Args:
+            query (str): the question sent via chatbot
+            k (int): number of neighbours to return
+            filter (Optional[List]): Matching Engine Namespace restricts
+
+        Returns:
+            List[Tuple[Document, float]]: documents with their cosine similarity, best first
+        """
+        query_vec = _normalize(np.asarray(self.embedding.embed_query(query), dtype=np.float32))
+        rows = self._candidate_rows(filter)
+        n_candidates = len(self.documents) if rows is None else len(rows)
+        if self.centroids is not None and n_candidates >= IVF_MIN_ROWS:
+            probed = np.argsort(-(self.centroids @ query_vec))[:self.n_probe]
+            in_lists = np.flatnonzero(np.isin(self.lists, probed))
+            rows = in_lists if rows is None else np.intersect1d(rows, in_lists)
+        if rows is None:
+            scores = np.asarray(self.vectors @ query_vec)
+            rows = np.arange(len(scores))
+        else:
+            scores = np.asarray(self.vectors[rows] @ query_vec)
+        top = np.argsort(-scores)[:k]
+        return [(Document(page_content=self.documents[rows[i]][0], metadata=dict(self.documents[rows[i]][1])), float(scores[i]))
+                for i in top]
+
+    def similarity_search(self, query: str, k: int = 4, filter: Optional[List] = None) -> List[Document]:
+        """same as similarity_search_with_score without the scores"""
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k, filter=filter)]
+
+
+def export_from_firestore(path: str, collection_name: str, embeddings: Embeddings, namespace_field: str = "user_id") -> int:
+    """exports the Firestore-backed documents of the Matching Engine index into a snapshot
+
+    Args:
+        path (str): output directory
+        collection_name (str): firestore collection the vector store reads documents from
+        embeddings (Embeddings): the embedding model the index was built with
+        namespace_field (str): metadata field holding the token of the "ids" namespace
+
+    Returns:
+        int: number of exported documents
+    """
+    from google.cloud import firestore
+
+    def records():
+        for snapshot in firestore.Client().collection(collection_name).stream():
+            data = snapshot.to_dict()
+            metadata = data.get("metadata", {})
+            yield snapshot.id, data.get("page_content", ""), metadata, {"ids": [str(metadata.get(namespace_field, ""))]}
+
+    return export_snapshot(path, records(), embeddings)
+
+
+if __name__ == "__main__":
+    # python local_index.py <output_dir> <firestore_collection> [namespace_field]
+    from langchain.embeddings import VertexAIEmbeddings
+    export_from_firestore(sys.argv[1], sys.argv[2], VertexAIEmbeddings(), *sys.argv[3:4])
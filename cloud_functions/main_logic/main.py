@@ -1,16 +1,20 @@
 import os
 import json
 import requests
+import queue
+from functools import partial
 import cohere
+import redis
 from google.cloud import aiplatform
 from google.cloud import firestore
 from flask import Response
+from flask import stream_with_context
 from flask import jsonify
 from urllib.parse import parse_qs
+from concurrent.futures import ThreadPoolExecutor
 from vertexai.preview.language_models import TextEmbeddingModel
 
 # langchain imports
-from langchain.retrievers import ContextualCompressionRetriever
 from langchain.retrievers.document_compressors import CohereRerank
 from langchain.prompts import PromptTemplate
 from langchain.llms import VertexAI
@@ -19,56 +23,395 @@ from langchain.embeddings import VertexAIEmbeddings
 from langchain.vectorstores.matching_engine import MatchingEngine
 from langchain.chains import RetrievalQA
 from langchain.chains.question_answering import load_qa_chain
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.schema import Document
 from google.cloud.aiplatform.matching_engine.matching_engine_index_endpoint import Namespace
 
 from utils import read_secret, logger
+from answer_cache import AnswerCache
+from embedding_cache import CachedEmbeddings
+from rerank_cache import RerankLayer
+from components import LazyComponents
+from context_packer import ContextPacker, estimate_tokens
+from doc_metadata import DocMetadataIndex
+from llm_router import LLMRouter
+from local_index import LocalVectorStore
+from tracing import set_trace, span
 
 
-from grpc import _InactiveRpcError
-from typing import Dict, List, Tuple
+from grpc._channel import _InactiveRpcError
+from typing import Dict, Iterator, List, Optional, Tuple
 # Load environment variables
 
 project_id = os.environ['project_id']
 
-# read secrets
-COHERE_API_KEY = read_secret('COHERE_API_KEY', project_id)
-matching_engine_proj = read_secret('MATCHING_ENGINE_PROJ', project_id)
-deployed_index_id = read_secret('VECTORDB_INDEX_ID', project_id)
-vector_endpoint_id = read_secret('VECTORDB_ENDPOINT_ID')
-firestore_collection = read_secret("FIRESTORE_COLLECTION_NAME")
+components = LazyComponents()
+
+EMBEDDING_MODEL = "textembedding-gecko@001"
+
+# read secrets, each one is a component so they are fetched in parallel
+for secret_id in ('COHERE_API_KEY', 'MATCHING_ENGINE_PROJ', 'VECTORDB_INDEX_ID', 'VECTORDB_ENDPOINT_ID',
+                  'FIRESTORE_COLLECTION_NAME', 'REDIS_HOST', 'REDIS_PORT', 'REDIS_PASS'):
+    components.register(secret_id)(partial(read_secret, secret_id, project_id))
+
+
+# Initialize AIPlatform
+@components.register('aiplatform')
+def _init_aiplatform():
+    aiplatform.init(project=project_id, location="us-central1")
 
 
 # Initialize Cohere
-os.environ["COHERE_API_KEY"] = COHERE_API_KEY
-co = cohere.Client(COHERE_API_KEY)
+@components.register('cohere')
+def _init_cohere():
+    os.environ["COHERE_API_KEY"] = components.get('COHERE_API_KEY')
+    return cohere.Client(os.environ["COHERE_API_KEY"])
+
+
+# Initialize PaLM embedding, only needed on demand
+@components.register('PaLM_embedding', eager=False)
+def _init_palm_embedding():
+    components.get('aiplatform')
+    return TextEmbeddingModel.from_pretrained(EMBEDDING_MODEL)
+
+
+@components.register('langchain_PaLM_embeddings')
+def _init_langchain_embeddings():
+    components.get('aiplatform')
+    return VertexAIEmbeddings()
+
+
+@components.register('PaLM_llm')
+def _init_llm():
+    components.get('aiplatform')
+    return VertexAI()
+
+
+# init HyDE, only needed on demand
+@components.register('HyDE', eager=False)
+def _init_hyde():
+    return HypotheticalDocumentEmbedder.from_llm(components.get('PaLM_llm'), components.get('langchain_PaLM_embeddings'), "web_search")
+
+
+# Redis client shared by the caches
+@components.register('redis')
+def _init_redis():
+    return redis.Redis(host=components.get('REDIS_HOST'),
+                       port=components.get('REDIS_PORT'),
+                       password=components.get('REDIS_PASS'))
+
 
-# Initialize PaLM embedding
-PaLM_embedding = TextEmbeddingModel.from_pretrained("textembedding-gecko@001")
-langchain_PaLM_embeddings = VertexAIEmbeddings()
+# query embedding cache, see embedding_cache.py
+embedding_cache_enabled = os.environ.get('EMBEDDING_CACHE_ENABLED', 'true') == 'true'
+# 'palm' embeds the query itself, 'hyde' embeds an LLM-written hypothetical answer
+query_embedder = os.environ.get('QUERY_EMBEDDER', 'palm')
+
+
+def _cached_embeddings(embeddings, model_name: str):
+    if not embedding_cache_enabled:
+        return embeddings
+    return CachedEmbeddings(embeddings, model_name, components.get('redis'),
+                            ttl=int(os.environ.get('EMBEDDING_CACHE_TTL', 7 * 86400)),
+                            max_entries=int(os.environ.get('EMBEDDING_CACHE_MAX_ENTRIES', 1024)),
+                            dtype=os.environ.get('EMBEDDING_CACHE_DTYPE', 'float16'))
+
+
+@components.register('cached_PaLM_embeddings')
+def _init_cached_embeddings():
+    return _cached_embeddings(components.get('langchain_PaLM_embeddings'), EMBEDDING_MODEL)
+
+
+# embeddings the vector stores embed queries with
+@components.register('query_embeddings')
+def _init_query_embeddings():
+    if query_embedder == 'hyde':
+        return _cached_embeddings(components.get('HyDE'), f"hyde-web_search-{EMBEDDING_MODEL}")
+    return components.get('cached_PaLM_embeddings')
 
-# init HyDE
-PaLM_llm = VertexAI()
-HyDE = HypotheticalDocumentEmbedder.from_llm(PaLM_llm, langchain_PaLM_embeddings, "web_search")
 
 # init langchain vector store
-vector_store = MatchingEngine.from_components(
-    project_id=matching_engine_proj,
-    region="us-central1",
-    index_id=deployed_index_id,
-    endpoint_id=vector_endpoint_id,
-    firestore_collection_name=firestore_collection,
-    embedding=langchain_PaLM_embeddings
-)
+@components.register('vector_store')
+def _init_vector_store():
+    return MatchingEngine.from_components(
+        project_id=components.get('MATCHING_ENGINE_PROJ'),
+        region="us-central1",
+        index_id=components.get('VECTORDB_INDEX_ID'),
+        endpoint_id=components.get('VECTORDB_ENDPOINT_ID'),
+        firestore_collection_name=components.get('FIRESTORE_COLLECTION_NAME'),
+        embedding=components.get('query_embeddings')
+    )
+
 
 # init rerank compressor
-compressor = CohereRerank(top_n=10)
+@components.register('compressor')
+def _init_compressor():
+    components.get('cohere')
+    return CohereRerank(top_n=10)
+
+
+# rerank behind the ranking cache, see rerank_cache.py
+@components.register('reranker')
+def _init_reranker():
+    skip_margin = os.environ.get('RERANK_SKIP_MARGIN')
+    return RerankLayer(components.get('compressor'),
+                       components.get('redis') if os.environ.get('RERANK_CACHE_ENABLED', 'true') == 'true' else None,
+                       ttl=int(os.environ.get('RERANK_CACHE_TTL', 86400)),
+                       skip_margin=float(skip_margin) if skip_margin else None)
+
 
 # init question answering chain
-QAchain = load_qa_chain(PaLM_llm, chain_type='stuff')
+@components.register('QAchain')
+def _init_qa_chain():
+    return load_qa_chain(components.get('PaLM_llm'), chain_type='stuff')
 
 
-# Initialize AIPlatform
-aiplatform.init(project=project_id, location="us-central1")
+# fast/slow model tiers, see llm_router.py; off unless LLM_ROUTING=true, every question then goes to PaLM_llm
+llm_routing = os.environ.get('LLM_ROUTING', 'false') == 'true'
+
+
+@components.register('llm_router', eager=llm_routing)
+def _init_llm_router():
+    components.get('aiplatform')
+    hedge_delay = os.environ.get('LLM_HEDGE_DELAY')
+    slow_llm = VertexAI(model_name=os.environ.get('LLM_SLOW_MODEL', 'text-unicorn@001'))
+    return LLMRouter(components.get('QAchain'), load_qa_chain(slow_llm, chain_type='stuff'),
+                     fast_deadline=float(os.environ.get('LLM_FAST_DEADLINE', 8)),
+                     slow_deadline=float(os.environ.get('LLM_SLOW_DEADLINE', 30)),
+                     hedge_delay=float(hedge_delay) if hedge_delay else None,
+                     hard_min_score=float(os.environ.get('LLM_HARD_MIN_SCORE', 0.3)),
+                     hard_query_words=int(os.environ.get('LLM_HARD_QUERY_WORDS', 40)),
+                     max_workers=int(os.environ.get('LLM_ROUTER_WORKERS', 32)))
+
+
+# packs the reranked documents into the prompt, see context_packer.py; opt-in until
+# benchmarks/context_packing.py shows answer parity, otherwise the top 3 documents are sent whole
+context_packing = os.environ.get('CONTEXT_PACKING', 'false') == 'true'
+
+
+@components.register('context_packer')
+def _init_context_packer():
+    return ContextPacker(token_budget=int(os.environ.get('CONTEXT_TOKEN_BUDGET', 2000)),
+                         max_documents=int(os.environ.get('CONTEXT_MAX_DOCUMENTS', 10)),
+                         dedup_threshold=float(os.environ.get('CONTEXT_DEDUP_THRESHOLD', 0.8)))
+
+
+# streaming chain for search_stream, falls back to the regular LLM on langchain versions without VertexAI streaming
+@components.register('QAchain_stream', eager=False)
+def _init_qa_chain_stream():
+    components.get('aiplatform')
+    try:
+        stream_llm = VertexAI(streaming=True)
+    except ValueError:
+        stream_llm = components.get('PaLM_llm')
+    return load_qa_chain(stream_llm, chain_type='stuff')
+
+
+# in-process replica of the index loaded from an exported snapshot, see local_index.py
+# 'off', 'fallback' (used when Matching Engine is unavailable) or 'primary'
+local_index_mode = os.environ.get('LOCAL_INDEX_MODE', 'off')
+
+
+@components.register('local_index', eager=local_index_mode != 'off')
+def _init_local_index():
+    if local_index_mode == 'off':
+        return None
+    return LocalVectorStore(os.environ['LOCAL_INDEX_PATH'], components.get('query_embeddings'))
+
+
+# prepared (title, url) per document id, see doc_metadata.py
+@components.register('doc_metadata')
+def _init_doc_metadata():
+    return DocMetadataIndex(max_entries=int(os.environ.get('DOC_METADATA_MAX_ENTRIES', 4096)))
+
+
+# init answer cache
+@components.register('answer_cache')
+def _init_answer_cache():
+    if os.environ.get('ANSWER_CACHE_ENABLED', 'true') != 'true':
+        return None
+    return AnswerCache(
+        components.get('redis'),
+        ttl=int(os.environ.get('ANSWER_CACHE_TTL', 86400)),
+        threshold=float(os.environ.get('ANSWER_CACHE_THRESHOLD', 0.95)),
+        max_entries=int(os.environ.get('ANSWER_CACHE_MAX_ENTRIES', 50))
+    )
+
+
+# retrieval depth: 'fixed' always uses the last k step, 'adaptive' widens only when needed
+retrieval_mode = os.environ.get('RETRIEVAL_MODE', 'fixed')
+retrieval_k_steps = [int(k) for k in os.environ.get('RETRIEVAL_K_STEPS', '20,50,100').split(',')]
+rerank_min_score = float(os.environ.get('RERANK_MIN_SCORE', 0.5))
+retrieval_min_score_spread = float(os.environ.get('RETRIEVAL_MIN_SCORE_SPREAD', 0.02))
+
+# build everything in the background, requests only wait for the components they use
+components.warmup(max_workers=int(os.environ.get('INIT_WORKERS', 8)))
+
+
+class _TokenQueueHandler(BaseCallbackHandler):
+    """Forwards tokens generated by the LLM to a queue read by search_stream"""
+
+    def __init__(self, token_queue: queue.Queue):
+        self.token_queue = token_queue
+
+    def on_llm_new_token(self, token: str, **kwargs) -> None:
+        self.token_queue.put(token)
+
+
+def _local_index() -> Optional[LocalVectorStore]:
+    """the local index, None when it is off or its snapshot cannot be loaded"""
+    try:
+        return components.get('local_index')
+    except (KeyError, OSError, ValueError) as e:
+        logger.error(f"Local index unavailable: {e}")
+        return None
+
+
+def vector_search(query: str, user_id: str, k: int) -> List[Document]:
+    """Matching Engine search in the user's namespace, served from the local index in 'primary'
+    mode or when the endpoint is unavailable in 'fallback' mode. Vector scores are kept in
+    metadata['vector_score'] when the store can return them
+
+    Args:
+        query (str): the question sent via chatbot
+        user_id (str): id of the user sending the query
+        k (int): number of neighbours to retrieve
+
+    Returns:
+        List[Document]: retrieved documents
+    """
+    namespace_filter = [Namespace("ids", [user_id], [])]
+    if local_index_mode == 'primary':
+        local_index = _local_index()
+        if local_index is not None and local_index.has_namespace(namespace_filter):
+            return _scored_documents(local_index.similarity_search_with_score(query, k=k, filter=namespace_filter))
+
+    vector_store = components.get('vector_store')
+    try:
+        try:
+            scored = vector_store.similarity_search_with_score(query, k=k, filter=namespace_filter)
+        except NotImplementedError:
+            return vector_store.similarity_search(query, k=k, filter=namespace_filter)
+    except _InactiveRpcError:
+        local_index = _local_index()
+        if local_index is None:
+            raise
+        logger.info("Matching engine unavailable, likely cold start, answering from the local index")
+        scored = local_index.similarity_search_with_score(query, k=k, filter=namespace_filter)
+    return _scored_documents(scored)
+
+
+def _scored_documents(scored: List[Tuple[Document, float]]) -> List[Document]:
+    for doc, score in scored:
+        doc.metadata['vector_score'] = score
+    return [doc for doc, _ in scored]
+
+
+def _is_decisive(retrieved: List[Document], reranked: List[Document], k: int) -> bool:
+    """Decides whether widening the retrieval could still change the top results"""
+    # the namespace has fewer documents than k, a larger k returns the same set
+    if len(retrieved) < k:
+        return True
+    vector_scores = [doc.metadata['vector_score'] for doc in retrieved if 'vector_score' in doc.metadata]
+    # a flat score distribution means relevant documents may sit just past the cut-off
+    if len(vector_scores) > 1 and abs(vector_scores[0] - vector_scores[-1]) < retrieval_min_score_spread:
+        return False
+    top_relevance = reranked[0].metadata.get('relevance_score') if reranked else None
+    if top_relevance is None:
+        return len(reranked) >= 3
+    return top_relevance >= rerank_min_score and len(reranked) >= 3
+
+
+def retrieve_documents(query: str, user_id: str, adaptive: bool) -> Tuple[List[Document], Dict]:
+    """Retrieves from Matching Engine and reranks with Cohere, in adaptive mode starting with a
+    small k and widening through retrieval_k_steps until the results look decisive
+
+    Args:
+        query (str): the question sent via chatbot
+        user_id (str): id of the user sending the query
+        adaptive (bool): use adaptive depth instead of the fixed largest k
+
+    Returns:
+        Tuple[List[Document], Dict]: reranked documents and retrieval stats (final k, rounds, Cohere calls, documents sent to rerank)
+    """
+    reranker = components.get('reranker')
+    k_steps = retrieval_k_steps if adaptive else retrieval_k_steps[-1:]
+    stats = {'k': 0, 'rounds': 0, 'rerank_calls': 0, 'reranked_documents': 0, 'reranked_characters': 0}
+    for k in k_steps:
+        with span("retrieval", k=k):
+            retrieved = vector_search(query, user_id, k)
+        with span("rerank", documents=len(retrieved)) as rerank_span:
+            docs, rerank_span['outcome'] = reranker.rerank(retrieved, query)
+        stats['k'] = k
+        stats['rounds'] += 1
+        # only documents Cohere actually ranked are billed
+        if rerank_span['outcome'] == 'cohere':
+            stats['rerank_calls'] += 1
+            stats['reranked_documents'] += len(retrieved)
+            stats['reranked_characters'] += sum(len(doc.page_content) for doc in retrieved)
+        if _is_decisive(retrieved, docs, k):
+            break
+    logger.info("Retrieval stats: %s", stats)
+    return docs, stats
+
+
+def retrieve(query: str, user_id: str) -> Tuple[List[Document], List[Tuple[str, str]]]:
+    """Retrieves and reranks documents from the user's namespace
+
+    Args:
+        query (str): the question sent via chatbot
+        user_id (str): id of the user sending the query
+
+    Returns:
+        Tuple[List[Document], List[Tuple[str, str]]]: reranked documents and a deduplicated list of (title, url)
+    """
+    # Search in the index
+    docs, _ = retrieve_documents(query, user_id, retrieval_mode == 'adaptive')
+
+    # (title, url) of the results, one per canonical url
+    return docs, components.get('doc_metadata').search_output(docs)
+
+
+def build_context(docs: List[Document], query: str) -> Tuple[List[Document], int]:
+    """Documents sent to the QA chain and the estimated number of prompt tokens
+
+    Args:
+        docs (List[Document]): reranked documents
+        query (str): the question sent via chatbot
+
+    Returns:
+        Tuple[List[Document], int]: input documents of the chain and prompt tokens
+    """
+    if not context_packing:
+        docs = docs[:3]
+        return docs, estimate_tokens(query + "".join(doc.page_content for doc in docs))
+    packed, stats = components.get('context_packer').pack(docs, query)
+    return packed, stats['prompt_tokens']
+
+
+def answer_question(context: List[Document], query: str, docs: List[Document]) -> Tuple[Dict, str]:
+    """Runs the QA chain, through the fast/slow router when routing is on
+
+    Returns:
+        Tuple[Dict, str]: chain output and the tier that answered
+    """
+    if not llm_routing:
+        return components.get('QAchain')({"input_documents": context, "question": query}, return_only_outputs=True), "default"
+    return components.get('llm_router').answer(context, query, docs)
+
+
+def _lookup_answer(query: str, user_id: str) -> Tuple[Optional[Dict], Optional[List[float]]]:
+    """Serves repeat and near-duplicate questions without the rerank and LLM calls"""
+    answer_cache = components.get('answer_cache')
+    if answer_cache is None:
+        return None, None
+    return answer_cache.lookup(user_id, query, components.get('cached_PaLM_embeddings').embed_query)
+
+
+def _store_answer(query: str, user_id: str, query_embedding: Optional[List[float]], result: Dict) -> None:
+    answer_cache = components.get('answer_cache')
+    if answer_cache is not None and result['chat_response'].get('output_text'):
+        answer_cache.store(user_id, query, query_embedding, result)
+
 
 # Search with langchain
 def search(query: str, user_id: str) -> Dict[str, List[Tuple[str, str]]]:
@@ -81,34 +424,57 @@ def search(query: str, user_id: str) -> Dict[str, List[Tuple[str, str]]]:
     Returns:
         Dict[str, List[Tuple[str, str]]]: A dictionary with a summary answer and a list of references
     """
+    cached, query_embedding = _lookup_answer(query, user_id)
+    if cached is not None:
+        return cached
 
-    compression_retriever = ContextualCompressionRetriever(
-        base_compressor=compressor,
-        base_retriever=vector_store.as_retriever(search_kwargs={"k": 100,
-                                                                "filter": [Namespace("ids", [user_id], [])]}))
+    docs, search_output = retrieve(query, user_id)
+    context, prompt_tokens = build_context(docs, query)
+    with span("llm", prompt_tokens=prompt_tokens) as llm_span:
+        chat_response, llm_span['tier'] = answer_question(context, query, docs)
+
+    result = {"chat_response": chat_response, "search_output": search_output}
+    _store_answer(query, user_id, query_embedding, result)
+
+    return result
 
-    # Search in the index
-    docs = compression_retriever.get_relevant_documents(query)
-    
-    chat_response = QAchain({"input_documents": docs[:3], "question": query}, return_only_outputs=True)
-    # future streaming
-    # for c in QAchain.astream:
-    #     yield c
-    
-    # Gather a list of (page_link, excerpt) from the response
-    search_output = []
-    for item in docs:
-        try:
-            doc_id = item.metadata['id']
-            url, title = item.metadata['url'], item.metadata['title']
-            if (title, url) not in search_output:
-                search_output.append((title, url))
-            
-        except requests.exceptions.HTTPError as e:
-            logger.error(f"Error fetching document with ID {doc_id}: {e}")
-            continue
-        
-    return {"chat_response": chat_response, "search_output": search_output}
+
+def search_stream(query: str, user_id: str) -> Iterator[Dict]:
+    """Streaming variant of search: yields the references as soon as retrieval and rerank
+    finish, then the answer as it is generated
+
+    Args:
+        query (str): the question sent via chatbot
+        user_id (str): id of the user sending the query
+
+    Yields:
+        Iterator[Dict]: {"event": "search_output"}, any number of {"event": "chunk"} and a final {"event": "done"}
+    """
+    cached, query_embedding = _lookup_answer(query, user_id)
+    if cached is not None:
+        yield {"event": "search_output", "search_output": cached['search_output']}
+        yield {"event": "done", "chat_response": cached['chat_response']}
+        return
+
+    docs, search_output = retrieve(query, user_id)
+    yield {"event": "search_output", "search_output": search_output}
+
+    # run the chain in the background and forward tokens as the LLM produces them
+    token_queue = queue.Queue()
+    context, prompt_tokens = build_context(docs, query)
+    with span("llm", stream=True, prompt_tokens=prompt_tokens), ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(components.get('QAchain_stream'), {"input_documents": context, "question": query},
+                                 return_only_outputs=True, callbacks=[_TokenQueueHandler(token_queue)])
+        while not (future.done() and token_queue.empty()):
+            try:
+                yield {"event": "chunk", "text": token_queue.get(timeout=0.1)}
+            except queue.Empty:
+                continue
+        chat_response = future.result()
+
+    result = {"chat_response": chat_response, "search_output": search_output}
+    _store_answer(query, user_id, query_embedding, result)
+    yield {"event": "done", "chat_response": chat_response}
 
 
 def main(request: requests.Request) -> Tuple:
@@ -127,6 +493,21 @@ def main(request: requests.Request) -> Tuple:
     parsed_data = json.loads(rq_data)
     query = parsed_data["query"]
     user_id = parsed_data["user_id"]
+    set_trace(parsed_data.get("trace_id"))
+
+    if parsed_data.get("stream"):
+        def generate():
+            try:
+                for event in search_stream(query, user_id):
+                    yield json.dumps(event) + "\n"
+            except _InactiveRpcError:
+                logger.info("Error: Likely matching engine cold start")
+                yield json.dumps({"event": "error"}) + "\n"
+            except Exception as e:
+                # the 200 status is already sent, the error event is how handle_message learns of it
+                logger.error("Streamed search failed: %s", e)
+                yield json.dumps({"event": "error"}) + "\n"
+        return Response(stream_with_context(generate()), 200, mimetype='application/x-ndjson')
 
     try:
         search_results = search(query, user_id)
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import threading
+from concurrent.futures import Future
+from time import perf_counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import redis
+from langchain.schema import Document
+
+from answer_cache import normalize_query
+from utils import logger
+
+# process-wide counters, reported in the logs on every rerank
+rerank_stats = {"queries": 0, "cohere_calls": 0, "cache_hits": 0, "skipped": 0, "coalesced": 0, "rerank_ms": 0.0}
+
+
+def document_id(doc: Document) -> str:
+    return str(doc.metadata.get('id') or hashlib.sha1(doc.page_content.encode("utf-8")).hexdigest())
+
+
+def report() -> Dict[str, float]:
+    """rerank_stats plus Cohere calls per 1k queries and mean rerank latency"""
+    queries = max(rerank_stats["queries"], 1)
+    return {**rerank_stats, "cohere_calls_per_1k": round(1000 * rerank_stats["cohere_calls"] / queries, 1),
+            "mean_rerank_ms": round(rerank_stats["rerank_ms"] / queries, 1)}
+
+
+class RerankLayer:
+    """Cohere rerank behind a ranking cache, a decisiveness check and single-flight calls.
+
+    Rankings are cached in Redis under (normalized query, sorted doc-id set) as a list of
+    (doc_id, relevance_score). When the top vector hit leads the runner-up by skip_margin the
+    vector order is kept and Cohere is not called. Concurrent requests for the same ranking
+    share one in-flight call; Cohere reranks a single query per request, so requests for
+    different queries cannot be merged into one call.
+    """
+
+    def __init__(self, compressor, redis_client: Optional[redis.Redis] = None, ttl: int = 86400,
+                 skip_margin: Optional[float] = None, prefix: str = "slackbot_rerank"):
+        self.compressor = compressor
+        self.r = redis_client
+        self.ttl = ttl
+        self.skip_margin = skip_margin
+        self.prefix = prefix
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, query: str, documents: Sequence[Document]) -> str:
+        ids = "\n".join(sorted(document_id(doc) for doc in documents))
+        digest = hashlib.sha1(f"{normalize_query(query)}\n{ids}".encode("utf-8")).hexdigest()
+        return f"{self.prefix}:{digest}"
+
+    def _is_decisive(self, documents: Sequence[Document]) -> bool:
+        if self.skip_margin is None or len(documents) < 2:
+            return False
+        scores = [doc.metadata.get('vector_score') for doc in documents[:2]]
+        return None not in scores and abs(scores[0] - scores[1]) >= self.skip_margin
+
+    def _cached(self, key: str) -> Optional[List[Tuple[str, float]]]:
+        if self.r is None:
+            return None
+        try:
+            cached = self.r.get(key)
+        except redis.exceptions.RedisError as e:
+            logger.error(f"Rerank cache lookup failed: {e}")
+            return None
+        return json.loads(cached) if cached is not None else None
+
+    def _store(self, key: str, ranking: List[Tuple[str, float]]) -> None:
+        if self.r is None:
+            return
+        try:
+            self.r.set(key, json.dumps(ranking), ex=self.ttl)
+        except redis.exceptions.RedisError as e:
+            logger.error(f"Rerank cache store failed: {e}")
+
+    def _call_cohere(self, key: str, documents: Sequence[Document], query: str) -> List[Tuple[str, float]]:
+        reranked = self.compressor.compress_documents(documents, query)
+        rerank_stats["cohere_calls"] += 1
+        ranking = [(document_id(doc), doc.metadata.get('relevance_score')) for doc in reranked]
+        self._store(key, ranking)
+        return ranking
+
+    def rerank(self, documents: Sequence[Document], query: str) -> Tuple[List[Document], str]:
+        """reranks the retrieved documents for the query
+
+        Args:
+            documents (Sequence[Document]): documents from the vector search, best first
+            query (str): the question sent via chatbot
+
+        Returns:
+            Tuple[List[Document], str]: reranked documents and how they were ranked:
+            "cohere", "cache", "skipped" or "coalesced"
+        """
+        start = perf_counter()
+        rerank_stats["queries"] += 1
+        try:
+            if not documents:
+                return [], "skipped"
+            if self._is_decisive(documents):
+                rerank_stats["skipped"] += 1
+                return list(documents[:self.compressor.top_n]), "skipped"
+
+            key = self._key(query, documents)
+            ranking = self._cached(key)
+            if ranking is not None:
+                rerank_stats["cache_hits"] += 1
+                outcome = "cache"
+            else:
+                with self._lock:
+                    future = self._inflight.get(key)
+                    leader = future is None
+                    if leader:
+                        future = self._inflight[key] = Future()
+                if leader:
+                    try:
+                        future.set_result(self._call_cohere(key, documents, query))
+                    except Exception as e:
+                        future.set_exception(e)
+                    finally:
+                        with self._lock:
+                            del self._inflight[key]
+                    outcome = "cohere"
+                else:
+                    rerank_stats["coalesced"] += 1
+                    outcome = "coalesced"
+                ranking = future.result()
+
+            by_id = {document_id(doc): doc for doc in documents}
+            return [Document(page_content=by_id[doc_id].page_content,
+                             metadata={**by_id[doc_id].metadata, 'relevance_score': score})
+                    for doc_id, score in ranking if doc_id in by_id], outcome
+        finally:
+            rerank_stats["rerank_ms"] += (perf_counter() - start) * 1000
+            logger.info("Rerank stats: %s", report())
@@ -1,5 +1,4 @@
 import os
-import json
 import slack_sdk
 from flask import request, jsonify
 from slack_sdk.signature import SignatureVerifier
@@ -7,34 +6,123 @@ from google.cloud import pubsub_v1
 from google.cloud import firestore
 from urllib.parse import parse_qs
 from utils import read_secret, logger
+from credentials_cache import get_bot_id, get_secret
+from tracing import record_span, set_trace, span
+from idempotency import IdempotencyStore
+from events import from_slack
+import orjson
+import redis
+from collections import deque
+from functools import partial
+from time import time
+from typing import Dict, Tuple
 # Load environment variables
 project_id = os.environ['GCP_PROJECT']
 
 # read secrets
 topic_id = read_secret('PUBSUB_TOPIC', project_id)
 slackapp_id = read_secret('SLACK_APP_ID', project_id)
-# Initialize Pub/Sub client
-publisher = pubsub_v1.PublisherClient()
+# Publish mode: 'sync' waits for the Pub/Sub ack before answering Slack, 'async' answers right away
+# and completes the publish in a callback (needs CPU allocated after the response is sent)
+publish_mode = os.environ.get('PUBLISH_MODE', 'sync')
+
+# Initialize Pub/Sub client, batching and bounding in-flight messages
+publisher = pubsub_v1.PublisherClient(
+    batch_settings=pubsub_v1.types.BatchSettings(
+        max_messages=int(os.environ.get('PUBLISH_BATCH_MESSAGES', 100)),
+        max_bytes=1024 * 1024,
+        max_latency=float(os.environ.get('PUBLISH_BATCH_LATENCY', 0.01)),
+    ),
+    publisher_options=pubsub_v1.types.PublisherOptions(
+        flow_control=pubsub_v1.types.PublishFlowControl(
+            message_limit=int(os.environ.get('PUBLISH_MAX_IN_FLIGHT', 1000)),
+            byte_limit=16 * 1024 * 1024,
+            limit_exceeded_behavior=pubsub_v1.types.LimitExceededBehavior.BLOCK,
+        )
+    ),
+)
 topic_path = publisher.topic_path(project_id, topic_id)
 
+# drops Slack retries (X-Slack-Retry-Num) of events that were already published
+dedup = IdempotencyStore("pubsub", redis.Redis(host=get_secret("REDIS_HOST", project_id),
+                                               port=get_secret("REDIS_PORT", project_id),
+                                               password=get_secret("REDIS_PASS", project_id)))
+
+# messages whose asynchronous publish failed, retried on the next request
+dead_letters = deque(maxlen=int(os.environ.get('DEAD_LETTER_SIZE', 1000)))
+publish_stats = {'published': 0, 'failed': 0, 'retried': 0}
+
+
+def _on_publish_done(data: bytes, attributes: Dict[str, str], submitted: float, future) -> None:
+    """callback completing an asynchronous publish, failures go to the dead-letter buffer"""
+    set_trace(attributes.get('trace_id'))
+    record_span("publish_ack", submitted, time() - submitted, mode="async")
+    try:
+        message_id = future.result()
+        publish_stats['published'] += 1
+        logger.info(f"Published message with ID: {message_id}")
+    except Exception as e:
+        publish_stats['failed'] += 1
+        dead_letters.append((data, attributes))
+        logger.error(f"An error occurred while publishing the message, kept in dead-letter buffer: {e}, stats: {publish_stats}")
+
+
+def _publish_async(data: bytes, **attributes) -> None:
+    future = publisher.publish(topic_path, data=data, **attributes)
+    future.add_done_callback(partial(_on_publish_done, data, attributes, time()))
+
+
+def retry_dead_letters() -> None:
+    """republishes the messages whose asynchronous publish failed"""
+    while dead_letters:
+        data, attributes = dead_letters.popleft()
+        publish_stats['retried'] += 1
+        _publish_async(data, **attributes)
+
+
+def publish_message(data: bytes, **attributes) -> Tuple[str, int]:
+    """publishes data to the topic, waiting for the ack unless publish_mode is 'async'
+
+    Args:
+        data (bytes): message body
+        **attributes: message attributes
+
+    Returns:
+        Tuple[str, int]: response string and code for Slack
+    """
+    if publish_mode == 'async':
+        retry_dead_letters()
+        _publish_async(data, **attributes)
+        return 'OK', 200
+
+    future = publisher.publish(topic_path, data=data, **attributes)
+    # Wait for Pub/Sub acknowledgement
+    try:
+        with span("publish_ack"):
+            message_id = future.result()
+        logger.info(f"Published message with ID: {message_id}")
+        return 'OK', 200
+
+    except Exception as e:
+        logger.error(f"An error occurred while publishing the message: {e}")
+        return 'Internal Server Error', 500
+
 
 def publish(request):
+    trace_id = set_trace()
     if request.mimetype == "application/x-www-form-urlencoded":
         data = dict(request.form)
         logger.info(f"this is the urlencoded form: {data}")
-        # Publish message to topic
-        data = json.dumps(data['payload']).encode("utf-8")
-        future = publisher.publish(topic_path, data=data)
-
-        # Wait for Pub/Sub acknowledgement
-        try:
-            message_id = future.result()
-            print(f"Published message with ID: {message_id}")
+        # Parse the interactive payload once, the typed event is what travels downstream
+        slack_event = from_slack(orjson.loads(data['payload']), trace_id=trace_id)
+        dedup_key = slack_event.dedup_key()
+        if not dedup.first_seen(dedup_key):
             return 'OK', 200
-            
-        except Exception as e:
-            logger.error(f"An error occurred while publishing the message: {e}")
-            return 'Internal Server Error', 500
+        # Publish message to topic
+        response = publish_message(slack_event.encode(), trace_id=trace_id)
+        if response[1] != 200:
+            dedup.release(dedup_key)
+        return response
         
     elif request.mimetype == 'application/json':
         logger.info(f"Here's the json request: {request.json}")
@@ -59,21 +147,22 @@ def publish(request):
 
         # Figure out which app specific tokens to use
         if app_id == slackapp_id:
-            signing_secret = read_secret('SIGNING_SECRET_SLACK', project_id)
-            ver_token = read_secret('VERIFICATION_TOKEN_SLACK', project_id)
-            bot_api_token = read_secret('BOT_TOKEN_SLACK', project_id)
+            signing_secret = get_secret('SIGNING_SECRET_SLACK', project_id)
+            ver_token = get_secret('VERIFICATION_TOKEN_SLACK', project_id)
+            bot_api_token = get_secret('BOT_TOKEN_SLACK', project_id)
         else:
             raise ValueError("No logic exists for that app.")
 
         # Load bot ID
-        client = slack_sdk.WebClient(token=bot_api_token)
-        bot_id = client.api_call("auth.test")['user_id']
+        bot_id = get_bot_id(bot_api_token)
 
         # Initialize signature verifier
         signature_verifier = SignatureVerifier(signing_secret)
 
         # Ensure Slack request is valid 
-        if not signature_verifier.is_valid_request(request.get_data(), request.headers):
+        with span("verify_signature"):
+            is_valid = signature_verifier.is_valid_request(request.get_data(), request.headers)
+        if not is_valid:
             logger.error("Signature error.")
             return jsonify({'error': 'invalid_request'}), 400
 
@@ -86,24 +175,28 @@ def publish(request):
         event = data.get('event')
         user_id = event.get('user')
 
+        # Acknowledge retries of events we already published so Slack stops resending them
+        if request.headers.get('X-Slack-Retry-Num'):
+            logger.info("Slack retry %s (%s) for event %s", request.headers.get('X-Slack-Retry-Num'),
+                        request.headers.get('X-Slack-Retry-Reason'), data.get('event_id'))
         # Ensure bot is not reading its own messages
         if user_id != bot_id:
             if event and event.get("type") == "message" and event.get("channel_type") == "im":
-                # Create a Pub/Sub message with the event data
-                message = json.dumps(event).encode("utf-8")
+                # Create the typed event, encoded once for all later hops
+                slack_event = from_slack(event, app_id=app_id, event_id=data.get('event_id'), trace_id=trace_id)
+                if slack_event is None:
+                    # edits, deletions and other subtypes without a question, nothing to answer
+                    logger.info(f"Ignoring message subtype {event.get('subtype')}")
+                    return 'OK', 200
+                dedup_key = slack_event.dedup_key()
+                if not dedup.first_seen(dedup_key):
+                    return 'OK', 200
                 
                 # Publish message to topic
-                future = publisher.publish(topic_path, data=message, app_id=app_id)
-
-                # Wait for Pub/Sub acknowledgement
-                try:
-                    message_id = future.result()
-                    logger.info(f"Published message with ID: {message_id}")
-                    return 'OK', 200
-                    
-                except Exception as e:
-                    logger.error(f"An error occurred while publishing the message: {e}")
-                    return 'Internal Server Error', 500
+                response = publish_message(slack_event.encode(), trace_id=trace_id)
+                if response[1] != 200:
+                    dedup.release(dedup_key)
+                return response
 
         return 'Bad Request', 400
     
@@ -1,11 +1,21 @@
 from google.cloud import workflows_v1
-from google.protobuf import json_format
-from google.protobuf.struct_pb2 import Value
 from google.cloud.workflows import executions_v1
 from google.cloud.workflows.executions_v1 import Execution
 from google.cloud.workflows.executions_v1.types import executions
 import base64
-import json
+import importlib
+import os
+import orjson
+import redis
+import requests
+from requests.adapters import HTTPAdapter
+from typing import Tuple
+from utils import read_secret
+from credentials_cache import get_id_token
+from idempotency import IdempotencyStore
+from scheduler import INTERACTIVE, classify
+from events import SlackEvent, decode_event
+from tracing import set_trace, span
 
 # Set up API clients
 execution_client = executions_v1.ExecutionsClient()
@@ -18,33 +28,86 @@ workflow = 'slackbot-flow'
 # Construct the fully qualified location path.
 parent = workflows_client.workflow_path(project_id, location, workflow)
 
+# drops Pub/Sub redeliveries of events that already started a workflow
+dedup = IdempotencyStore("pubsub_workflow", redis.Redis(host=read_secret("REDIS_HOST", project_id),
+                                                        port=read_secret("REDIS_PORT", project_id),
+                                                        password=read_secret("REDIS_PASS", project_id)))
+
+# 'workflow' starts a Cloud Workflows execution per event, 'http' posts the event straight to
+# handle_message over a pooled session and 'inprocess' calls handle_message deployed alongside
+dispatch_mode = os.environ.get('DISPATCH_MODE', 'workflow')
+handle_message_url = os.environ.get('HANDLE_MESSAGE_URL', '')
+# Show More and feedback clicks skip the workflow start when handle_message can be called directly
+interactive_dispatch_mode = os.environ.get('INTERACTIVE_DISPATCH_MODE', 'http' if handle_message_url else dispatch_mode)
+
+# keep-alive session reused across invocations of a warm instance
+http_session = requests.Session()
+http_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=int(os.environ.get('DISPATCH_POOL_SIZE', 10))))
+
+
+class _InProcessRequest:
+    """The part of the request object handle_message reads"""
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+
+def dispatch_workflow(event: SlackEvent) -> Tuple[str, int]:
+    """starts a workflow execution that calls handle_message, the workflow adds the user_id namespace to the argument
+
+    The argument keeps the Slack payload and app_id the workflow reads next to the typed event handle_message decodes.
+    """
+    argument = orjson.dumps({'data': event.to_slack(), 'app_id': event.app_id, 'event': event.to_list()}).decode()
+    with span("workflow_dispatch", mode="workflow"):
+        response = execution_client.create_execution(request={"parent": parent, "execution": {"argument": argument}})
+    print(f'Workflow executed with name: {response.name}')
+    return "OK", 200
+
+
+def dispatch_http(event: SlackEvent) -> Tuple[str, int]:
+    """posts the event to handle_message over the pooled session"""
+    headers = {'Content-type': 'application/json', 'Authorization': f'Bearer {get_id_token(handle_message_url)}'}
+    with span("workflow_dispatch", mode="http"):
+        response = http_session.post(handle_message_url, data=event.encode(), headers=headers, timeout=540)
+    return response.text, response.status_code
+
+
+def dispatch_inprocess(event: SlackEvent) -> Tuple[str, int]:
+    """calls handle_message in this process, it has to be deployed with this function"""
+    handler = importlib.import_module('handle_message')
+    with span("workflow_dispatch", mode="inprocess"):
+        return handler.handle_message(_InProcessRequest(event.encode()))
+
+
+dispatchers = {'workflow': dispatch_workflow, 'http': dispatch_http, 'inprocess': dispatch_inprocess}
+
+
 def pub_sub_acknowledge_and_trigger_workflow(request):
     print("take a look at the request type:", request.mimetype)
     pub_sub_message = request.get_json()
-    # Decode the data and get the app_id
-    decoded_data = base64.b64decode(pub_sub_message['message']['data']).decode().strip()
-    print("take a look at the decoded data", decoded_data)
-    while type(decoded_data) == str:
-        decoded_data = json.loads(decoded_data)
-    print(type(decoded_data), decoded_data)
-    if decoded_data['type'] == 'message':
-        app_id = pub_sub_message['message']['attributes']['app_id']
-        print("APP_ID: ", app_id)
-    elif decoded_data['type'] == 'interactive_message':
-        app_id = decoded_data['original_message']['app_id']
-        print("APP_ID: ", app_id)
-    else:
-        raise TypeError("Unrecognized message type!")
-    
-    
-    # Pass the data and app_id to the workflow
-    body = json_format.ParseDict({'data': decoded_data, 'app_id': app_id}, Value())
+    attributes = pub_sub_message['message'].get('attributes', {})
+    # Decode the event once, messages published before events were typed carry these as attributes
+    event = decode_event(base64.b64decode(pub_sub_message['message']['data']))
+    if event is None:
+        # nothing to answer (message edits, deletions, ...), ack so Pub/Sub does not redeliver it
+        return "OK", 200
+    event.app_id = event.app_id or attributes.get('app_id')
+    event.event_id = event.event_id or attributes.get('event_id')
+    event.trace_id = set_trace(event.trace_id or attributes.get('trace_id'))
+    print("take a look at the decoded event", event)
+
+    dedup_key = event.dedup_key()
+    if not dedup.first_seen(dedup_key):
+        return "OK", 200
 
     try:
         print("i got before execution")
-        response = execution_client.create_execution(request={"parent": parent, "execution": {"argument": json_format.MessageToJson(body)}})
-        print(f'Workflow executed with name: {response.name}')
-        return "OK", 200
+        mode = interactive_dispatch_mode if classify(event) == INTERACTIVE else dispatch_mode
+        response = dispatchers[mode](event)
+        if response[1] >= 300:
+            dedup.release(dedup_key)
+        return response
     except Exception as e:
         print(e)
+        dedup.release(dedup_key)
         return str(e), 500
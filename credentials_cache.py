@@ -0,0 +1,100 @@
+import base64
+import json
+import os
+import threading
+from time import time
+from typing import Callable, Dict, Hashable, Tuple
+
+import slack_sdk
+from google.auth.transport.requests import Request
+from google.oauth2 import id_token
+
+from slack_client import RateLimitedSlackClient
+from utils import read_secret, logger
+
+SECRET_TTL = int(os.environ.get('CREDENTIAL_SECRET_TTL', 600))
+BOT_ID_TTL = int(os.environ.get('CREDENTIAL_BOT_ID_TTL', 3600))
+# refresh ID tokens this many seconds before they expire (they are valid for one hour)
+ID_TOKEN_REFRESH_MARGIN = int(os.environ.get('CREDENTIAL_ID_TOKEN_MARGIN', 300))
+
+
+class _TTLCache:
+    """Process-wide cache whose entries are refreshed under a per-key lock, so concurrent
+    requests on a warm instance wait for one refresh instead of each doing their own"""
+
+    def __init__(self):
+        self._values: Dict[Hashable, Tuple[object, float]] = {}
+        self._locks: Dict[Hashable, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+
+    def get(self, key: Hashable, loader: Callable[[], Tuple[object, float]]) -> object:
+        """returns the cached value, calling loader for a (value, expires_at) pair when missing or expired"""
+        entry = self._values.get(key)
+        if entry is not None and entry[1] > time():
+            return entry[0]
+        with self._locks_lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            entry = self._values.get(key)
+            if entry is None or entry[1] <= time():
+                entry = loader()
+                self._values[key] = entry
+        return entry[0]
+
+
+_cache = _TTLCache()
+
+
+def get_secret(secret_id: str, project_id: str) -> str:
+    """cached read_secret
+
+    Args:
+        secret_id (str): id of the target secret
+        project_id (str): id of the project
+
+    Returns:
+        str: secret value
+    """
+    def load():
+        logger.info("Refreshing secret %s", secret_id)
+        return read_secret(secret_id, project_id), time() + SECRET_TTL
+    return _cache.get(('secret', secret_id, project_id), load)
+
+
+def _token_expiry(token: str) -> float:
+    """reads the exp claim of a JWT without verifying it"""
+    payload = token.split('.')[1]
+    payload += '=' * (-len(payload) % 4)
+    return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+
+
+def get_id_token(audience: str) -> str:
+    """cached Google ID token for calling another cloud function, refreshed before it expires
+
+    Args:
+        audience (str): url of the target function
+
+    Returns:
+        str: ID token
+    """
+    def load():
+        logger.info("Fetching ID token for %s", audience)
+        token = id_token.fetch_id_token(Request(), audience)
+        return token, _token_expiry(token) - ID_TOKEN_REFRESH_MARGIN
+    return _cache.get(('id_token', audience), load)
+
+
+def get_bot_id(bot_api_token: str) -> str:
+    """cached bot user id from auth.test
+
+    Args:
+        bot_api_token (str): Slack bot token
+
+    Returns:
+        str: user id of the bot
+    """
+    def load():
+        logger.info("Refreshing Slack bot identity")
+        bot_id = RateLimitedSlackClient(slack_sdk.WebClient(token=bot_api_token)).api_call("auth.test")['user_id']
+        return bot_id, time() + BOT_ID_TTL
+    return _cache.get(('bot_id', bot_api_token), load)
@@ -0,0 +1,191 @@
+from typing import Dict, List, Optional, Tuple
+
+import orjson
+
+FEEDBACK_VALUES = {"👍": 1, "👎": -1}
+
+
+class SlackEvent:
+    """Base of the events passed between the functions.
+
+    Events are parsed from the Slack payload once at ingress and travel as a compact
+    positional orjson array ([kind, *fields]), so every later hop decodes them once.
+    """
+
+    kind = None
+    __slots__ = ('app_id', 'event_id', 'trace_id', 'user_id')
+
+    def __init__(self, app_id: Optional[str] = None, event_id: Optional[str] = None,
+                 trace_id: Optional[str] = None, user_id: Optional[str] = None):
+        self.app_id = app_id
+        self.event_id = event_id
+        self.trace_id = trace_id
+        self.user_id = user_id
+
+    @classmethod
+    def _fields(cls) -> Tuple[str, ...]:
+        return tuple(field for klass in reversed(cls.__mro__) for field in getattr(klass, '__slots__', ()))
+
+    def to_list(self) -> List:
+        """positional representation, the JSON-serializable form of encode()"""
+        return [self.kind, *(getattr(self, field) for field in self._fields())]
+
+    def encode(self) -> bytes:
+        """serializes the event for the next hop"""
+        return orjson.dumps(self.to_list())
+
+    def dedup_key(self) -> Optional[str]:
+        """idempotency key of the event, None when nothing identifies it"""
+        return self.event_id
+
+    def to_slack(self) -> Dict:
+        """the Slack payload from_slack parses into this event, for consumers of the untyped format"""
+        raise NotImplementedError
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({', '.join(f'{f}={getattr(self, f)!r}' for f in self._fields())})"
+
+
+class MessageEvent(SlackEvent):
+    """A question sent to the bot in a DM. namespace is the Matching Engine namespace
+    searched for the user, the Slack user id unless the workflow supplies another one"""
+
+    kind = 'message'
+    __slots__ = ('text', 'ts', 'namespace')
+
+    def __init__(self, text: str = '', ts: str = '', namespace: Optional[str] = None, **kwargs):
+        super().__init__(**kwargs)
+        self.text = text
+        self.ts = ts
+        self.namespace = namespace or self.user_id
+
+    def dedup_key(self) -> Optional[str]:
+        return self.event_id or (f"{self.user_id}:{self.ts}" if self.user_id and self.ts else None)
+
+    def to_slack(self) -> Dict:
+        return {'type': 'message', 'user': self.user_id, 'text': self.text, 'ts': self.ts}
+
+
+class FeedbackEvent(SlackEvent):
+    """A thumbs up or down click, question_ts identifies the answered question"""
+
+    kind = 'feedback'
+    __slots__ = ('question_ts', 'feedback', 'action_ts')
+
+    def __init__(self, question_ts: str = '', feedback: Optional[int] = None, action_ts: Optional[str] = None, **kwargs):
+        super().__init__(**kwargs)
+        self.question_ts = question_ts
+        self.feedback = feedback
+        self.action_ts = action_ts
+
+    def dedup_key(self) -> Optional[str]:
+        # a second click on the same button is a new action with its own action_ts
+        if self.event_id or not self.action_ts:
+            return self.event_id
+        return f"feedback_{self.user_id}_{self.question_ts}:{self.action_ts}"
+
+    def to_slack(self) -> Dict:
+        value = next((emoji for emoji, feedback in FEEDBACK_VALUES.items() if feedback == self.feedback), self.feedback)
+        return {'type': 'interactive_message', 'callback_id': f"feedback_{self.user_id}_{self.question_ts}",
+                'actions': [{'value': value}], 'action_ts': self.action_ts, 'user': {'id': self.user_id},
+                'original_message': {'app_id': self.app_id}}
+
+
+class ShowMoreEvent(SlackEvent):
+    """A Show More click, callback_id is the key of the cached results"""
+
+    kind = 'showmore'
+    __slots__ = ('callback_id', 'action_ts')
+
+    def __init__(self, callback_id: str = '', action_ts: Optional[str] = None, **kwargs):
+        super().__init__(**kwargs)
+        self.callback_id = callback_id
+        self.action_ts = action_ts
+
+    def dedup_key(self) -> Optional[str]:
+        if self.event_id or not self.action_ts:
+            return self.event_id
+        return f"{self.callback_id}:{self.action_ts}"
+
+    def to_slack(self) -> Dict:
+        return {'type': 'interactive_message', 'callback_id': self.callback_id, 'action_ts': self.action_ts,
+                'user': {'id': self.user_id}, 'original_message': {'app_id': self.app_id}}
+
+
+EVENT_TYPES = {klass.kind: klass for klass in (MessageEvent, FeedbackEvent, ShowMoreEvent)}
+
+
+def from_slack(payload: Dict, app_id: Optional[str] = None, event_id: Optional[str] = None,
+               trace_id: Optional[str] = None) -> Optional[SlackEvent]:
+    """parses a Slack message event or interactive_message payload
+
+    Args:
+        payload (Dict): the Slack event or interactive payload
+        app_id (Optional[str]): app id, read from the original message for interactive payloads
+        event_id (Optional[str]): envelope event_id
+        trace_id (Optional[str]): current trace id
+
+    Returns:
+        Optional[SlackEvent]: the typed event, None for message subtypes without a user or text (edits, deletions, ...)
+    """
+    if payload['type'] == 'interactive_message':
+        app_id = app_id or payload.get('original_message', {}).get('app_id')
+        callback_id = payload['callback_id']
+        if callback_id.startswith("feedback"):
+            user_id, ts = callback_id.split("_")[1:]
+            value = payload['actions'][0]['value']
+            return FeedbackEvent(question_ts=ts, feedback=FEEDBACK_VALUES.get(value, value), action_ts=payload.get('action_ts'),
+                                 app_id=app_id, event_id=event_id, trace_id=trace_id, user_id=user_id)
+        return ShowMoreEvent(callback_id=callback_id, action_ts=payload.get('action_ts'),
+                             app_id=app_id, event_id=event_id, trace_id=trace_id, user_id=payload['user']['id'])
+    if 'user' not in payload or 'text' not in payload:
+        return None
+    return MessageEvent(text=payload['text'], ts=payload['ts'], app_id=app_id, event_id=event_id,
+                        trace_id=trace_id, user_id=payload['user'])
+
+
+def from_list(values: List) -> SlackEvent:
+    """rebuilds an event from its positional representation"""
+    klass = EVENT_TYPES[values[0]]
+    return klass(**dict(zip(klass._fields(), values[1:])))
+
+
+def decode_event(raw: bytes) -> Optional[SlackEvent]:
+    """decodes an event, also accepting the JSON payloads published before events were typed
+
+    Args:
+        raw (bytes): encoded event, or a legacy (possibly doubly encoded) Slack payload
+
+    Returns:
+        Optional[SlackEvent]: the typed event, None for payloads that are not a question or a click
+    """
+    decoded = orjson.loads(raw)
+    if isinstance(decoded, list):
+        return from_list(decoded)
+    while isinstance(decoded, str):
+        decoded = orjson.loads(decoded)
+    return from_slack(decoded)
+
+
+def decode_request(raw: bytes) -> Optional[SlackEvent]:
+    """decodes the body handle_message receives
+
+    Accepts an encoded event, the workflow argument {"event": [...], "data": ..., "app_id": ..., "user_id": ...}
+    whose user_id namespace the workflow adds, and the legacy {"data": <slack payload>, "app_id": ..., "user_id": ...} body.
+
+    Args:
+        raw (bytes): request body
+
+    Returns:
+        Optional[SlackEvent]: the typed event, None for payloads that are not a question or a click
+    """
+    decoded = orjson.loads(raw)
+    if isinstance(decoded, list):
+        return from_list(decoded)
+    if 'event' in decoded:
+        event = from_list(decoded['event'])
+    else:
+        event = from_slack(decoded['data'], decoded.get('app_id'), decoded.get('event_id'), decoded.get('trace_id'))
+    if isinstance(event, MessageEvent) and decoded.get('user_id'):
+        event.namespace = decoded['user_id']
+    return event
@@ -0,0 +1,76 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import redis
+
+from utils import logger
+
+DEDUP_TTL = int(os.environ.get('DEDUP_TTL', 3600))
+DEDUP_FRONT_SIZE = int(os.environ.get('DEDUP_FRONT_SIZE', 10000))
+
+
+class IdempotencyStore:
+    """Remembers which events a stage already processed.
+
+    An in-memory LRU answers repeat deliveries to the same instance without a network call,
+    Redis (SET NX with a TTL) catches the ones that land on another instance. Each stage
+    uses its own namespace because every stage has to process an event once.
+    """
+
+    def __init__(self, stage: str, redis_client: Optional[redis.Redis] = None,
+                 ttl: int = DEDUP_TTL, front_size: int = DEDUP_FRONT_SIZE):
+        self.stage = stage
+        self.r = redis_client
+        self.ttl = ttl
+        self.front_size = front_size
+        self._front: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'processed': 0, 'dropped': 0}
+
+    def first_seen(self, key: Optional[str]) -> bool:
+        """marks the event as seen, returns False when it is a duplicate to drop
+
+        Args:
+            key (Optional[str]): idempotency key from SlackEvent.dedup_key, events without one always pass
+
+        Returns:
+            bool: whether this is the first delivery
+        """
+        if key is None:
+            return True
+        with self._lock:
+            duplicate = key in self._front
+            self._front[key] = True
+            self._front.move_to_end(key)
+            while len(self._front) > self.front_size:
+                self._front.popitem(last=False)
+        if not duplicate and self.r is not None:
+            try:
+                duplicate = not self.r.set(f"slackbot_dedup:{self.stage}:{key}", 1, nx=True, ex=self.ttl)
+            except redis.exceptions.RedisError as e:
+                # better to process twice than to lose the event
+                logger.error(f"Idempotency check failed, processing event {key}: {e}")
+        if duplicate:
+            self.stats['dropped'] += 1
+            logger.info("Dropped duplicate event %s at %s, stats: %s", key, self.stage, self.stats)
+            return False
+        self.stats['processed'] += 1
+        return True
+
+    def release(self, key: Optional[str]) -> None:
+        """forgets the event after a failed attempt so its retry is processed
+
+        Args:
+            key (Optional[str]): idempotency key from SlackEvent.dedup_key
+        """
+        if key is None:
+            return
+        with self._lock:
+            self._front.pop(key, None)
+        if self.r is not None:
+            try:
+                self.r.delete(f"slackbot_dedup:{self.stage}:{key}")
+            except redis.exceptions.RedisError as e:
+                logger.error(f"Could not release event {key}: {e}")
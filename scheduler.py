@@ -0,0 +1,199 @@
+import os
+import re
+import uuid
+from contextlib import contextmanager
+from time import perf_counter, sleep, time
+from typing import Dict, Iterator, Optional
+
+import orjson
+import redis
+
+from events import FeedbackEvent, MessageEvent, ShowMoreEvent, SlackEvent
+from tracing import span
+from utils import logger
+
+INTERACTIVE = "interactive"
+SEARCH = "search"
+
+SCHEDULER_USER_LIMIT = int(os.environ.get('SCHEDULER_USER_LIMIT', 1))
+SCHEDULER_GLOBAL_LIMIT = int(os.environ.get('SCHEDULER_GLOBAL_LIMIT', 16))
+# a slot of a crashed instance is freed after this many seconds, longer than any search
+SCHEDULER_LEASE = int(os.environ.get('SCHEDULER_LEASE', 600))
+SCHEDULER_MAX_WAIT = float(os.environ.get('SCHEDULER_MAX_WAIT', 60))
+
+
+def normalize_text(text: str) -> str:
+    """lowercased question with collapsed whitespace and no trailing punctuation, equal for repeated questions"""
+    return re.sub(r"\s+", " ", text.strip().lower()).rstrip("?!. ")
+
+
+def classify(event: SlackEvent) -> str:
+    """Show More and feedback clicks only read Redis or write Firestore, every other event runs a search"""
+    return INTERACTIVE if isinstance(event, (FeedbackEvent, ShowMoreEvent)) else SEARCH
+
+
+class Slot:
+    """What the scheduler decided for an event. coalesced counts the user's queued repeats of the
+    same question answered by this search; a superseded event is such a repeat and needs no search"""
+
+    __slots__ = ('priority', 'coalesced', 'superseded', 'wait_ms')
+
+    def __init__(self, priority: str, coalesced: int = 0, superseded: bool = False, wait_ms: float = 0.0):
+        self.priority = priority
+        self.coalesced = coalesced
+        self.superseded = superseded
+        self.wait_ms = wait_ms
+
+
+class _WaitTimeout(TimeoutError):
+    """max_wait ran out, coalesced repeats were already taken and have to be answered by the unscheduled search"""
+
+    def __init__(self, coalesced: int = 0):
+        super().__init__(coalesced)
+        self.coalesced = coalesced
+
+
+class SearchScheduler:
+    """Caps the searches in flight per user and across all instances, interactive events skip the queue.
+
+    Slots are leases in Redis sorted sets (member a random token, score its expiry), so the
+    slots of a crashed instance free themselves. A search first takes one of its user's
+    slots, then a global one. Questions a user sends while their previous search still runs
+    queue up and get the slot in the order they were asked. The question that gets the slot
+    also takes the queued repeats of itself (same normalized text), which return without a
+    search; different questions are each answered. Queue depth and wait time go out as
+    attributes of a schedule_wait span.
+    """
+
+    def __init__(self, redis_client: Optional[redis.Redis], user_limit: int = SCHEDULER_USER_LIMIT,
+                 global_limit: int = SCHEDULER_GLOBAL_LIMIT, lease: int = SCHEDULER_LEASE,
+                 max_wait: float = SCHEDULER_MAX_WAIT, poll_interval: float = 0.05, prefix: str = "slackbot_sched"):
+        self.r = redis_client
+        self.user_limit = user_limit
+        self.global_limit = global_limit
+        self.lease = lease
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self.prefix = prefix
+        self.stats = {'interactive': 0, 'searches': 0, 'waited': 0, 'coalesced': 0, 'superseded': 0, 'timeouts': 0, 'wait_ms': 0.0}
+
+    def _try_acquire(self, key: str, limit: int, token: str) -> bool:
+        now = time()
+        with self.r.pipeline() as pipe:
+            pipe.zremrangebyscore(key, '-inf', now)
+            pipe.zadd(key, {token: now + self.lease})
+            pipe.zrank(key, token)
+            pipe.expire(key, self.lease)
+            rank = pipe.execute()[2]
+        # holders were added earlier, so they expire earlier and rank first
+        if rank < limit:
+            return True
+        self.r.zrem(key, token)
+        return False
+
+    def _take_repeats(self, pending_key: str, entry: bytes, text: str) -> int:
+        """takes the entry and the queued repeats of its question off the queue, returns the number of repeats"""
+        repeats = [item for item in self.r.lrange(pending_key, 0, -1)
+                   if item != entry and normalize_text(orjson.loads(item)['text']) == normalize_text(text)]
+        with self.r.pipeline() as pipe:
+            pipe.lrem(pending_key, 1, entry)
+            for item in repeats:
+                pipe.lrem(pending_key, 1, item)
+            # a repeat that timed out meanwhile removed itself and searches on its own
+            return sum(pipe.execute()[1:])
+
+    def _wait(self, event: MessageEvent, token: str, attributes: Dict) -> Slot:
+        user_key, global_key = f"{self.prefix}:user:{event.user_id}", f"{self.prefix}:global"
+        pending_key = f"{self.prefix}:pending:{event.user_id}"
+        entry = orjson.dumps({'ts': event.ts, 'text': event.text, 'at': time()})
+        with self.r.pipeline() as pipe:
+            pipe.rpush(pending_key, entry)
+            pipe.expire(pending_key, self.lease)
+            pipe.incr(f"{self.prefix}:waiting")
+            pipe.zcard(global_key)
+            *_, queue_depth, in_flight = pipe.execute()
+        attributes.update(queue_depth=queue_depth - 1, in_flight=in_flight)
+        start = perf_counter()
+        try:
+            # the user's slot, in the order the questions were asked
+            while True:
+                position = self.r.lpos(pending_key, entry)
+                if position is None:
+                    # an earlier repeat of this question took it and answers it
+                    return Slot(SEARCH, superseded=True)
+                if position == 0 and self._try_acquire(user_key, self.user_limit, token):
+                    break
+                if position > 0:
+                    head = self.r.lindex(pending_key, 0)
+                    if head is not None and time() - orjson.loads(head)['at'] > 2 * self.max_wait:
+                        # its waiter would have timed out and left long ago, the instance is gone
+                        self.r.lrem(pending_key, 1, head)
+                        continue
+                if perf_counter() - start > self.max_wait:
+                    # searched on its own, it must not hold up the queue or be taken as a repeat
+                    self.r.lrem(pending_key, 1, entry)
+                    raise _WaitTimeout()
+                sleep(self.poll_interval)
+            coalesced = self._take_repeats(pending_key, entry, event.text)
+            while not self._try_acquire(global_key, self.global_limit, token):
+                if perf_counter() - start > self.max_wait:
+                    # the taken repeats return superseded, this search answers them
+                    raise _WaitTimeout(coalesced)
+                sleep(self.poll_interval)
+            return Slot(SEARCH, coalesced=coalesced)
+        finally:
+            self.r.decr(f"{self.prefix}:waiting")
+
+    def _release(self, user_id: str, token: str) -> None:
+        try:
+            with self.r.pipeline() as pipe:
+                pipe.zrem(f"{self.prefix}:user:{user_id}", token)
+                pipe.zrem(f"{self.prefix}:global", token)
+                pipe.execute()
+        except redis.exceptions.RedisError as e:
+            logger.error(f"Could not release scheduler slot of {user_id}, it expires in {self.lease}s: {e}")
+
+    @contextmanager
+    def slot(self, event: SlackEvent) -> Iterator[Slot]:
+        """waits until the event may run and holds its slot for the enclosed block
+
+        Args:
+            event (SlackEvent): the decoded event
+
+        Yields:
+            Iterator[Slot]: the decision, the block skips the search when it is superseded
+        """
+        priority = classify(event)
+        if priority == INTERACTIVE or self.r is None:
+            self.stats['interactive' if priority == INTERACTIVE else 'searches'] += 1
+            with span("schedule_wait", priority=priority):
+                pass
+            yield Slot(priority)
+            return
+
+        self.stats['searches'] += 1
+        token = uuid.uuid4().hex
+        start = perf_counter()
+        with span("schedule_wait", priority=priority) as attributes:
+            try:
+                decision = self._wait(event, token, attributes)
+            except _WaitTimeout as e:
+                # better a late answer over the caps than none
+                self.stats['timeouts'] += 1
+                decision = Slot(SEARCH, coalesced=e.coalesced)
+            except redis.exceptions.RedisError as e:
+                logger.error(f"Scheduler unavailable, running the search unscheduled: {e}")
+                decision = Slot(SEARCH)
+            decision.wait_ms = (perf_counter() - start) * 1000
+            attributes.update(coalesced=decision.coalesced, superseded=decision.superseded)
+
+        self.stats['wait_ms'] += decision.wait_ms
+        self.stats['waited'] += decision.wait_ms > 1000 * self.poll_interval
+        self.stats['coalesced'] += decision.coalesced
+        self.stats['superseded'] += decision.superseded
+        logger.info("Scheduled search of %s after %.0fms, stats: %s", event.user_id, decision.wait_ms, self.stats)
+        try:
+            yield decision
+        finally:
+            if not decision.superseded:
+                self._release(event.user_id, token)
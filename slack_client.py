@@ -0,0 +1,195 @@
+import asyncio
+import os
+import threading
+from functools import partial
+from time import sleep, time
+from typing import Callable, Dict, Optional, Tuple
+
+import redis
+from slack_sdk.errors import SlackApiError
+
+from tracing import span
+from utils import logger
+
+# Slack's per-workspace rate tiers, in calls per second
+TIERS = {1: 1 / 60, 2: 20 / 60, 3: 50 / 60, 4: 100 / 60}
+# method -> (calls per second, burst, scope); scope 'channel' keeps one bucket per channel
+METHOD_LIMITS: Dict[str, Tuple[float, int, Optional[str]]] = {
+    # special tier: about one message per second per channel, short bursts are tolerated
+    'chat.postMessage': (1.0, 3, 'channel'),
+    'chat.update': (TIERS[3], 5, None),
+    'auth.test': (TIERS[4], 10, None),
+}
+DEFAULT_LIMIT = (TIERS[3], 5, None)
+SLACK_MAX_RETRIES = int(os.environ.get('SLACK_MAX_RETRIES', 3))
+# calls queued longer than this go out anyway and take their chance with a 429
+SLACK_MAX_QUEUE_DELAY = float(os.environ.get('SLACK_MAX_QUEUE_DELAY', 30))
+
+
+class _LocalBuckets:
+    """in-process fallback of the shared buckets"""
+
+    def __init__(self):
+        self._tat: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, key: str, interval: float, tolerance: float, now: float) -> float:
+        with self._lock:
+            start = max(self._tat.get(key, now), now)
+            self._tat[key] = start + interval
+        return start - tolerance
+
+    def push_back(self, key: str, until: float) -> None:
+        with self._lock:
+            self._tat[key] = max(self._tat.get(key, until), until)
+
+
+class RateLimitedSlackClient:
+    """WebClient wrapper that queues calls behind per-method token buckets and honours Retry-After.
+
+    The buckets are kept as a GCRA theoretical arrival time in Redis, shared by every
+    instance: each call reserves the next free send time of its bucket and sleeps until
+    then, so bursts are spread at the limit instead of failing. A 429 pushes the bucket
+    back by Retry-After for all instances before the call is retried. Without Redis, or
+    when it is down, the buckets are per instance.
+    """
+
+    def __init__(self, client, redis_client: Optional[redis.Redis] = None, limits: Dict = METHOD_LIMITS,
+                 max_retries: int = SLACK_MAX_RETRIES, max_queue_delay: float = SLACK_MAX_QUEUE_DELAY,
+                 prefix: str = "slackbot_ratelimit"):
+        self.client = client
+        self.r = redis_client
+        self.limits = limits
+        self.max_retries = max_retries
+        self.max_queue_delay = max_queue_delay
+        self.prefix = prefix
+        self._local = _LocalBuckets()
+        self.stats = {'calls': 0, 'queued': 0, 'queue_ms': 0.0, 'rate_limited': 0, 'retries': 0, 'failed': 0}
+
+    def _bucket(self, method: str, kwargs: Dict) -> Tuple[str, float, float]:
+        """bucket key, interval between calls and burst tolerance in seconds"""
+        rate, burst, scope = self.limits.get(method, DEFAULT_LIMIT)
+        key = f"{self.prefix}:{method}" + (f":{kwargs.get(scope)}" if scope else "")
+        return key, 1 / rate, (burst - 1) / rate
+
+    def _reserve_shared(self, key: str, interval: float, tolerance: float, now: float) -> float:
+        def reserve(pipe: redis.client.Pipeline) -> float:
+            tat = pipe.get(key)
+            start = max(float(tat), now) if tat is not None else now
+            pipe.multi()
+            pipe.set(key, start + interval, px=int((start + interval - now + tolerance) * 1000) + 1)
+            return start - tolerance
+        return self.r.transaction(reserve, key, value_from_callable=True)
+
+    def _reserve(self, key: str, interval: float, tolerance: float) -> float:
+        """takes the next send time of the bucket, returns how long to wait for it"""
+        now = time()
+        send_at = None
+        if self.r is not None:
+            try:
+                send_at = self._reserve_shared(key, interval, tolerance, now)
+            except redis.exceptions.RedisError as e:
+                logger.error(f"Shared Slack rate limit unavailable, limiting {key} per instance: {e}")
+        if send_at is None:
+            send_at = self._local.reserve(key, interval, tolerance, now)
+        return max(0.0, send_at - now)
+
+    def _push_back(self, key: str, retry_after: float, tolerance: float) -> None:
+        # no burst allowance right after a 429
+        until = time() + retry_after + tolerance
+        self._local.push_back(key, until)
+        if self.r is not None:
+            try:
+                # later reservations start after the Retry-After window on every instance
+                def push(pipe: redis.client.Pipeline) -> None:
+                    tat = pipe.get(key)
+                    pipe.multi()
+                    pipe.set(key, max(float(tat or 0), until), px=int((retry_after + 2 * tolerance) * 1000) + 1)
+                self.r.transaction(push, key)
+            except redis.exceptions.RedisError as e:
+                logger.error(f"Could not share the Retry-After of {key}: {e}")
+
+    def _queue_delay(self, key: str, interval: float, tolerance: float) -> float:
+        """reserves the next send time of the bucket and records the wait, returns how long to sleep"""
+        delay = self._reserve(key, interval, tolerance)
+        if delay > 0:
+            self.stats['queued'] += 1
+            self.stats['queue_ms'] += min(delay, self.max_queue_delay) * 1000
+        return delay
+
+    def _retry_after(self, key: str, error: SlackApiError, attempt: int) -> Optional[float]:
+        """seconds to back off after a 429 that is worth retrying, None when the error has to be raised"""
+        if error.response.status_code != 429 or attempt == self.max_retries:
+            self.stats['failed'] += 1
+            return None
+        headers = {k.lower(): v for k, v in (error.response.headers or {}).items()}
+        retry_after = float(headers.get('retry-after', 1))
+        self.stats['rate_limited'] += 1
+        self.stats['retries'] += 1
+        logger.warning("Slack rate limited %s, retrying in %ss, stats: %s", key, retry_after, self.report())
+        return retry_after
+
+    def _call(self, method: str, fn: Callable, kwargs: Dict) -> Dict:
+        key, interval, tolerance = self._bucket(method, kwargs)
+        self.stats['calls'] += 1
+        for attempt in range(self.max_retries + 1):
+            delay = self._queue_delay(key, interval, tolerance)
+            if delay > 0:
+                with span("slack_queue", method=method, delay_ms=round(delay * 1000, 1)):
+                    sleep(min(delay, self.max_queue_delay))
+            try:
+                return fn(**kwargs)
+            except SlackApiError as e:
+                retry_after = self._retry_after(key, e, attempt)
+                if retry_after is None:
+                    raise
+                self._push_back(key, retry_after, tolerance)
+
+    def chat_postMessage(self, **kwargs) -> Dict:
+        return self._call('chat.postMessage', self.client.chat_postMessage, kwargs)
+
+    def chat_update(self, **kwargs) -> Dict:
+        return self._call('chat.update', self.client.chat_update, kwargs)
+
+    def api_call(self, api_method: str, **kwargs) -> Dict:
+        return self._call(api_method, partial(self.client.api_call, api_method), kwargs)
+
+    def report(self) -> Dict[str, float]:
+        """stats plus the share of calls that had to queue"""
+        calls = max(self.stats['calls'], 1)
+        return {**self.stats, 'queued_share': round(self.stats['queued'] / calls, 3),
+                'mean_queue_ms': round(self.stats['queue_ms'] / max(self.stats['queued'], 1), 1)}
+
+
+class AsyncRateLimitedSlackClient(RateLimitedSlackClient):
+    """AsyncWebClient counterpart of RateLimitedSlackClient, queued behind the same buckets.
+
+    The bucket reservations and Retry-After push backs use the synchronous Redis client in
+    the loop's default executor, the queueing delay is an asyncio sleep.
+    """
+
+    async def _acall(self, method: str, fn: Callable, kwargs: Dict) -> Dict:
+        loop = asyncio.get_running_loop()
+        key, interval, tolerance = self._bucket(method, kwargs)
+        self.stats['calls'] += 1
+        for attempt in range(self.max_retries + 1):
+            delay = await loop.run_in_executor(None, self._queue_delay, key, interval, tolerance)
+            if delay > 0:
+                with span("slack_queue", method=method, delay_ms=round(delay * 1000, 1)):
+                    await asyncio.sleep(min(delay, self.max_queue_delay))
+            try:
+                return await fn(**kwargs)
+            except SlackApiError as e:
+                retry_after = self._retry_after(key, e, attempt)
+                if retry_after is None:
+                    raise
+                await loop.run_in_executor(None, self._push_back, key, retry_after, tolerance)
+
+    async def chat_postMessage(self, **kwargs) -> Dict:
+        return await self._acall('chat.postMessage', self.client.chat_postMessage, kwargs)
+
+    async def chat_update(self, **kwargs) -> Dict:
+        return await self._acall('chat.update', self.client.chat_update, kwargs)
+
+    async def api_call(self, api_method: str, **kwargs) -> Dict:
+        return await self._acall(api_method, partial(self.client.api_call, api_method), kwargs)
@@ -0,0 +1,45 @@
+import logging
+import os
+import sys
+from unittest.mock import MagicMock, patch
+
+import fakeredis
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "cloud_functions/handle_messages"))
+os.environ.setdefault("project_id", "test-project")
+
+
+class _NullCloudLoggingHandler(logging.Handler):
+    def __init__(self, client=None, **kwargs):
+        super().__init__()
+
+    def emit(self, record):
+        pass
+
+
+def _secret_version(request):
+    secret_id = request["name"].split("/")[3]
+    return MagicMock(payload=MagicMock(data=b"6379" if secret_id == "REDIS_PORT" else f"test-{secret_id}".encode()))
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "integration: runs a whole cloud function with its clients mocked")
+    # the functions create their GCP and Redis clients at import time, give them ones that need no credentials
+    import google.cloud.firestore
+    import google.cloud.logging
+    import google.cloud.logging_v2.handlers
+    import google.cloud.secretmanager
+    import google.cloud.workflows.executions_v1
+    import google.cloud.workflows_v1
+    import redis
+    patch.object(google.cloud.logging, "Client", MagicMock()).start()
+    patch.object(google.cloud.logging_v2.handlers, "CloudLoggingHandler", _NullCloudLoggingHandler).start()
+    secret_manager = MagicMock()
+    secret_manager.return_value.access_secret_version.side_effect = _secret_version
+    patch.object(google.cloud.secretmanager, "SecretManagerServiceClient", secret_manager).start()
+    patch.object(google.cloud.firestore, "Client", MagicMock()).start()
+    patch.object(google.cloud.workflows_v1, "WorkflowsClient", MagicMock()).start()
+    patch.object(google.cloud.workflows.executions_v1, "ExecutionsClient", MagicMock()).start()
+    patch.object(redis, "Redis", fakeredis.FakeRedis).start()
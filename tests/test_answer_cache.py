@@ -0,0 +1,97 @@
+import hashlib
+import os
+import sys
+from itertools import count
+
+import fakeredis
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../cloud_functions/main_logic"))
+import answer_cache  # noqa: E402
+from answer_cache import AnswerCache, normalize_query  # noqa: E402
+
+RESULT = {"chat_response": {"output_text": "Rotate them in the vault."}, "search_output": [["Keys", "http://keys"]]}
+
+
+def embed_as(vectors):
+    """embedding function returning the given vector per query, recording the calls"""
+    def embed(query):
+        embed.calls.append(query)
+        return vectors[query]
+    embed.calls = []
+    return embed
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    # strictly increasing access times, so the LRU order does not depend on the clock resolution
+    clock = count(1000)
+    monkeypatch.setattr(answer_cache.time, "time", lambda: next(clock))
+    return AnswerCache(fakeredis.FakeRedis(), threshold=0.95, max_entries=2)
+
+
+def test_normalize_query():
+    assert normalize_query("  How do I   rotate KEYS?! ") == "how do i rotate keys"
+
+
+def test_exact_hit_skips_the_embedding(cache):
+    embed = embed_as({"How do I rotate keys?": [1.0, 0.0]})
+    assert cache.lookup("user1", "How do I rotate keys?", embed) == (None, [1.0, 0.0])
+    cache.store("user1", "How do I rotate keys?", [1.0, 0.0], RESULT)
+
+    assert cache.lookup("user1", "how do i rotate keys", embed) == (RESULT, None)
+    assert embed.calls == ["How do I rotate keys?"]
+
+
+def test_near_duplicate_hit_and_miss(cache):
+    cache.store("user1", "How do I rotate keys?", [1.0, 0.0], RESULT)
+    embed = embed_as({"key rotation steps": [0.99, 0.05], "expense policy": [0.0, 1.0]})
+
+    result, embedding = cache.lookup("user1", "key rotation steps", embed)
+    assert result == RESULT
+    assert embedding == [0.99, 0.05]
+    assert cache.lookup("user1", "expense policy", embed) == (None, [0.0, 1.0])
+    # entries are per user
+    assert cache.lookup("user2", "key rotation steps", embed)[0] is None
+
+
+def test_least_recently_used_entry_is_evicted(cache):
+    embed = embed_as({})
+    cache.store("user1", "first", [1.0, 0.0], {"n": 1})
+    cache.store("user1", "second", [0.0, 1.0], {"n": 2})
+    # reading the first entry makes the second the least recently used
+    assert cache.lookup("user1", "first", embed)[0] == {"n": 1}
+    cache.store("user1", "third", [0.7, 0.7], {"n": 3})
+
+    assert cache.lookup("user1", "first", embed)[0] == {"n": 1}
+    assert cache.lookup("user1", "third", embed)[0] == {"n": 3}
+    assert not cache.r.exists(f"slackbot_answers:user1:{hashlib.sha1(b'second').hexdigest()}")
+    assert cache.r.zcard("slackbot_answers_lru:user1") == 2
+
+
+def test_redis_error_after_a_semantic_match_is_a_miss(cache, monkeypatch):
+    cache.store("user1", "How do I rotate keys?", [1.0, 0.0], RESULT)
+    embed = embed_as({"how to rotate the keys": [0.99, 0.01]})
+
+    exact_hget = cache.r.hget
+    calls = count()
+
+    def unavailable(*args, **kwargs):
+        if next(calls) == 0:
+            return exact_hget(*args, **kwargs)
+        raise answer_cache.redis.exceptions.ConnectionError("redis down")
+    # the exact lookup and the index scan succeed, reading the matched result fails
+    monkeypatch.setattr(cache.r, "hget", unavailable)
+    assert cache.lookup("user1", "how to rotate the keys", embed) == (None, [0.99, 0.01])
+
+
+def test_redis_error_dropping_expired_entries_is_a_miss(cache, monkeypatch):
+    cache.store("user1", "How do I rotate keys?", [1.0, 0.0], RESULT)
+    digest = hashlib.sha1(b"how do i rotate keys").hexdigest()
+    cache.r.delete(cache._entry_key("user1", digest))
+    embed = embed_as({"how to rotate the keys": [0.99, 0.01]})
+
+    def unavailable(*args, **kwargs):
+        raise answer_cache.redis.exceptions.ConnectionError("redis down")
+    monkeypatch.setattr(cache.r, "zrem", unavailable)
+    assert cache.lookup("user1", "how to rotate the keys", embed) == (None, [0.99, 0.01])
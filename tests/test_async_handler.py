@@ -0,0 +1,155 @@
+import asyncio
+import json
+import threading
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import aiohttp
+import fakeredis
+import pytest
+from aiohttp import web
+from slack_sdk.errors import SlackApiError
+
+from answer_flow import ERROR_TEXT
+from async_handler import AsyncHandler
+from events import MessageEvent
+from search_client import SearchClient
+from slack_client import AsyncRateLimitedSlackClient
+
+
+class RecordingAsyncWebClient:
+    """AsyncWebClient answering 429 for the first rate_limited posts"""
+
+    def __init__(self, rate_limited=0):
+        self.rate_limited = rate_limited
+        self.posts = []
+        self.updates = []
+
+    async def chat_postMessage(self, **kwargs):
+        if self.rate_limited:
+            self.rate_limited -= 1
+            response = SimpleNamespace(status_code=429, headers={"Retry-After": "0.1"}, data={"ok": False})
+            raise SlackApiError("ratelimited", response)
+        self.posts.append(kwargs)
+        return {"ok": True, "channel": "D1", "ts": f"100.{len(self.posts)}"}
+
+    async def chat_update(self, **kwargs):
+        self.updates.append(kwargs)
+        return {"ok": True}
+
+
+@pytest.fixture
+def search_server():
+    """local search function answering with the scripted (status, body) replies in turn,
+    a None line in a streamed body drops the connection"""
+    replies = []
+    loop = asyncio.new_event_loop()
+
+    async def search(request):
+        status, body = replies.pop(0)
+        if isinstance(body, list):
+            response = web.StreamResponse(status=status)
+            await response.prepare(request)
+            for line in body:
+                if line is None:
+                    # drops the connection in the middle of the chunked body
+                    request.transport.close()
+                    return response
+                await response.write(json.dumps(line).encode() + b"\n")
+            return response
+        return web.Response(status=status, text=json.dumps(body))
+
+    app = web.Application()
+    app.router.add_post("/", search)
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{port}/", replies
+    asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+
+
+def make_handler(url, web_client, stream_answers=False):
+    feedback = MagicMock()
+    search_client = SearchClient(url, backoff=0)
+    handler = AsyncHandler("token", search_client, fakeredis.FakeRedis(), {}, feedback, stream_answers=stream_answers,
+                           stream_update_interval=0)
+
+    async def clients():
+        return (AsyncRateLimitedSlackClient(web_client, fakeredis.FakeRedis()), aiohttp.ClientSession(),
+                fakeredis.FakeAsyncRedis())
+    handler._clients = asyncio.run_coroutine_threadsafe(clients(), handler.loop).result()
+    return handler
+
+
+@pytest.fixture(autouse=True)
+def mock_id_token():
+    with patch("async_handler.get_id_token", return_value="mock_token") as get_id_token:
+        yield get_id_token
+
+
+def test_answer_goes_through_search_retries_and_slack_rate_limits(search_server):
+    url, replies = search_server
+    replies.extend([(503, {}), (200, {"chat_response": {"output_text": "Here are your results."},
+                                      "search_output": [["Title1", "http://link1"], ["Title2", "http://link2"]]})])
+    web_client = RecordingAsyncWebClient(rate_limited=1)
+    handler = make_handler(url, web_client)
+
+    response = handler.handle(MessageEvent(user_id="user1", text="search query", ts="1234"))
+
+    assert response == ("OK", 200)
+    # the cold-start 503 was retried by the shared search client
+    assert handler.search_client.stats["retries"] == 1
+    # the 429 was retried after Retry-After by the rate limited client
+    assert handler._clients[0].stats["rate_limited"] == 1
+    assert len(web_client.posts) == 1
+    assert web_client.posts[0]["text"] == "*Here are your results.*"
+    handler.feedback.record_query.assert_called_once()
+    assert handler.feedback.record_query.call_args.args[3] == ["http://link1", "http://link2"]
+
+
+def test_search_error_is_reported(search_server):
+    url, replies = search_server
+    replies.append((500, {}))
+    web_client = RecordingAsyncWebClient()
+    handler = make_handler(url, web_client)
+
+    response = handler.handle(MessageEvent(user_id="user1", text="search query", ts="1234"))
+
+    assert response == ("QUERY ERROR", 404)
+    assert handler.search_client.stats["attempts"] == 1
+    assert web_client.posts == [{"channel": "user1", "text": ERROR_TEXT}]
+
+
+def test_stream_cut_short_replaces_the_placeholder(search_server):
+    url, replies = search_server
+    replies.append((200, [{"event": "search_output", "search_output": [["Title1", "http://link1"]]},
+                          {"event": "chunk", "text": "Half an"}]))
+    web_client = RecordingAsyncWebClient()
+    handler = make_handler(url, web_client, stream_answers=True)
+
+    response = handler.handle(MessageEvent(user_id="user1", text="search query", ts="1234"))
+
+    assert response == ("OK", 200)
+    assert web_client.posts[0]["text"] == "_Thinking..._"
+    assert web_client.updates[0]["text"] == "*Half an*"
+    assert web_client.updates[-1] == {"channel": "D1", "ts": "100.1", "text": ERROR_TEXT}
+    handler.feedback.record_query.assert_not_called()
+
+
+def test_stream_error_is_reported_once(search_server):
+    url, replies = search_server
+    # the connection drops after the placeholder was posted
+    replies.append((200, [{"event": "search_output", "search_output": [["Title1", "http://link1"]]}, None]))
+    web_client = RecordingAsyncWebClient()
+    handler = make_handler(url, web_client, stream_answers=True)
+
+    response = handler.handle(MessageEvent(user_id="user1", text="search query", ts="1234"))
+
+    assert response == ("QUERY ERROR", 404)
+    # the error replaces the placeholder and is not posted a second time
+    assert web_client.updates[-1] == {"channel": "D1", "ts": "100.1", "text": ERROR_TEXT}
+    assert ERROR_TEXT not in [post.get("text") for post in web_client.posts]
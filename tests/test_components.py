@@ -0,0 +1,85 @@
+import os
+import sys
+import threading
+from time import sleep
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../cloud_functions/main_logic"))
+from components import LazyComponents  # noqa: E402
+
+
+def wait_for(condition, timeout=5):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return True
+        sleep(0.01)
+    return False
+
+
+def test_components_are_built_once_on_first_use():
+    components = LazyComponents()
+    built = []
+
+    @components.register('secret')
+    def _secret():
+        built.append('secret')
+        sleep(0.05)
+        return "s3cret"
+
+    @components.register('client', eager=False)
+    def _client():
+        built.append('client')
+        return f"client({components.get('secret')})"
+
+    assert built == []
+    threads = [threading.Thread(target=components.get, args=('client',)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert components.get('client') == "client(s3cret)"
+    assert built == ['client', 'secret']
+    assert set(components.timings) == {'secret', 'client'}
+
+
+def test_warmup_builds_only_eager_components_and_survives_failures():
+    components = LazyComponents()
+    attempts = []
+
+    @components.register('broken')
+    def _broken():
+        attempts.append('broken')
+        if len(attempts) == 1:
+            raise ConnectionError("secret manager unavailable")
+        return "recovered"
+
+    @components.register('redis')
+    def _redis():
+        return "redis"
+
+    @components.register('hyde', eager=False)
+    def _hyde():
+        raise AssertionError("built on demand only")
+
+    components.warmup()
+    assert wait_for(lambda: 'redis' in components._values and attempts)
+    sleep(0.05)
+    assert 'hyde' not in components._values
+    assert 'broken' not in components._values
+
+    # a failed build is not cached, the next request retries it
+    assert components.get('broken') == "recovered"
+    assert attempts == ['broken', 'broken']
+
+
+def test_failed_build_raises_to_the_caller():
+    components = LazyComponents()
+
+    @components.register('cohere', eager=False)
+    def _cohere():
+        raise KeyError('COHERE_API_KEY')
+
+    with pytest.raises(KeyError):
+        components.get('cohere')
+    assert 'cohere' not in components.timings
@@ -0,0 +1,64 @@
+import os
+import sys
+
+from langchain.schema import Document
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../cloud_functions/main_logic"))
+from context_packer import PROMPT_OVERHEAD_TOKENS, ContextPacker, estimate_tokens  # noqa: E402
+
+BOILERPLATE = "This page is maintained by the platform team and reviewed every quarter."
+
+
+def doc(text, score):
+    return Document(page_content=text, metadata={"relevance_score": score})
+
+
+def test_documents_are_packed_by_relevance_within_the_budget():
+    packer = ContextPacker(token_budget=2000)
+    docs = [doc("Deploys run from the release pipeline.", 0.2), doc("Keys are rotated in the vault every month.", 0.9)]
+
+    packed, stats = packer.pack(docs, "how are keys rotated")
+
+    assert [d.page_content for d in packed] == ["Keys are rotated in the vault every month.",
+                                                "Deploys run from the release pipeline."]
+    assert packed[0].metadata == {"relevance_score": 0.9}
+    assert stats["prompt_tokens"] <= packer.token_budget
+    assert stats["prompt_tokens"] == (PROMPT_OVERHEAD_TOKENS + estimate_tokens("how are keys rotated")
+                                      + sum(estimate_tokens(d.page_content) for d in packed))
+
+
+def test_repeated_sentences_are_dropped():
+    packer = ContextPacker(token_budget=2000)
+    docs = [doc(f"Keys are rotated in the vault. {BOILERPLATE}", 0.9),
+            doc(f"{BOILERPLATE} Rotation is automated by a weekly job. {BOILERPLATE}", 0.8)]
+
+    packed, stats = packer.pack(docs, "key rotation")
+
+    assert packed[1].page_content == "Rotation is automated by a weekly job."
+    assert stats["duplicate_sentences"] == 2
+
+
+def test_document_over_the_budget_keeps_the_sentences_about_the_question():
+    filler = " ".join(f"Section {i} covers office seating plans and lunch menus." for i in range(40))
+    text = f"{filler} To rotate keys open the vault and press rotate. {filler.replace('Section', 'Part')}"
+    packer = ContextPacker(token_budget=PROMPT_OVERHEAD_TOKENS + 60)
+
+    packed, stats = packer.pack([doc(text, 0.9)], "rotate keys")
+
+    assert "To rotate keys open the vault and press rotate." in packed[0].page_content
+    assert stats["trimmed_sentences"] > 0
+    assert stats["prompt_tokens"] <= packer.token_budget
+    assert estimate_tokens(packed[0].page_content) < estimate_tokens(text)
+
+
+def test_documents_past_the_budget_are_left_out():
+    packer = ContextPacker(token_budget=PROMPT_OVERHEAD_TOKENS + 30, max_documents=10)
+    docs = [doc("Alpha beta gamma delta epsilon zeta eta theta iota kappa lambda mu.", 0.9),
+            doc("Nu xi omicron pi rho sigma tau upsilon phi chi psi omega.", 0.8),
+            doc("One two three four five six seven eight nine ten eleven twelve.", 0.7)]
+
+    packed, stats = packer.pack(docs, "q")
+
+    assert 0 < len(packed) < len(docs)
+    assert stats["prompt_tokens"] <= packer.token_budget
+    assert stats["source_tokens"] == sum(estimate_tokens(d.page_content) for d in docs)
@@ -0,0 +1,59 @@
+import base64
+import json
+import os
+import sys
+from unittest.mock import patch
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import credentials_cache  # noqa: E402
+from credentials_cache import ID_TOKEN_REFRESH_MARGIN, SECRET_TTL, get_id_token, get_secret  # noqa: E402
+
+
+def jwt(exp):
+    """unsigned JWT carrying only the exp claim"""
+    payload = base64.urlsafe_b64encode(json.dumps({"exp": exp}).encode()).rstrip(b"=").decode()
+    return f"header.{payload}.signature"
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(credentials_cache, "time", lambda: now[0])
+    # every test starts from an empty cache
+    monkeypatch.setattr(credentials_cache, "_cache", credentials_cache._TTLCache())
+    return now
+
+
+def test_id_token_is_refreshed_before_it_expires(clock):
+    tokens = iter([jwt(4600), jwt(8200)])
+    with patch("credentials_cache.id_token.fetch_id_token", side_effect=lambda request, audience: next(tokens)) as fetch:
+        assert get_id_token("https://search") == jwt(4600)
+        clock[0] = 4600 - ID_TOKEN_REFRESH_MARGIN - 1
+        assert get_id_token("https://search") == jwt(4600)
+        assert fetch.call_count == 1
+
+        # inside the margin a new token is fetched while the old one is still valid
+        clock[0] = 4600 - ID_TOKEN_REFRESH_MARGIN
+        assert get_id_token("https://search") == jwt(8200)
+        assert fetch.call_count == 2
+
+
+def test_id_tokens_are_cached_per_audience(clock):
+    with patch("credentials_cache.id_token.fetch_id_token", return_value=jwt(4600)) as fetch:
+        get_id_token("https://search")
+        get_id_token("https://handle")
+        get_id_token("https://search")
+    assert [call.args[1] for call in fetch.call_args_list] == ["https://search", "https://handle"]
+
+
+def test_secret_is_read_again_after_its_ttl(clock):
+    values = iter(["old", "new"])
+    with patch("credentials_cache.read_secret", side_effect=lambda secret_id, project_id: next(values)) as read:
+        assert get_secret("BOT_TOKEN", "project") == "old"
+        clock[0] += SECRET_TTL - 1
+        assert get_secret("BOT_TOKEN", "project") == "old"
+        clock[0] += 1
+        assert get_secret("BOT_TOKEN", "project") == "new"
+    assert read.call_count == 2
@@ -0,0 +1,53 @@
+import os
+import sys
+
+from langchain.schema import Document
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../cloud_functions/main_logic"))
+from doc_metadata import DocMeta, DocMetadataIndex, canonicalize_url  # noqa: E402
+
+
+def doc(doc_id, title=None, url=None):
+    metadata = {"id": doc_id}
+    if title:
+        metadata.update(title=title, url=url)
+    return Document(page_content=f"content of {doc_id}", metadata=metadata)
+
+
+def test_canonical_urls_drop_tracking_and_formatting():
+    assert canonicalize_url("HTTPS://Docs.Example.com:443/page/?utm_source=x&b=2&a=1#top") == "https://docs.example.com/page?a=1&b=2"
+
+
+def test_documents_without_metadata_are_described_from_the_index():
+    index = DocMetadataIndex()
+    index.describe([doc("1", "Title", "http://link1")])
+
+    described = index.describe([doc("1"), doc("2")])
+
+    assert described == [("1", DocMeta("Title", "http://link1")), ("2", None)]
+
+
+def test_fresh_metadata_wins_over_the_cache():
+    index = DocMetadataIndex()
+    index.describe([doc("1", "Old title", "http://link1")])
+
+    assert index.describe([doc("1", "New title", "http://link1")]) == [("1", DocMeta("New title", "http://link1"))]
+    assert index.describe([doc("1")]) == [("1", DocMeta("New title", "http://link1"))]
+
+
+def test_least_recently_used_entries_are_evicted():
+    index = DocMetadataIndex(max_entries=2)
+    index.describe([doc("1", "One", "http://link1"), doc("2", "Two", "http://link2")])
+    index.describe([doc("1")])
+    index.describe([doc("3", "Three", "http://link3")])
+
+    assert index.describe([doc("1"), doc("2"), doc("3")]) == [("1", DocMeta("One", "http://link1")), ("2", None),
+                                                             ("3", DocMeta("Three", "http://link3"))]
+
+
+def test_search_output_is_deduplicated_on_canonical_urls():
+    index = DocMetadataIndex()
+    docs = [doc("1", "Page", "https://example.com/page"), doc("2", "Page again", "https://example.com/page/?utm_campaign=x"),
+            doc("3"), doc("4", "Other", "https://example.com/other")]
+
+    assert index.search_output(docs) == [("Page", "https://example.com/page"), ("Other", "https://example.com/other")]
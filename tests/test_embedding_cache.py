@@ -0,0 +1,60 @@
+import os
+import sys
+
+import fakeredis
+import numpy as np
+import pytest
+from langchain.embeddings.base import Embeddings
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../cloud_functions/main_logic"))
+from embedding_cache import CachedEmbeddings  # noqa: E402
+
+DIM = 768
+
+
+class CountingEmbeddings(Embeddings):
+    def __init__(self):
+        self.calls = 0
+
+    def embed_query(self, text):
+        self.calls += 1
+        return np.random.default_rng(len(text)).standard_normal(DIM).tolist()
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+
+@pytest.mark.parametrize("dtype,tolerance", [("float16", 1e-2), ("float32", 1e-6)])
+def test_redis_round_trip(dtype, tolerance):
+    r = fakeredis.FakeRedis()
+    model = CountingEmbeddings()
+    computed = CachedEmbeddings(model, "gecko", r, dtype=dtype).embed_query("How do I rotate keys?")
+
+    # a fresh instance has an empty memory and reads the stored bytes
+    other = CachedEmbeddings(model, "gecko", r, dtype=dtype)
+    restored = other.embed_query("how do i rotate keys")
+
+    assert model.calls == 1
+    assert len(restored) == DIM
+    assert np.allclose(restored, computed, atol=tolerance * np.abs(computed).max())
+    (key,) = r.keys()
+    assert len(r.get(key)) == DIM * np.dtype(dtype).itemsize
+    assert f":{dtype}:".encode() in key
+
+
+def test_memory_hits_and_lru():
+    model = CountingEmbeddings()
+    cache = CachedEmbeddings(model, "gecko", max_entries=2)
+    for text in ("a", "bb", "a", "ccc", "bb"):
+        cache.embed_query(text)
+    # "bb" was the least recently used when "ccc" came in
+    assert model.calls == 4
+    assert list(cache._memory) == [cache._key("ccc"), cache._key("bb")]
+
+
+def test_models_do_not_share_entries():
+    r = fakeredis.FakeRedis()
+    model = CountingEmbeddings()
+    CachedEmbeddings(model, "gecko", r).embed_query("question")
+    CachedEmbeddings(model, "hyde-gecko", r).embed_query("question")
+    assert model.calls == 2
@@ -0,0 +1,64 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from events import (FeedbackEvent, MessageEvent, ShowMoreEvent, decode_event, decode_request,  # noqa: E402
+                    from_list, from_slack)
+
+EVENTS = [
+    MessageEvent(text="how do I rotate keys", ts="1.0", app_id="A1", event_id="Ev1", trace_id="t1", user_id="user1"),
+    FeedbackEvent(question_ts="1.0", feedback=-1, action_ts="2.0", app_id="A1", user_id="user1"),
+    ShowMoreEvent(callback_id="user1_1.0_2", action_ts="3.0", app_id="A1", user_id="user1"),
+]
+
+
+@pytest.mark.parametrize("event", EVENTS, ids=lambda event: event.kind)
+def test_positional_round_trip(event):
+    assert repr(from_list(event.to_list())) == repr(event)
+    assert repr(decode_event(event.encode())) == repr(event)
+    assert repr(decode_request(event.encode())) == repr(event)
+
+
+@pytest.mark.parametrize("event", EVENTS, ids=lambda event: event.kind)
+def test_slack_payload_round_trip(event):
+    # app_id of a message comes from the Pub/Sub attributes, interactive payloads carry it
+    decoded = from_slack(event.to_slack(), event.app_id, event.event_id, event.trace_id)
+    assert repr(decoded) == repr(event)
+
+
+def test_legacy_pubsub_payload_is_decoded():
+    payload = {"type": "message", "user": "user1", "text": "how do I rotate keys", "ts": "1.0"}
+    # the first publisher encoded the payload twice
+    event = decode_event(json.dumps(json.dumps(payload)).encode())
+    assert isinstance(event, MessageEvent)
+    assert (event.user_id, event.text, event.ts, event.namespace) == ("user1", "how do I rotate keys", "1.0", "user1")
+
+
+def test_legacy_workflow_body_is_decoded():
+    body = {"data": {"type": "interactive_message", "callback_id": "feedback_user1_1.0", "actions": [{"value": "👍"}],
+                     "action_ts": "2.0", "original_message": {"app_id": "A1"}},
+            "app_id": "A1", "user_id": "namespace1"}
+    event = decode_request(json.dumps(body).encode())
+    assert repr(event) == repr(FeedbackEvent(question_ts="1.0", feedback=1, action_ts="2.0", app_id="A1", user_id="user1"))
+
+
+def test_workflow_argument_sets_the_namespace():
+    event = EVENTS[0]
+    body = {"data": event.to_slack(), "app_id": "A1", "event": event.to_list(), "user_id": "namespace1"}
+    decoded = decode_request(json.dumps(body).encode())
+    assert decoded.namespace == "namespace1"
+    assert decoded.event_id == "Ev1"
+
+
+@pytest.mark.parametrize("payload", [
+    {"type": "message", "subtype": "message_changed", "message": {"user": "user1", "text": "edited"}, "ts": "1.0"},
+    {"type": "message", "subtype": "message_deleted", "ts": "1.0"},
+    {"type": "message", "subtype": "bot_message", "text": "an answer", "ts": "1.0"},
+])
+def test_subtypes_without_user_or_text_are_dropped(payload):
+    assert from_slack(payload) is None
+    assert decode_event(json.dumps(payload).encode()) is None
+    assert decode_request(json.dumps({"data": payload, "app_id": "A1"}).encode()) is None
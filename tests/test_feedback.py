@@ -0,0 +1,122 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../cloud_functions/handle_messages"))
+from feedback_store import FeedbackPipeline  # noqa: E402
+
+
+class InMemoryDocument:
+    def __init__(self, store, path):
+        self.store = store
+        self.path = path
+
+
+class InMemoryBatch:
+    def __init__(self, db):
+        self.db = db
+        self.writes = []
+
+    def set(self, document, fields, merge=False):
+        self.writes.append((document.path, dict(fields), merge))
+
+    def commit(self):
+        self.db.commits += 1
+        if self.db.fail_commits:
+            self.db.fail_commits -= 1
+            raise RuntimeError("deadline exceeded")
+        for path, fields, merge in self.writes:
+            self.db.documents[path] = {**self.db.documents.get(path, {}), **fields} if merge else fields
+
+
+class InMemoryCollection:
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+
+    def document(self, doc_id):
+        return InMemoryDocument(self.db, (self.name, doc_id))
+
+
+class InMemoryFirestore:
+    """The part of firestore.Client the feedback pipeline uses"""
+
+    def __init__(self):
+        self.documents = {}
+        self.commits = 0
+        self.fail_commits = 0
+
+    def collection(self, name):
+        return InMemoryCollection(self, name)
+
+    def batch(self):
+        return InMemoryBatch(self)
+
+
+@pytest.fixture
+def db():
+    return InMemoryFirestore()
+
+
+@pytest.fixture
+def pipeline(db):
+    return FeedbackPipeline(db, batch_size=2, background=False)
+
+
+def test_feedback_upserts_without_query_record(db, pipeline):
+    pipeline.record_feedback("user1", "1234", 1)
+
+    assert pipeline.flush() == 1
+    assert db.documents[("slackbot_feedback", "user1_1234")]["feedback"] == 1
+
+
+def test_query_and_feedback_merge_into_one_document(db, pipeline):
+    pipeline.record_query("user1", "1234", "search query", ["http://link1", "http://link2"], 812.34)
+    pipeline.record_feedback("user1", "1234", -1)
+    pipeline.record_feedback("user2", "5678", 1)
+
+    assert pipeline.flush() == 3
+    # batch_size is 2, so three records go out in two batches
+    assert db.commits == 2
+    document = db.documents[("slackbot_feedback", "user1_1234")]
+    assert document["query"] == "search query"
+    assert document["urls"] == ["http://link1", "http://link2"]
+    assert document["latency_ms"] == 812.3
+    assert document["feedback"] == -1
+    assert db.documents[("slackbot_feedback", "user2_5678")]["feedback"] == 1
+
+
+def test_feedback_after_flushed_query_keeps_query_fields(db, pipeline):
+    pipeline.record_query("user1", "1234", "search query", [], 100)
+    pipeline.flush()
+    pipeline.record_feedback("user1", "1234", 1)
+    pipeline.flush()
+
+    document = db.documents[("slackbot_feedback", "user1_1234")]
+    assert document["query"] == "search query"
+    assert document["feedback"] == 1
+
+
+def test_failed_batch_is_retried(db, pipeline):
+    db.fail_commits = 1
+    pipeline.record_feedback("user1", "1234", 1)
+
+    assert pipeline.flush() == 0
+    assert pipeline.stats["failed_batches"] == 1
+    assert pipeline.flush() == 1
+    assert db.documents[("slackbot_feedback", "user1_1234")]["feedback"] == 1
+
+
+def test_records_dropped_after_max_attempts(db):
+    pipeline = FeedbackPipeline(db, max_attempts=2, background=False)
+    db.fail_commits = 5
+    pipeline.record_feedback("user1", "1234", 1)
+
+    pipeline.flush()
+    pipeline.flush()
+
+    assert pipeline.stats["dropped"] == 1
+    assert pipeline.flush() == 0
+    assert db.documents == {}
@@ -2,68 +2,104 @@ import pytest
 from unittest.mock import MagicMock, patch
 import json
 from typing import Tuple
+import requests
 from requests import Request
-from cloudfunctions.handle_messages.handle_message import handle_message  # Replace with the actual module name
+from handle_message import handle_message
 
 
 @pytest.fixture
 def mock_logger():
-    with patch("cloudfunctions.handle_messages.handle_message.logger") as logger:
+    with patch("handle_message.logger") as logger:
         yield logger
 
 
 @pytest.fixture
-def mock_db():
-    with patch("cloudfunctions.handle_messages.handle_message.db") as db:
-        yield db
+def mock_feedback():
+    with patch("handle_message.feedback") as feedback:
+        yield feedback
 
 
 @pytest.fixture
 def mock_r():
-    with patch("cloudfunctions.handle_messages.handle_message.r") as r:
+    with patch("handle_message.r") as r:
         yield r
 
 
 @pytest.fixture
 def mock_client():
-    with patch("cloudfunctions.handle_messages.handle_message.client") as client:
+    with patch("handle_message.client") as client:
         yield client
 
 
 @pytest.fixture
 def mock_id_token():
-    with patch("cloudfunctions.handle_messages.handle_message.id_token") as id_token:
-        yield id_token
+    with patch("handle_message.get_id_token") as get_id_token:
+        yield get_id_token
 
 
 @pytest.fixture
 def mock_requests():
-    with patch("cloudfunctions.handle_messages.handle_message.requests.post") as requests_post:
-        yield requests_post
+    # the search call goes through the pooled SearchClient, not requests.post
+    with patch("handle_message.search_client") as search_client:
+        yield search_client.post
 
 @pytest.mark.integration
 def test_handle_message_feedback(
-    mock_db
+    mock_feedback
 ):
     # Mock request data
     mock_request = MagicMock(spec=Request)
-    mock_request.data = b'{"data": {"type": "interactive_message", "callback_id": "feedback_user1_1234", "actions": [{"value": "👍"}]}}'
+    mock_request.data = '{"data": {"type": "interactive_message", "callback_id": "feedback_user1_1234", "actions": [{"value": "👍"}]}}'.encode()
 
     # Call the function
     response = handle_message(mock_request)
 
-    # Assertions for feedback
-    mock_db.collection.assert_called_with("slackbot_feedback")
-    mock_db.collection().document.assert_called_with("user1_1234")
-    mock_db.collection().document().update.assert_called_with({"feedback": 1})
+    # Assertions for feedback, queued and committed before the request returns
+    mock_feedback.record_feedback.assert_called_once_with("user1", "1234", 1)
+    mock_feedback.flush.assert_called_once_with()
+    assert response == ("OK", 200)
+
+@pytest.mark.integration
+def test_handle_message_feedback_without_firestore():
+    mock_request = MagicMock(spec=Request)
+    mock_request.data = '{"data": {"type": "interactive_message", "callback_id": "feedback_user1_1235", "actions": [{"value": "👍"}]}}'.encode()
+
+    # the click is acknowledged even when the Firestore client could not be created
+    with patch("handle_message.feedback", None):
+        assert handle_message(mock_request) == ("OK", 200)
+
+@pytest.mark.integration
+def test_handle_message_showmore_page(
+    mock_r, mock_client
+):
+    # Mock the pre-rendered second page
+    page = {"attachments": [{"fallback": "Your search results are ready!", "color": "#DBB0CE",
+                             "title": "Title11", "title_link": "http://link11"}]}
+    mock_r.hget.return_value = json.dumps(page).encode()
+
+    # Mock request data
+    mock_request = MagicMock(spec=Request)
+    mock_request.data = b'{"data": {"type": "interactive_message", "callback_id": "user1_1234:2", "user": {"id": "user1"}}}'
+
+    # Call the function
+    response = handle_message(mock_request)
+
+    # a click is one HGET and one message
+    mock_r.hget.assert_called_once_with("slackbot_showmore:user1_1234", "page.2")
+    mock_r.hgetall.assert_not_called()
+    mock_client.chat_postMessage.assert_called_once_with(channel="user1", **page)
     assert response == ("OK", 200)
 
 @pytest.mark.integration
 def test_handle_message_showmore(
     mock_r, mock_client
 ):
-    # Mock Redis data
+    # Mock Redis data cached before pages were pre-rendered
+    mock_r.hget.return_value = None
     mock_r.hgetall.return_value = {
+        b"search_results.0": b"Top1$$$http://top1",
+        b"search_results.1": b"Top2$$$http://top2",
+        b"search_results.2": b"Top3$$$http://top3",
         b"search_results.3": b"Title1$$$http://link1",
         b"search_results.4": b"Title2$$$http://link2",
     }
@@ -77,7 +113,7 @@ def test_handle_message_showmore(
 
     # Assertions for show more
     mock_r.hgetall.assert_called_with("slackbot_showmore:user1_1234")
-    mock_client.chat_postMessage.assert_any_call(
+    mock_client.chat_postMessage.assert_called_once_with(
         channel="user1",
         attachments=[
             {
@@ -85,7 +121,13 @@ def test_handle_message_showmore(
                 "color": "#DBB0CE",
                 "title": "Title1",
                 "title_link": "http://link1",
-            }
+            },
+            {
+                "fallback": "Your search results are ready!",
+                "color": "#411C50",
+                "title": "Title2",
+                "title_link": "http://link2",
+            },
         ],
     )
     assert response == ("OK", 200)
@@ -111,25 +153,114 @@ def test_handle_message_initial_message(
     )
 
     # Mock token
-    mock_id_token.fetch_id_token.return_value = "mock_token"
+    mock_id_token.return_value = "mock_token"
 
     # Call the function
     response = handle_message(mock_request)
 
     # Assertions for initial message
     mock_requests.assert_called_once()
-    mock_client.chat_postMessage.assert_any_call(
-        channel="user1", text="*Here are your results.*"
-    )
-    mock_client.chat_postMessage.assert_any_call(
-        channel="user1",
-        attachments=[
-            {
-                "fallback": "Your search results are ready!",
-                "color": "#DBB0CE",
-                "title": "Title1",
-                "title_link": "http://link1",
-            }
-        ],
+    # the answer, the results and both button rows go out in a single message
+    mock_client.chat_postMessage.assert_called_once()
+    kwargs = mock_client.chat_postMessage.call_args.kwargs
+    assert kwargs["channel"] == "user1"
+    assert kwargs["text"] == "*Here are your results.*"
+    assert kwargs["attachments"][0] == {
+        "fallback": "Your search results are ready!",
+        "color": "#DBB0CE",
+        "title": "Title1",
+        "title_link": "http://link1",
+    }
+    assert [a.get("callback_id") for a in kwargs["attachments"][3:]] == ["user1_1234", "feedback_user1_1234"]
+    assert response == ("OK", 200)
+
+@pytest.mark.integration
+def test_handle_message_failed_search_is_retried(
+    mock_client, mock_id_token, mock_requests
+):
+    # Mock request data
+    mock_request = MagicMock(spec=Request)
+    mock_request.data = b'{"data": {"type": "initial_message", "text": "failing query", "user": "user1", "ts": "5678"}}'
+    mock_id_token.return_value = "mock_token"
+
+    # the first delivery fails before anything is posted, the workflow retry has to search again
+    mock_requests.side_effect = RuntimeError("search down")
+    with pytest.raises(RuntimeError):
+        handle_message(mock_request)
+    mock_client.chat_postMessage.assert_not_called()
+    mock_requests.side_effect = None
+    mock_requests.return_value.text = json.dumps(
+        {"chat_response": {"output_text": "Found it."}, "search_output": [["Title1", "http://link1"]]}
     )
+    assert handle_message(mock_request) == ("OK", 200)
+    assert mock_requests.call_count == 2
+
+    # a redelivery of the answered event is dropped
+    assert handle_message(mock_request) == ("OK", 200)
+    assert mock_requests.call_count == 2
+
+@pytest.mark.integration
+def test_handle_message_reported_error_is_not_retried(
+    mock_client, mock_id_token, mock_requests
+):
+    # Mock request data
+    mock_request = MagicMock(spec=Request)
+    mock_request.data = b'{"data": {"type": "initial_message", "text": "failing query", "user": "user1", "ts": "5679"}}'
+    mock_id_token.return_value = "mock_token"
+
+    # the error reply is posted once, a workflow retry must not post it again or a late answer
+    mock_requests.side_effect = requests.exceptions.ConnectionError("search down")
+    assert handle_message(mock_request) == ("QUERY ERROR", 404)
+    assert handle_message(mock_request) == ("OK", 200)
+    assert mock_requests.call_count == 1
+    assert mock_client.chat_postMessage.call_count == 1
+
+@pytest.mark.integration
+def test_handle_message_stream_cut_short(
+    mock_client, mock_id_token, mock_requests
+):
+    # Mock request data
+    mock_request = MagicMock(spec=Request)
+    mock_request.data = b'{"data": {"type": "initial_message", "text": "streamed query", "user": "user1", "ts": "9012"}}'
+    mock_id_token.return_value = "mock_token"
+
+    # the stream ends after the results, without 'done' or 'error'
+    mock_requests.return_value.iter_lines.return_value = [
+        json.dumps({"event": "search_output", "search_output": [["Title1", "http://link1"]]}).encode(),
+        json.dumps({"event": "chunk", "text": "Half an"}).encode(),
+    ]
+    mock_client.chat_postMessage.return_value = {"channel": "D1", "ts": "9013"}
+
+    with patch("handle_message.stream_answers", True):
+        response = handle_message(mock_request)
+
+    # the placeholder does not stay on "Thinking..."
+    kwargs = mock_client.chat_update.call_args.kwargs
+    assert (kwargs["channel"], kwargs["ts"]) == ("D1", "9013")
+    assert kwargs["text"].startswith("*Sorry, we encountered an error.")
     assert response == ("OK", 200)
+
+@pytest.mark.integration
+def test_handle_message_stream_error_is_reported_once(
+    mock_client, mock_id_token, mock_requests
+):
+    # Mock request data
+    mock_request = MagicMock(spec=Request)
+    mock_request.data = b'{"data": {"type": "initial_message", "text": "streamed query", "user": "user1", "ts": "9112"}}'
+    mock_id_token.return_value = "mock_token"
+
+    # the connection drops after the placeholder was posted
+    def lines():
+        yield json.dumps({"event": "search_output", "search_output": [["Title1", "http://link1"]]}).encode()
+        raise requests.exceptions.ChunkedEncodingError("connection reset")
+    mock_requests.return_value.iter_lines.side_effect = lines
+    mock_client.chat_postMessage.return_value = {"channel": "D1", "ts": "9113"}
+
+    with patch("handle_message.stream_answers", True):
+        response = handle_message(mock_request)
+
+    # the error replaces the placeholder and is not posted a second time
+    assert mock_client.chat_update.call_args.kwargs["text"].startswith("*Sorry, we encountered an error.")
+    posted = [call.kwargs.get("text", "") for call in mock_client.chat_postMessage.call_args_list]
+    assert not any(text.startswith("*Sorry") for text in posted)
+    assert response == ("QUERY ERROR", 404)
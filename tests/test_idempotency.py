@@ -0,0 +1,71 @@
+import os
+import sys
+
+import fakeredis
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from events import FeedbackEvent, MessageEvent, ShowMoreEvent  # noqa: E402
+from idempotency import IdempotencyStore  # noqa: E402
+
+
+def test_envelope_event_id_takes_precedence():
+    assert MessageEvent(text="q", ts="1.0", user_id="user1", event_id="Ev1").dedup_key() == "Ev1"
+    assert MessageEvent(text="q", ts="1.0", user_id="user1").dedup_key() == "user1:1.0"
+    assert MessageEvent(text="q").dedup_key() is None
+    assert FeedbackEvent(question_ts="1.0", feedback=1, action_ts="2.0", user_id="user1", event_id="Ev1").dedup_key() == "Ev1"
+    assert FeedbackEvent(question_ts="1.0", feedback=1, action_ts="2.0", user_id="user1").dedup_key() == "feedback_user1_1.0:2.0"
+    assert FeedbackEvent(question_ts="1.0", feedback=1, user_id="user1").dedup_key() is None
+    assert ShowMoreEvent(callback_id="user1_1.0_2", action_ts="3.0", user_id="user1").dedup_key() == "user1_1.0_2:3.0"
+    assert ShowMoreEvent(callback_id="user1_1.0_2", user_id="user1").dedup_key() is None
+
+
+def test_events_without_a_key_always_pass():
+    store = IdempotencyStore("stage", fakeredis.FakeRedis())
+    assert store.first_seen(None)
+    assert store.first_seen(None)
+
+
+def test_redelivery_is_dropped_on_the_same_and_another_instance():
+    r = fakeredis.FakeRedis()
+    store = IdempotencyStore("stage", r)
+    assert store.first_seen("user1:1.0")
+    assert not store.first_seen("user1:1.0")
+    assert not IdempotencyStore("stage", r).first_seen("user1:1.0")
+    # every stage processes the event once
+    assert IdempotencyStore("other_stage", r).first_seen("user1:1.0")
+    assert store.stats == {'processed': 1, 'dropped': 1}
+
+
+def test_released_event_is_processed_again():
+    r = fakeredis.FakeRedis()
+    store = IdempotencyStore("stage", r)
+    store.first_seen("user1:1.0")
+    store.release("user1:1.0")
+    assert IdempotencyStore("stage", r).first_seen("user1:1.0")
+    store.release("user1:1.0")
+    assert store.first_seen("user1:1.0")
+
+
+def test_least_recently_seen_keys_leave_the_front():
+    store = IdempotencyStore("stage", front_size=2)
+    for key in ("a", "b", "c"):
+        store.first_seen(key)
+    assert store.first_seen("a")
+    assert not store.first_seen("c")
+
+
+@pytest.fixture
+def down_redis():
+    server = fakeredis.FakeServer()
+    server.connected = False
+    return fakeredis.FakeRedis(server=server)
+
+
+def test_redis_errors_fall_back_to_the_front(down_redis):
+    store = IdempotencyStore("stage", down_redis)
+    # better processed twice than lost, the in-memory front still drops repeats on this instance
+    assert store.first_seen("user1:1.0")
+    assert not store.first_seen("user1:1.0")
+    store.release("user1:1.0")
+    assert store.first_seen("user1:1.0")
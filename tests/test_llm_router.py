@@ -0,0 +1,98 @@
+import os
+import sys
+from time import perf_counter, sleep
+
+import pytest
+from langchain.schema import Document
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../cloud_functions/main_logic"))
+import llm_router  # noqa: E402
+from llm_router import FAST, SLOW, LLMRouter  # noqa: E402
+
+
+class StubChain:
+    """QA chain answering after delay seconds"""
+
+    def __init__(self, answer="an answer", delay=0.0):
+        self.answer = answer
+        self.delay = delay
+        self.calls = 0
+
+    def __call__(self, inputs, return_only_outputs=False):
+        self.calls += 1
+        sleep(self.delay)
+        return {"output_text": self.answer}
+
+
+def scored(score):
+    return [Document(page_content="text", metadata={"relevance_score": score})]
+
+
+@pytest.fixture(autouse=True)
+def reset_stats():
+    for key in llm_router.llm_stats:
+        llm_router.llm_stats[key] = 0
+    yield
+
+
+def test_easy_question_is_answered_by_the_fast_tier():
+    fast, slow = StubChain("fast answer"), StubChain("slow answer")
+    router = LLMRouter(fast, slow, fast_deadline=1, slow_deadline=1)
+
+    response, tier = router.answer([], "short question", scored(0.9))
+
+    assert (response["output_text"], tier) == ("fast answer", FAST)
+    assert slow.calls == 0
+
+
+def test_hard_question_goes_to_the_slow_tier():
+    fast, slow = StubChain("fast answer"), StubChain("slow answer")
+    router = LLMRouter(fast, slow, fast_deadline=1, slow_deadline=1, hard_query_words=5)
+
+    assert router.answer([], "short question", scored(0.1))[1] == SLOW
+    assert router.answer([], "a question well over five words long", scored(0.9))[1] == SLOW
+    assert fast.calls == 0
+    assert llm_router.llm_stats["routed_slow"] == 2
+
+
+def test_missed_fast_deadline_escalates():
+    router = LLMRouter(StubChain("fast answer", delay=0.5), StubChain("slow answer"), fast_deadline=0.05, slow_deadline=1)
+
+    start = perf_counter()
+    response, tier = router.answer([], "short question", scored(0.9))
+
+    assert (response["output_text"], tier) == ("slow answer", SLOW)
+    assert perf_counter() - start < 0.4
+    assert llm_router.llm_stats["escalated_deadline"] == 1
+
+
+def test_empty_fast_answer_escalates():
+    router = LLMRouter(StubChain("  "), StubChain("slow answer"), fast_deadline=1, slow_deadline=1)
+
+    response, tier = router.answer([], "short question", scored(0.9))
+
+    assert (response["output_text"], tier) == ("slow answer", SLOW)
+    assert llm_router.llm_stats["escalated_empty"] == 1
+
+
+def test_slow_deadline_gives_an_empty_answer():
+    router = LLMRouter(StubChain(delay=0.5), StubChain(delay=0.5), fast_deadline=0.05, slow_deadline=0.05)
+
+    response, tier = router.answer([], "short question", scored(0.9))
+
+    assert (response["output_text"], tier) == ("", SLOW)
+    assert llm_router.llm_stats["timeouts"] == 1
+
+
+@pytest.mark.parametrize("fast_delay,slow_delay,winner", [(0.1, 0.5, FAST), (0.5, 0.05, SLOW)])
+def test_hedge_takes_the_first_answer(fast_delay, slow_delay, winner):
+    fast, slow = StubChain("fast answer", delay=fast_delay), StubChain("slow answer", delay=slow_delay)
+    router = LLMRouter(fast, slow, fast_deadline=1, slow_deadline=1, hedge_delay=0.02)
+
+    response, tier = router.answer([], "short question", scored(0.9))
+
+    assert tier == winner
+    assert response["output_text"] == f"{winner} answer"
+    assert slow.calls == 1
+    assert llm_router.llm_stats["hedged"] == 1
+    assert llm_router.llm_stats["hedge_slow_wins"] == (winner == SLOW)
@@ -0,0 +1,71 @@
+import os
+import sys
+from typing import List, NamedTuple
+
+import pytest
+from langchain.embeddings.base import Embeddings
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../cloud_functions/main_logic"))
+import local_index  # noqa: E402
+from local_index import LocalVectorStore, export_snapshot  # noqa: E402
+
+TOPICS = ["billing", "keys", "deploy", "alerts"]
+
+
+class Namespace(NamedTuple):
+    """the fields of a Matching Engine Namespace restrict the store reads"""
+    name: str
+    allow_tokens: List[str]
+    deny_tokens: List[str]
+
+
+class TopicEmbeddings(Embeddings):
+    """counts of the topic words, so the nearest documents are easy to tell"""
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        words = text.lower().split()
+        return [float(words.count(topic)) + 0.01 for topic in TOPICS]
+
+
+RECORDS = [
+    ("a1", "billing billing invoices", {"title": "Billing", "url": "http://a/billing"}, {"ids": ["userA"]}),
+    ("a2", "rotate keys keys", {"title": "Keys", "url": "http://a/keys"}, {"ids": ["userA"]}),
+    ("b1", "billing and deploy", {"title": "B billing", "url": "http://b/billing"}, {"ids": ["userB"]}),
+    ("b2", "deploy deploy pipeline", {"title": "Deploy", "url": "http://b/deploy"}, {"ids": ["userB"]}),
+    ("s1", "alerts and keys shared", {"title": "Shared", "url": "http://s/alerts"}, {"ids": ["userA", "userB"]}),
+]
+
+
+@pytest.fixture(params=[False, True], ids=["exhaustive", "ivf"])
+def store(request, tmp_path, monkeypatch):
+    if request.param:
+        monkeypatch.setattr(local_index, "IVF_MIN_ROWS", 4)
+    assert export_snapshot(str(tmp_path), RECORDS, TopicEmbeddings(), batch_size=2) == len(RECORDS)
+    # a large n_probe keeps the IVF search exact on this tiny snapshot
+    return LocalVectorStore(str(tmp_path), TopicEmbeddings(), n_probe=10)
+
+
+def test_round_trip_keeps_documents_and_metadata(store):
+    (doc, score), = store.similarity_search_with_score("billing", k=1)
+    assert doc.page_content == "billing billing invoices"
+    assert doc.metadata == {"title": "Billing", "url": "http://a/billing", "id": "a1"}
+    assert score == pytest.approx(1.0, abs=0.01)
+
+
+def test_namespace_restricts_are_applied(store):
+    user_b = [Namespace("ids", ["userB"], [])]
+    assert [doc.metadata["id"] for doc in store.similarity_search("billing", k=1, filter=user_b)] == ["b1"]
+    assert {doc.metadata["id"] for doc in store.similarity_search("billing", k=5, filter=user_b)} == {"b1", "b2", "s1"}
+    assert [doc.metadata["id"] for doc in store.similarity_search("keys", k=1, filter=user_b)] == ["s1"]
+
+    not_shared = [Namespace("ids", ["userA"], ["userB"])]
+    assert {doc.metadata["id"] for doc in store.similarity_search("keys", k=5, filter=not_shared)} == {"a1", "a2"}
+
+
+def test_has_namespace(store):
+    assert store.has_namespace([Namespace("ids", ["userA"], [])])
+    assert not store.has_namespace([Namespace("ids", ["userC"], [])])
+    assert store.has_namespace(None)
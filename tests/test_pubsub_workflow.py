@@ -0,0 +1,102 @@
+import base64
+import json
+import os
+import sys
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../cloud_functions/pubsub_workflow"))
+import pubsub_workflow  # noqa: E402
+from events import FeedbackEvent, MessageEvent, decode_request  # noqa: E402
+from pubsub_workflow import pub_sub_acknowledge_and_trigger_workflow  # noqa: E402
+
+
+def push_request(event, attributes=None):
+    """Pub/Sub push request carrying the encoded event"""
+    request = MagicMock(mimetype="application/json")
+    request.get_json.return_value = {"message": {"data": base64.b64encode(event).decode(), "attributes": attributes or {}}}
+    return request
+
+
+def question(ts):
+    return MessageEvent(text="how do I rotate keys", ts=ts, app_id="A1", user_id="user1").encode()
+
+
+@pytest.fixture
+def mock_id_token():
+    with patch("pubsub_workflow.get_id_token", return_value="mock_token") as get_id_token:
+        yield get_id_token
+
+
+@pytest.fixture
+def http_post():
+    with patch("pubsub_workflow.handle_message_url", "https://handle"), \
+            patch.object(pubsub_workflow.http_session, "post") as post:
+        yield post
+
+
+def test_workflow_argument_keeps_the_slack_payload():
+    with patch("pubsub_workflow.dispatch_mode", "workflow"), \
+            patch.object(pubsub_workflow.execution_client, "create_execution") as create_execution:
+        assert pub_sub_acknowledge_and_trigger_workflow(push_request(question("1.0"))) == ("OK", 200)
+
+    argument = json.loads(create_execution.call_args.kwargs["request"]["execution"]["argument"])
+    assert argument["data"] == {"type": "message", "user": "user1", "text": "how do I rotate keys", "ts": "1.0"}
+    assert argument["app_id"] == "A1"
+    assert decode_request(json.dumps(argument).encode()).text == "how do I rotate keys"
+
+
+def test_http_dispatch_posts_the_event(http_post, mock_id_token):
+    http_post.return_value = MagicMock(text="OK", status_code=200)
+    with patch("pubsub_workflow.dispatch_mode", "http"):
+        assert pub_sub_acknowledge_and_trigger_workflow(push_request(question("2.0"))) == ("OK", 200)
+        # the redelivery is dropped before any dispatch
+        assert pub_sub_acknowledge_and_trigger_workflow(push_request(question("2.0"))) == ("OK", 200)
+
+    http_post.assert_called_once()
+    assert http_post.call_args.args[0] == "https://handle"
+    assert http_post.call_args.kwargs["headers"]["Authorization"] == "Bearer mock_token"
+    assert decode_request(http_post.call_args.kwargs["data"]).ts == "2.0"
+
+
+def test_failed_dispatch_releases_the_key(http_post, mock_id_token):
+    http_post.return_value = MagicMock(text="unavailable", status_code=503)
+    with patch("pubsub_workflow.dispatch_mode", "http"):
+        assert pub_sub_acknowledge_and_trigger_workflow(push_request(question("3.0"))) == ("unavailable", 503)
+        http_post.return_value = MagicMock(text="OK", status_code=200)
+        # the Pub/Sub redelivery is dispatched again
+        assert pub_sub_acknowledge_and_trigger_workflow(push_request(question("3.0"))) == ("OK", 200)
+    assert http_post.call_count == 2
+
+
+def test_dispatch_error_releases_the_key(http_post, mock_id_token):
+    http_post.side_effect = ConnectionError("handle_message down")
+    with patch("pubsub_workflow.dispatch_mode", "http"):
+        assert pub_sub_acknowledge_and_trigger_workflow(push_request(question("4.0"))) == ("handle_message down", 500)
+        http_post.side_effect = None
+        http_post.return_value = MagicMock(text="OK", status_code=200)
+        assert pub_sub_acknowledge_and_trigger_workflow(push_request(question("4.0"))) == ("OK", 200)
+
+
+def test_inprocess_dispatch_calls_handle_message():
+    with patch("pubsub_workflow.dispatch_mode", "inprocess"), \
+            patch("handle_message.handle_message", return_value=("OK", 200)) as handle_message:
+        assert pub_sub_acknowledge_and_trigger_workflow(push_request(question("5.0"))) == ("OK", 200)
+
+    assert decode_request(handle_message.call_args.args[0].data).ts == "5.0"
+
+
+def test_interactive_clicks_use_their_own_mode(http_post, mock_id_token):
+    http_post.return_value = MagicMock(text="OK", status_code=200)
+    click = FeedbackEvent(question_ts="1.0", feedback=1, action_ts="6.0", user_id="user1").encode()
+    with patch("pubsub_workflow.dispatch_mode", "workflow"), patch("pubsub_workflow.interactive_dispatch_mode", "http"):
+        assert pub_sub_acknowledge_and_trigger_workflow(push_request(click)) == ("OK", 200)
+    http_post.assert_called_once()
+
+
+def test_dropped_subtype_is_acked(http_post):
+    edit = json.dumps({"type": "message", "subtype": "message_deleted", "ts": "7.0"}).encode()
+    with patch("pubsub_workflow.dispatch_mode", "http"):
+        assert pub_sub_acknowledge_and_trigger_workflow(push_request(edit)) == ("OK", 200)
+    http_post.assert_not_called()
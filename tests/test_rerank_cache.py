@@ -0,0 +1,92 @@
+import os
+import sys
+import threading
+from time import sleep
+
+import fakeredis
+from langchain.schema import Document
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../cloud_functions/main_logic"))
+import rerank_cache  # noqa: E402
+from rerank_cache import RerankLayer  # noqa: E402
+
+
+class ReversingCompressor:
+    """Cohere stand-in ranking the documents in reverse, optionally held until released"""
+
+    def __init__(self, top_n=3, hold=False):
+        self.top_n = top_n
+        self.calls = 0
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        if not hold:
+            self.release.set()
+
+    def compress_documents(self, documents, query):
+        self.calls += 1
+        self.entered.set()
+        self.release.wait(5)
+        return [Document(page_content=doc.page_content, metadata={**doc.metadata, "relevance_score": 0.9 - i / 10})
+                for i, doc in enumerate(reversed(documents[-self.top_n:]))]
+
+
+def retrieved(*scores):
+    return [Document(page_content=f"page {i}", metadata={"id": str(i), "vector_score": score}) for i, score in enumerate(scores)]
+
+
+def ids(docs):
+    return [doc.metadata["id"] for doc in docs]
+
+
+def test_ranking_is_cached_across_instances():
+    r = fakeredis.FakeRedis()
+    compressor = ReversingCompressor()
+    docs = retrieved(0.8, 0.79, 0.78)
+
+    first, outcome = RerankLayer(compressor, r).rerank(docs, "How do I rotate keys?")
+    assert (ids(first), outcome) == (["2", "1", "0"], "cohere")
+
+    # same query once normalized and the same documents in another order
+    cached, outcome = RerankLayer(compressor, r).rerank(list(reversed(docs)), "how do i rotate keys")
+    assert (ids(cached), outcome) == (["2", "1", "0"], "cache")
+    assert [doc.metadata["relevance_score"] for doc in cached] == [doc.metadata["relevance_score"] for doc in first]
+    assert compressor.calls == 1
+
+
+def test_skip_margin_keeps_a_decisive_vector_order():
+    compressor = ReversingCompressor(top_n=2)
+    layer = RerankLayer(compressor, skip_margin=0.1)
+
+    assert ids(layer.rerank(retrieved(0.9, 0.7, 0.6), "query")[0]) == ["0", "1"]
+    assert layer.rerank(retrieved(0.9, 0.7, 0.6), "query")[1] == "skipped"
+    assert layer.rerank(retrieved(0.9, 0.85, 0.6), "query")[1] == "cohere"
+    assert compressor.calls == 1
+
+
+def test_concurrent_requests_share_one_cohere_call():
+    compressor = ReversingCompressor(hold=True)
+    layer = RerankLayer(compressor)
+    docs = retrieved(0.8, 0.79, 0.78)
+    coalesced_before = rerank_cache.rerank_stats["coalesced"]
+    outcomes = []
+
+    def rerank():
+        ranked, outcome = layer.rerank(docs, "query")
+        outcomes.append((ids(ranked), outcome))
+
+    leader = threading.Thread(target=rerank)
+    leader.start()
+    assert compressor.entered.wait(5)
+    followers = [threading.Thread(target=rerank) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    while rerank_cache.rerank_stats["coalesced"] - coalesced_before < 3:
+        sleep(0.01)
+    compressor.release.set()
+    for thread in [leader, *followers]:
+        thread.join()
+
+    assert compressor.calls == 1
+    assert sorted(outcome for _, outcome in outcomes) == ["coalesced"] * 3 + ["cohere"]
+    assert {tuple(ranking) for ranking, _ in outcomes} == {("2", "1", "0")}
+    assert layer._inflight == {}
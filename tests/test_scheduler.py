@@ -0,0 +1,138 @@
+import os
+import sys
+import threading
+from time import sleep, time
+
+import fakeredis
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from events import MessageEvent, ShowMoreEvent  # noqa: E402
+from scheduler import INTERACTIVE, SEARCH, SearchScheduler  # noqa: E402
+
+
+def question(user_id, ts, text):
+    return MessageEvent(text=text, ts=ts, user_id=user_id)
+
+
+@pytest.fixture
+def scheduler():
+    return SearchScheduler(fakeredis.FakeRedis(), user_limit=1, global_limit=2, max_wait=2, poll_interval=0.01)
+
+
+def test_interactive_click_skips_a_full_queue(scheduler):
+    with scheduler.slot(question("user1", "1.0", "first")):
+        with scheduler.slot(ShowMoreEvent(callback_id="user1_1.0", user_id="user1")) as slot:
+            assert slot.priority == INTERACTIVE
+            assert not slot.superseded
+    assert scheduler.stats["interactive"] == 1
+
+
+def test_queued_questions_of_a_user_are_answered_in_order(scheduler):
+    order = []
+
+    def ask(ts, text):
+        with scheduler.slot(question("user1", ts, text)) as slot:
+            assert not slot.superseded
+            order.append(ts)
+
+    with scheduler.slot(question("user1", "1.0", "first")):
+        waiting = [threading.Thread(target=ask, args=("2.0", "how do I")), threading.Thread(target=ask, args=("3.0", "rotate keys"))]
+        for thread in waiting:
+            thread.start()
+            sleep(0.05)
+    for thread in waiting:
+        thread.join()
+
+    assert order == ["2.0", "3.0"]
+    assert scheduler.stats["superseded"] == 0
+
+
+def test_queued_repeats_of_a_question_are_coalesced(scheduler):
+    slots = {}
+
+    def ask(ts, text):
+        with scheduler.slot(question("user1", ts, text)) as slot:
+            slots[ts] = slot
+
+    with scheduler.slot(question("user1", "1.0", "first")):
+        waiting = [threading.Thread(target=ask, args=("2.0", "How do I rotate keys?")),
+                   threading.Thread(target=ask, args=("3.0", "how do i  rotate keys")),
+                   threading.Thread(target=ask, args=("4.0", "rotate keys"))]
+        for thread in waiting:
+            thread.start()
+            sleep(0.05)
+    for thread in waiting:
+        thread.join()
+
+    assert slots["2.0"].coalesced == 1
+    assert slots["3.0"].superseded
+    assert not slots["4.0"].superseded
+    assert scheduler.stats["superseded"] == 1
+
+
+def test_entry_of_a_gone_instance_does_not_block_the_queue(scheduler):
+    scheduler.max_wait = 0.5
+    scheduler.r.rpush("slackbot_sched:pending:user1", b'{"ts":"0.5","text":"lost","at":0}')
+
+    with scheduler.slot(question("user1", "1.0", "first")) as slot:
+        assert slot.wait_ms < 400
+    assert scheduler.stats["timeouts"] == 0
+
+
+def test_global_limit_caps_searches_of_different_users(scheduler):
+    scheduler.max_wait = 0.1
+    with scheduler.slot(question("user1", "1.0", "a")), scheduler.slot(question("user2", "1.0", "b")):
+        with scheduler.slot(question("user3", "1.0", "c")) as slot:
+            # over max_wait the search runs anyway
+            assert not slot.superseded
+    assert scheduler.stats["timeouts"] == 1
+    with scheduler.slot(question("user3", "2.0", "d")) as slot:
+        assert slot.wait_ms < 100
+    assert scheduler.stats["timeouts"] == 1
+
+
+def test_timed_out_question_leaves_the_queue(scheduler):
+    scheduler.max_wait = 0.1
+    with scheduler.slot(question("user1", "1.0", "first")):
+        with scheduler.slot(question("user1", "2.0", "second")) as slot:
+            # over max_wait the search runs on its own
+            assert not slot.superseded
+    assert scheduler.stats["timeouts"] == 1
+    assert scheduler.r.lrange("slackbot_sched:pending:user1", 0, -1) == []
+    with scheduler.slot(question("user1", "3.0", "third")) as slot:
+        assert slot.wait_ms < 50
+
+
+def test_global_timeout_keeps_the_coalesced_repeats(scheduler):
+    scheduler.max_wait = 0.5
+    slots = {}
+
+    def ask(ts, text):
+        with scheduler.slot(question("user3", ts, text)) as slot:
+            slots[ts] = slot
+
+    with scheduler.slot(question("user1", "1.0", "a")):
+        with scheduler.slot(question("user3", "1.0", "b")):
+            waiting = [threading.Thread(target=ask, args=("2.0", "rotate keys")), threading.Thread(target=ask, args=("3.0", "Rotate keys?"))]
+            for thread in waiting:
+                thread.start()
+                sleep(0.05)
+            # another instance takes the global slot user3 frees
+            scheduler.r.zadd("slackbot_sched:global", {"other": time() + 60})
+        for thread in waiting:
+            thread.join()
+
+    assert slots["2.0"].coalesced == 1
+    assert slots["3.0"].superseded
+    assert scheduler.stats["timeouts"] == 1
+
+
+def test_runs_unscheduled_without_redis():
+    server = fakeredis.FakeServer()
+    server.connected = False
+    scheduler = SearchScheduler(fakeredis.FakeRedis(server=server))
+
+    with scheduler.slot(question("user1", "1.0", "query")) as slot:
+        assert slot.priority == SEARCH
+        assert not slot.superseded
@@ -0,0 +1,57 @@
+import os
+import sys
+from unittest.mock import MagicMock
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../cloud_functions/handle_messages"))
+from search_client import CircuitOpenError, SearchClient  # noqa: E402
+
+
+def make_client(*outcomes, **kwargs):
+    """SearchClient whose session answers with the given statuses or raises the given errors"""
+    client = SearchClient("https://search.example", backoff=0, **kwargs)
+    responses = []
+    for outcome in outcomes:
+        if isinstance(outcome, Exception):
+            responses.append(outcome)
+        else:
+            responses.append(MagicMock(status_code=outcome))
+    client.session.post = MagicMock(side_effect=responses)
+    return client
+
+
+def test_cold_start_statuses_are_retried():
+    client = make_client(503, 429, 200)
+    assert client.post({"query": "q"}, {}).status_code == 200
+    assert client.session.post.call_count == 3
+    assert client.stats["retries"] == 2
+
+
+def test_server_error_is_not_retried():
+    client = make_client(500, 200)
+    assert client.post({"query": "q"}, {}).status_code == 500
+    assert client.session.post.call_count == 1
+
+
+def test_connection_errors_are_retried_and_read_timeouts_are_not():
+    client = make_client(requests.exceptions.ConnectionError("reset"), 200)
+    assert client.post({"query": "q"}, {}).status_code == 200
+    assert client.session.post.call_count == 2
+
+    client = make_client(requests.exceptions.ReadTimeout("slow"), 200)
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        client.post({"query": "q"}, {})
+    assert client.session.post.call_count == 1
+
+
+def test_breaker_opens_after_consecutive_failures():
+    client = make_client(*[requests.exceptions.ConnectionError("down")] * 2, retries=0, breaker_threshold=2)
+    for _ in range(2):
+        with pytest.raises(requests.exceptions.ConnectionError):
+            client.post({"query": "q"}, {})
+    with pytest.raises(CircuitOpenError):
+        client.post({"query": "q"}, {})
+    assert client.session.post.call_count == 2
+    assert client.stats["short_circuited"] == 1
@@ -0,0 +1,73 @@
+import os
+import sys
+from time import perf_counter
+from types import SimpleNamespace
+
+import fakeredis
+import pytest
+from slack_sdk.errors import SlackApiError
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from slack_client import RateLimitedSlackClient  # noqa: E402
+
+LIMITS = {"chat.postMessage": (10.0, 2, "channel")}
+
+
+class RecordingWebClient:
+    """WebClient answering 429 for the first rate_limited calls"""
+
+    def __init__(self, rate_limited=0, status_code=429):
+        self.rate_limited = rate_limited
+        self.status_code = status_code
+        self.calls = []
+
+    def chat_postMessage(self, **kwargs):
+        self.calls.append((perf_counter(), kwargs))
+        if self.rate_limited:
+            self.rate_limited -= 1
+            response = SimpleNamespace(status_code=self.status_code, headers={"Retry-After": "0.2"}, data={"ok": False})
+            raise SlackApiError("ratelimited", response)
+        return {"ok": True, "channel": kwargs["channel"]}
+
+
+def test_burst_is_queued_at_the_limit():
+    web_client = RecordingWebClient()
+    client = RateLimitedSlackClient(web_client, fakeredis.FakeRedis(), limits=LIMITS)
+
+    for _ in range(4):
+        client.chat_postMessage(channel="user1", text="hi")
+    client.chat_postMessage(channel="user2", text="hi")
+
+    sent = [at for at, _ in web_client.calls]
+    # two go out right away, the rest 0.1s apart; another channel has its own bucket
+    assert sent[3] - sent[0] >= 0.18
+    assert client.stats["queued"] == 2
+
+
+def test_buckets_are_shared_between_instances():
+    server = fakeredis.FakeServer()
+    first, second = RecordingWebClient(), RecordingWebClient()
+    clients = [RateLimitedSlackClient(web_client, fakeredis.FakeRedis(server=server), limits=LIMITS) for web_client in (first, second)]
+
+    clients[0].chat_postMessage(channel="user1", text="hi")
+    clients[0].chat_postMessage(channel="user1", text="hi")
+    clients[1].chat_postMessage(channel="user1", text="hi")
+
+    assert clients[1].stats["queued"] == 1
+
+
+def test_rate_limited_call_is_retried_after_retry_after():
+    web_client = RecordingWebClient(rate_limited=1)
+    client = RateLimitedSlackClient(web_client, fakeredis.FakeRedis(), limits=LIMITS)
+
+    assert client.chat_postMessage(channel="user1", text="hi")["ok"]
+    assert web_client.calls[1][0] - web_client.calls[0][0] >= 0.2
+    assert client.stats["rate_limited"] == 1
+
+
+def test_other_errors_are_raised():
+    client = RateLimitedSlackClient(RecordingWebClient(rate_limited=1, status_code=400), limits=LIMITS)
+
+    with pytest.raises(SlackApiError):
+        client.chat_postMessage(channel="user1", text="hi")
+    assert client.stats["failed"] == 1
@@ -0,0 +1,105 @@
+import json
+import os
+import sys
+import threading
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter, time
+from typing import Dict, Iterable, Iterator, Optional
+
+from utils import logger
+
+# spans are also appended here as JSON lines when set, for local runs and the summary report
+TRACE_EXPORT_PATH = os.environ.get('TRACE_EXPORT_PATH')
+
+_trace_id: ContextVar[Optional[str]] = ContextVar('trace_id', default=None)
+_export_lock = threading.Lock()
+
+
+def set_trace(trace_id: Optional[str] = None) -> str:
+    """makes trace_id the current trace, starting a new one when it is missing
+
+    Args:
+        trace_id (Optional[str]): id propagated from the previous hop
+
+    Returns:
+        str: the current trace id
+    """
+    trace_id = trace_id or uuid.uuid4().hex
+    _trace_id.set(trace_id)
+    return trace_id
+
+
+def current_trace_id() -> Optional[str]:
+    """returns the current trace id, to be forwarded to the next hop"""
+    return _trace_id.get()
+
+
+def record_span(name: str, start: float, duration: float, **attributes) -> None:
+    """logs a finished span as structured JSON and exports it locally when configured
+
+    Args:
+        name (str): stage name
+        start (float): epoch time the stage started
+        duration (float): duration in seconds
+    """
+    span_record = {'trace_id': current_trace_id(), 'span': name, 'start': start,
+                   'duration_ms': round(duration * 1000, 3), **attributes}
+    logger.info("span %s %.1fms", name, span_record['duration_ms'], extra={'json_fields': span_record})
+    if TRACE_EXPORT_PATH:
+        with _export_lock, open(TRACE_EXPORT_PATH, 'a') as f:
+            f.write(json.dumps(span_record) + '\n')
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Dict]:
+    """times the enclosed block as a span of the current trace
+
+    Args:
+        name (str): stage name, e.g. "retrieval" or "slack_post"
+
+    Yields:
+        Iterator[Dict]: attributes dict the block can add to
+    """
+    start_epoch, start = time(), perf_counter()
+    try:
+        yield attributes
+    except Exception as e:
+        attributes['error'] = type(e).__name__
+        raise
+    finally:
+        record_span(name, start_epoch, perf_counter() - start, **attributes)
+
+
+def _percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def summarize(records: Iterable[Dict]) -> Dict[str, Dict[str, float]]:
+    """computes p50/p95/p99 duration per stage
+
+    Args:
+        records (Iterable[Dict]): exported span records
+
+    Returns:
+        Dict[str, Dict[str, float]]: stage -> {"count", "p50", "p95", "p99"} in milliseconds
+    """
+    durations = {}
+    for span_record in records:
+        durations.setdefault(span_record['span'], []).append(span_record['duration_ms'])
+    return {name: {'count': len(values), 'p50': _percentile(values, 50),
+                   'p95': _percentile(values, 95), 'p99': _percentile(values, 99)}
+            for name, values in durations.items()}
+
+
+if __name__ == "__main__":
+    # python tracing.py spans.jsonl [more.jsonl ...]
+    records = []
+    for path in sys.argv[1:]:
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    print(f"{'stage':<24}{'count':>8}{'p50 ms':>12}{'p95 ms':>12}{'p99 ms':>12}")
+    for name, stats in sorted(summarize(records).items(), key=lambda item: -item[1]['p50']):
+        print(f"{name:<24}{stats['count']:>8}{stats['p50']:>12.1f}{stats['p95']:>12.1f}{stats['p99']:>12.1f}")
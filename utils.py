@@ -1,5 +1,6 @@
 from google.cloud import secretmanager
 import logging
+import logging.config
 from google.cloud.logging_v2.handlers import CloudLoggingHandler
 from google.cloud import logging as cloud_logging
 